@@ -9,13 +9,15 @@ from party import Address
 from stock import (
     ShipmentOut, EndiciaRefundRequestWizardView, EndiciaRefundRequestWizard,
     BuyPostageWizardView, BuyPostageWizard, ShippingEndicia,
-    GenerateShippingLabel
+    GenerateShippingLabel, EndiciaLabelDocument
 )
 from shipment_bag import EndiciaShipmentBag
 from carrier import Carrier, EndiciaMailclass
 from sale import Configuration, Sale
-from configuration import EndiciaConfiguration
+from configuration import EndiciaConfiguration, EndiciaAccount
 from country import Country
+from attachment import Attachment
+from location import EndiciaLabelProfile, Location
 
 
 def register():
@@ -30,13 +32,18 @@ def register():
         EndiciaRefundRequestWizardView,
         BuyPostageWizardView,
         EndiciaConfiguration,
+        EndiciaAccount,
         Country,
         ShippingEndicia,
+        Attachment,
+        EndiciaLabelProfile,
+        Location,
         module='endicia_integration', type_='model'
     )
     Pool.register(
         EndiciaRefundRequestWizard,
         BuyPostageWizard,
         GenerateShippingLabel,
+        EndiciaLabelDocument,
         module='endicia_integration', type_='wizard'
     )
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+    attachment.py
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import base64
+from StringIO import StringIO
+import hashlib
+import tempfile
+
+from trytond.pool import PoolMeta
+from trytond.config import config
+from trytond.transaction import Transaction
+
+__metaclass__ = PoolMeta
+__all__ = ['Attachment']
+
+
+class FileStore(object):
+    """
+    Write a file in chunks into the attachment filestore without holding
+    it in memory.
+
+    Files are addressed by their digest, the same way ir.attachment
+    stores them, so identical files are stored only once.
+    """
+
+    def __init__(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0770)
+        self.directory = directory
+        self.md5 = hashlib.md5()
+        self.size = 0
+        file_d, self.temp_name = tempfile.mkstemp(dir=directory)
+        self.file_p = os.fdopen(file_d, 'wb')
+
+    def write(self, data):
+        """
+        :param data: Chunk of the file, of any length
+        """
+        self.md5.update(data)
+        self.size += len(data)
+        self.file_p.write(data)
+
+    def abort(self):
+        """
+        Discard the data written so far
+        """
+        if not self.file_p.closed:
+            self.file_p.close()
+        if os.path.exists(self.temp_name):
+            os.unlink(self.temp_name)
+
+    def close(self):
+        """
+        Move the file into the filestore
+
+        :return: Tuple of (digest, value). The value is the data of the
+                 file only if a different file with the same digest is
+                 already stored, and is None otherwise.
+        """
+        try:
+            self.file_p.close()
+
+            digest = self.md5.hexdigest()
+            directory = os.path.join(self.directory, digest[0:2], digest[2:4])
+            if not os.path.isdir(directory):
+                os.makedirs(directory, 0770)
+            filename = os.path.join(directory, digest)
+
+            if not os.path.isfile(filename):
+                os.chmod(self.temp_name, 0660)
+                os.rename(self.temp_name, filename)
+            elif os.stat(filename).st_size != self.size:
+                # Let ir.attachment resolve the collision
+                with open(self.temp_name, 'rb') as file_p:
+                    return digest, buffer(file_p.read())
+        finally:
+            self.abort()
+        return digest, None
+
+
+class Base64FileStore(FileStore):
+    """
+    Decode base64 data written in chunks into the attachment filestore
+    without holding the decoded data in memory.
+    """
+
+    def __init__(self, directory):
+        super(Base64FileStore, self).__init__(directory)
+        self.remainder = ''
+
+    def write(self, data):
+        """
+        :param data: Chunk of base64 data, of any length
+        """
+        # Line breaks are allowed in base64 encoded XML text
+        data = self.remainder + ''.join(str(data).split())
+        cut = len(data) - len(data) % 4
+        self.remainder = data[cut:]
+        if cut:
+            super(Base64FileStore, self).write(base64.b64decode(data[:cut]))
+
+    def close(self):
+        """
+        Move the decoded file into the filestore
+
+        :return: Tuple of (digest, value) as returned by FileStore.close
+        """
+        if self.remainder:
+            try:
+                super(Base64FileStore, self).write(
+                    base64.b64decode(self.remainder)
+                )
+            except Exception:
+                self.abort()
+                raise
+        return super(Base64FileStore, self).close()
+
+
+class Attachment:
+    __name__ = 'ir.attachment'
+
+    def open_data(self):
+        """
+        Returns a file object to read the data of the attachment without
+        loading it all in memory.
+        """
+        if not self.digest:
+            return StringIO(str(self.data or ''))
+
+        filename = self.digest
+        if self.collision:
+            filename = filename + '-' + str(self.collision)
+        return open(os.path.join(
+            self.get_filestore_directory(), filename[0:2], filename[2:4],
+            filename
+        ), 'rb')
+
+    @staticmethod
+    def get_filestore_directory():
+        """
+        Returns the directory of the filestore of the database
+        """
+        return os.path.join(
+            config.get('database', 'path'), Transaction().cursor.dbname
+        )
+
+    @classmethod
+    def open_file_store(cls):
+        """
+        Returns a FileStore writing to the filestore of the database
+        """
+        return FileStore(cls.get_filestore_directory())
+
+    @classmethod
+    def open_base64_store(cls):
+        """
+        Returns a Base64FileStore writing to the filestore of the database
+        """
+        return Base64FileStore(cls.get_filestore_directory())
+
+    @staticmethod
+    def get_stored_values(digest, value):
+        """
+        Returns the values to create an attachment of a stored file
+
+        :param digest: Digest and value as returned by FileStore.close
+        """
+        if value is None:
+            return {
+                'digest': digest,
+                'collision': 0,
+            }
+        return {
+            'data': value,
+        }
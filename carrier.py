@@ -5,10 +5,105 @@ from decimal import Decimal
 from trytond.model import ModelSQL, ModelView, fields
 from trytond.pool import PoolMeta, Pool
 from trytond.transaction import Transaction
+from trytond import backend
 
-__all__ = ['Carrier', 'EndiciaMailclass', ]
+__all__ = ['Carrier', 'EndiciaMailclass', 'EndiciaShippingMixin']
 __metaclass__ = PoolMeta
 
+# Models storing whether their carrier is Endicia
+ENDICIA_SHIPPING_MODELS = ['sale.sale', 'stock.shipment.out']
+
+
+class EndiciaShippingMixin(object):
+    """
+    Store whether the carrier of the record is Endicia, so the records
+    shipped with Endicia are filtered with an indexed column instead of a
+    join on the carrier.
+    """
+    is_endicia_shipping = fields.Boolean(
+        'Is Endicia Shipping?', readonly=True, select=True
+    )
+
+    @staticmethod
+    def default_is_endicia_shipping():
+        return False
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+
+        filled = TableHandler.table_exist(cursor, cls._table) and \
+            TableHandler(cursor, cls, module_name).column_exist(
+                'is_endicia_shipping')
+        super(EndiciaShippingMixin, cls).__register__(module_name)
+
+        # Migration: fill the column of the existing records
+        if not filled:
+            cls.update_is_endicia_shipping()
+
+    @classmethod
+    def update_is_endicia_shipping(cls, carriers=None):
+        """
+        Set is_endicia_shipping of the records from the cost method of
+        their carrier, with one UPDATE.
+
+        :param carriers: Update only the records of these carriers
+        """
+        Carrier = Pool().get('carrier')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        carrier = Carrier.__table__()
+
+        endicia = table.carrier.in_(carrier.select(
+            carrier.id, where=carrier.carrier_cost_method == 'endicia'
+        ))
+        if carriers is None:
+            where = None
+        else:
+            where = table.carrier.in_([c.id for c in carriers])
+            endicia &= where
+        cursor.execute(*table.update(
+            [table.is_endicia_shipping], [False], where=where
+        ))
+        cursor.execute(*table.update(
+            [table.is_endicia_shipping], [True], where=endicia
+        ))
+
+        # Clean cursor cache
+        Transaction().counter += 1
+        for cache in cursor.cache.itervalues():
+            cache.pop(cls.__name__, None)
+
+    @classmethod
+    def _set_is_endicia_shipping(cls, values):
+        """
+        Returns the values with is_endicia_shipping set when the carrier
+        is in the values
+        """
+        Carrier = Pool().get('carrier')
+
+        if 'carrier' not in values:
+            return values
+        values = values.copy()
+        values['is_endicia_shipping'] = bool(values['carrier']) and \
+            Carrier(values['carrier']).carrier_cost_method == 'endicia'
+        return values
+
+    @classmethod
+    def create(cls, vlist):
+        return super(EndiciaShippingMixin, cls).create(
+            map(cls._set_is_endicia_shipping, vlist)
+        )
+
+    @classmethod
+    def write(cls, *args):
+        actions = iter(args)
+        args = []
+        for records, values in zip(actions, actions):
+            args.extend((records, cls._set_is_endicia_shipping(values)))
+        super(EndiciaShippingMixin, cls).write(*args)
+
 
 class Carrier:
     "Carrier"
@@ -21,6 +116,19 @@ class Carrier:
         if selection not in cls.carrier_cost_method.selection:
             cls.carrier_cost_method.selection.append(selection)
 
+    @classmethod
+    def write(cls, *args):
+        super(Carrier, cls).write(*args)
+
+        actions = iter(args)
+        carriers = []
+        for records, values in zip(actions, actions):
+            if 'carrier_cost_method' in values:
+                carriers.extend(records)
+        if carriers:
+            for model in ENDICIA_SHIPPING_MODELS:
+                Pool().get(model).update_is_endicia_shipping(carriers)
+
     def get_rates(self):
         """
         Return list of tuples as:
@@ -65,7 +173,6 @@ class Carrier:
         if self.carrier_cost_method != 'endicia':
             return super(Carrier, self).get_sale_price()
 
-        usd, = Currency.search([('code', '=', 'USD')])
         if sale:
             return Sale(sale).get_endicia_shipping_cost(), usd.id
 
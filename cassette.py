@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+"""
+    cassette.py
+
+    Record the requests sent to Endicia and their responses into cassette
+    files, and replay them instead of sending the requests.
+
+    Every call is recorded when the `record` option of the `endicia`
+    section of the configuration file names a directory::
+
+        [endicia]
+        record = /var/lib/trytond/endicia
+
+    Each process appends to a gzip compressed file of JSON lines per day,
+    named `endicia-<date>-<pid>.jsonl.gz`. The credentials are removed
+    from the recorded requests.
+
+    The recorded responses are served instead of sending the requests
+    when the `replay` option names cassette files or directories holding
+    them::
+
+        [endicia]
+        replay = /var/lib/trytond/endicia
+
+    The responses of a cassette can also be parsed offline, to profile
+    the parsing or reproduce its failures::
+
+        python -m trytond.modules.endicia_integration.cassette \\
+            /var/lib/trytond/endicia/endicia-20150601-1234.jsonl.gz
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import re
+import glob
+import gzip
+import json
+import time
+import hashlib
+import logging
+import threading
+import urlparse
+from datetime import datetime
+
+from trytond.config import config
+
+__all__ = [
+    'CassetteError', 'CassetteRecorder', 'Cassette', 'redact',
+    'fingerprint', 'get_recorder', 'get_cassette',
+]
+
+logger = logging.getLogger(__name__)
+
+# Elements removed from the recorded requests
+REDACTED_ELEMENTS = (
+    'AccountID', 'RequesterID', 'PassPhrase', 'NewPassPhrase',
+)
+
+# Elements which differ between two databases sending the same request,
+# ignored by the fingerprints
+VOLATILE_ELEMENTS = (
+    'PartnerCustomerID', 'PartnerTransactionID', 'RequestID',
+)
+
+REDACTED = 'REDACTED'
+
+
+def _element_pattern(tags):
+    return re.compile(r'<(%s)>[^<]*</\1>' % '|'.join(tags))
+
+REDACTED_PATTERN = _element_pattern(REDACTED_ELEMENTS)
+VOLATILE_PATTERN = _element_pattern(VOLATILE_ELEMENTS)
+# Whitespace between elements, which changes with pretty printing
+BLANK_PATTERN = re.compile(r'>\s+<')
+
+
+class CassetteError(Exception):
+    """
+    No response was recorded for a request being replayed
+    """
+
+
+def redact(values):
+    """
+    Returns the posted values without the credentials
+    """
+    return dict(
+        (key, REDACTED_PATTERN.sub(r'<\1>%s</\1>' % REDACTED, value))
+        for key, value in values.iteritems()
+    )
+
+
+def fingerprint(url, values):
+    """
+    Returns the fingerprint of a request, the same for the requests a
+    recorded response is served for.
+
+    :param url: URL of the Endicia API, only its path is used
+    :param values: Posted values, redacted or not
+    """
+    digest = hashlib.sha1(urlparse.urlsplit(url).path)
+    for key, value in sorted(redact(values).iteritems()):
+        value = BLANK_PATTERN.sub('><', VOLATILE_PATTERN.sub('', value))
+        digest.update('\0%s\0%s' % (key, value.strip()))
+    return digest.hexdigest()
+
+
+def read_entries(path):
+    """
+    Yields the entries recorded in a cassette file
+    """
+    with gzip.open(path, 'rb') as cassette:
+        for line in cassette:
+            if line.strip():
+                yield json.loads(line)
+
+
+def cassette_paths(paths):
+    """
+    Returns the cassette files of the paths, directories being replaced
+    by the cassettes they hold.
+    """
+    result = []
+    for path in paths:
+        if os.path.isdir(path):
+            result.extend(
+                sorted(glob.glob(os.path.join(path, '*.jsonl.gz')))
+            )
+        else:
+            result.append(path)
+    return result
+
+
+class CassetteRecorder(object):
+    """
+    Append the calls to Endicia to cassette files of a directory
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, 'endicia-%s-%s.jsonl.gz' % (
+            datetime.utcnow().strftime('%Y%m%d'), os.getpid()
+        ))
+
+    def record(self, url, values, response, duration):
+        """
+        Record a call
+
+        :param url: URL of the Endicia API
+        :param values: Values posted
+        :param response: Response of Endicia as string
+        :param duration: Time taken by the call, in seconds
+        """
+        entry = json.dumps({
+            'date': datetime.utcnow().isoformat(),
+            'url': url,
+            'fingerprint': fingerprint(url, values),
+            'request': redact(values),
+            'response': response.decode('utf-8'),
+            'duration': duration,
+        })
+        with self.lock:
+            # Each call is written as a gzip member of its own, so the
+            # cassette is readable even if the process is killed.
+            with gzip.open(self.path, 'ab') as cassette:
+                cassette.write(entry + '\n')
+
+
+class Cassette(object):
+    """
+    Responses recorded in cassette files, served by request fingerprint.
+
+    The responses recorded for the same fingerprint are served in the
+    order they were recorded, the last one being served again once all
+    were served.
+    """
+
+    def __init__(self, paths):
+        self.responses = {}
+        self.lock = threading.Lock()
+        for path in cassette_paths(paths):
+            for entry in read_entries(path):
+                self.responses.setdefault(entry['fingerprint'], []).append(
+                    entry['response'].encode('utf-8')
+                )
+
+    def __len__(self):
+        return sum(map(len, self.responses.itervalues()))
+
+    def play(self, url, values):
+        """
+        Returns the response recorded for the request
+
+        :raises CassetteError: if no response was recorded
+        """
+        key = fingerprint(url, values)
+        with self.lock:
+            responses = self.responses.get(key)
+            if not responses:
+                raise CassetteError(
+                    'No response recorded for the request to %s' % url
+                )
+            if len(responses) > 1:
+                return responses.pop(0)
+            return responses[0]
+
+
+_recorders = {}
+_cassettes = {}
+_lock = threading.Lock()
+
+
+def get_recorder():
+    """
+    Returns the recorder of the configured directory, None if the calls
+    are not recorded.
+    """
+    directory = config.get('endicia', 'record')
+    if not directory:
+        return None
+    with _lock:
+        if directory not in _recorders:
+            _recorders[directory] = CassetteRecorder(directory)
+        return _recorders[directory]
+
+
+def get_cassette():
+    """
+    Returns the cassette of the configured files, None if the calls are
+    not replayed.
+    """
+    paths = config.get('endicia', 'replay')
+    if not paths:
+        return None
+    with _lock:
+        if paths not in _cassettes:
+            _cassettes[paths] = Cassette(paths.split())
+            logger.info(
+                'Replaying %s Endicia responses of %s',
+                len(_cassettes[paths]), paths
+            )
+        return _cassettes[paths]
+
+
+class DiscardedImage(object):
+    """
+    Image store of the responses parsed offline, keeping only the size
+    """
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+
+    def close(self):
+        return self.size
+
+    def abort(self):
+        pass
+
+
+def parse_response(response):
+    """
+    Parse a recorded response as the module does
+    """
+    from lxml import etree
+    from .response import StreamedResponse
+
+    parser = etree.XMLParser(target=StreamedResponse(DiscardedImage))
+    parser.feed(response)
+    return parser.close()
+
+
+def main():
+    import sys
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Parse the responses of Endicia cassettes'
+    )
+    parser.add_argument('paths', nargs='+', help='cassette files')
+    options = parser.parse_args()
+
+    totals = {}
+    failures = 0
+    for path in cassette_paths(options.paths):
+        for entry in read_entries(path):
+            operation = urlparse.urlsplit(entry['url']).path.rsplit('/')[-1]
+            if operation.startswith('ELSServices'):
+                operation = entry['request'].get('method', operation)
+            count, duration, parse_time = totals.get(operation, (0, 0, 0))
+            start = time.time()
+            try:
+                parse_response(entry['response'].encode('utf-8'))
+            except Exception, error:
+                failures += 1
+                print >> sys.stderr, '%s %s %s: %s' % (
+                    path, entry['date'], operation, error
+                )
+            totals[operation] = (
+                count + 1, duration + entry['duration'],
+                parse_time + time.time() - start,
+            )
+
+    print '%-28s %8s %12s %12s' % ('operation', 'calls', 'endicia', 'parse')
+    for operation, (count, duration, parse_time) in sorted(
+            totals.iteritems()):
+        print '%-28s %8d %11.3fs %11.3fs' % (
+            operation, count, duration, parse_time
+        )
+    if failures:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+    client.py
+
+    Send several Endicia requests at the same time from one request of the
+    server, so rating many mail classes or many sales takes about as long
+    as the slowest call instead of the sum of the calls.
+
+    The requests are sent by threads, which only run the transport: the
+    requests are built and the responses are used in the thread of the
+    server request, with its transaction. The slots and rate limits of the
+    accounts still apply to each request.
+
+    The number of requests sent at the same time by a server request is
+    set in the configuration file::
+
+        [endicia]
+        parallel_requests = 8
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import sys
+import threading
+from Queue import Queue, Empty
+
+from trytond.config import config
+
+from .metrics import send_request
+
+__all__ = [
+    'Result', 'send_requests', 'calculate_postage', 'postage_rates',
+]
+
+# Requests sent at the same time when not configured
+DEFAULT_PARALLEL_REQUESTS = 8
+
+
+class Result(object):
+    """
+    Outcome of a request sent with the others
+    """
+
+    def __init__(self):
+        self.response = None
+        self.exc_info = None
+
+    def get(self):
+        """
+        Returns the response, raising again the exception of the request
+        if it failed.
+        """
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.response
+
+
+def _send_queued_requests(queue):
+    """
+    Send the requests of the queue until it is empty, storing the
+    response or the exception of each request in its result
+
+    :param queue: Queue of tuples of the request and its Result
+    """
+    while True:
+        try:
+            (name, api), result = queue.get_nowait()
+        except Empty:
+            return
+        try:
+            result.response = send_request(name, api)
+        except Exception:
+            result.exc_info = sys.exc_info()
+
+
+def send_requests(requests, parallel=None):
+    """
+    Send the requests at the same time and wait for all of them
+
+    :param requests: List of tuples of the name of the API in the metrics
+                     and the API
+    :param parallel: Number of requests sent at the same time, from the
+                     configuration if None
+    :return: List of results in the order of the requests
+    """
+    if parallel is None:
+        parallel = config.getint('endicia', 'parallel_requests') or \
+            DEFAULT_PARALLEL_REQUESTS
+    results = [Result() for _ in requests]
+    queue = Queue()
+    for request in zip(requests, results):
+        queue.put(request)
+
+    threads = [
+        threading.Thread(target=_send_queued_requests, args=(queue,))
+        for _ in xrange(min(parallel, len(requests)) - 1)
+    ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    # The thread of the server request sends requests too
+    _send_queued_requests(queue)
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def calculate_postage(apis, parallel=None):
+    """
+    Send the requests of CalculatingPostageAPI at the same time
+
+    :return: List of results in the order of the APIs
+    """
+    return send_requests(
+        [('calculate_postage', api) for api in apis], parallel
+    )
+
+
+def postage_rates(apis, parallel=None):
+    """
+    Send the requests of PostageRatesAPI at the same time
+
+    :return: List of results in the order of the APIs
+    """
+    return send_requests([('postage_rates', api) for api in apis], parallel)
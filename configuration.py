@@ -5,9 +5,131 @@
     :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
     :license: BSD, see LICENSE for more details.
 """
+from decimal import Decimal
+from datetime import datetime
+from collections import namedtuple
+from itertools import count
+import logging
+
+from endicia import BuyingPostageAPI
+from endicia.tools import objectify_response
+from endicia.exceptions import RequestError
+from sql import For
+
+from trytond import backend
 from trytond.model import fields, ModelSingleton, ModelSQL, ModelView
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.cache import Cache
+from trytond.rpc import RPC
+from trytond.exceptions import UserError
+
+from .metrics import registry, send_request
+from .transport import slots
+from .rate_limit import set_account_rate
+
+__all__ = ['EndiciaConfiguration', 'EndiciaAccount']
+
+logger = logging.getLogger(__name__)
+
+# Immutable snapshot of the credentials sent with every Endicia request,
+# account being the id of the endicia.account they come from, if any
+EndiciaCredentials = namedtuple('EndiciaCredentials', [
+    'account_id', 'requester_id', 'passphrase', 'is_test', 'account',
+])
+
+# Account of the pool, with the warehouse it ships from
+PooledAccount = namedtuple('PooledAccount', [
+    'credentials', 'warehouse', 'max_concurrency',
+])
+
+ACCOUNT_POLICIES = [
+    ('round_robin', 'Round Robin'),
+    ('least_loaded', 'Least Loaded'),
+    ('warehouse', 'Per Warehouse'),
+]
+
+# Fields of the configuration kept in the credentials cache
+CACHED_FIELDS = set([
+    'account_id', 'requester_id', 'passphrase', 'is_test', 'account_policy',
+])
+
+_round_robin = count()
+
+
+def _write_postage_balance(Model, record_id, balance, recredit, lock):
+    """
+    Write the postage balance of the record with a single UPDATE, unless
+    a newer balance was written. When lock is set, the row is locked
+    first and the lookup fails if another transaction holds it.
+    """
+    cursor = Transaction().cursor
+    table = Model.__table__()
+    now = datetime.utcnow()
+
+    if lock:
+        cursor.execute(*table.select(
+            table.id, where=table.id == record_id,
+            for_=For('UPDATE', nowait=True)
+        ))
+
+    columns = [table.postage_balance, table.postage_balance_date]
+    values = [balance, now]
+    if recredit:
+        columns.append(table.postage_recredit_pending)
+        values.append(True)
 
-__all__ = ['EndiciaConfiguration']
+    cursor.execute(*table.update(
+        columns=columns, values=values,
+        where=(table.id == record_id) & (
+            (table.postage_balance_date == None) |  # noqa
+            (table.postage_balance_date <= now)
+        )
+    ))
+
+
+def update_postage_balance_row(Model, record_id, balance, recredit=False):
+    """
+    Record the postage balance of a configuration or account row.
+
+    The rows are updated by every label and rate request. On PostgreSQL
+    the transactions are REPEATABLE READ, so two requests updating the
+    same row in their transactions would fail to serialize after Endicia
+    sold their labels, and the retried request would buy a second label.
+    The balance is then written and committed with its own cursor, and
+    skipped when another transaction holds the row, as that transaction
+    writes a balance as recent.
+
+    :param Model: Model of the row
+    :param record_id: Id of the row
+    :param balance: Postage balance in USD as Decimal
+    :param recredit: True to flag a recredit
+    """
+    if backend.name() == 'postgresql':
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+        with Transaction().new_cursor() as transaction:
+            try:
+                _write_postage_balance(
+                    Model, record_id, balance, recredit, True
+                )
+                transaction.cursor.commit()
+            except DatabaseOperationalError:
+                transaction.cursor.rollback()
+                logger.info(
+                    'Postage balance %s of %s,%s skipped, the row is locked',
+                    balance, Model.__name__, record_id
+                )
+    else:
+        # The other backends lock the database for the transaction, so
+        # the balance is written in it
+        _write_postage_balance(Model, record_id, balance, recredit, False)
+
+    # Clean cursor cache
+    cursor = Transaction().cursor
+    Transaction().counter += 1
+    for cache in cursor.cache.itervalues():
+        if Model.__name__ in cache:
+            cache[Model.__name__].pop(record_id, None)
 
 
 class EndiciaConfiguration(ModelSingleton, ModelSQL, ModelView):
@@ -20,6 +142,67 @@ class EndiciaConfiguration(ModelSingleton, ModelSQL, ModelView):
     requester_id = fields.Char('Requester Id')
     passphrase = fields.Char('Passphrase')
     is_test = fields.Boolean('Is Test')
+    label_profile = fields.Many2One(
+        'endicia.label.profile', 'Default Label Profile',
+        help='Label profile used when the warehouse has none.'
+    )
+    refund_sweep_days = fields.Integer(
+        'Refund Unused Labels After (Days)',
+        help='Labels of cancelled shipments are refunded automatically '
+        'once the shipment has been cancelled for these many days.'
+    )
+    refund_sweep_batch_size = fields.Integer(
+        'Refund Batch Size', required=True,
+        help='Number of labels sent in a single refund request.'
+    )
+    refund_sweep_watermark = fields.DateTime(
+        'Refund Sweep Watermark', readonly=True,
+        help='Shipments cancelled before this time have already been '
+        'scanned for refund.'
+    )
+    postage_balance = fields.Numeric(
+        'Postage Balance', digits=(16, 2), readonly=True,
+        help='Remaining postage balance as last reported by Endicia.'
+    )
+    postage_balance_date = fields.DateTime(
+        'Postage Balance Updated On', readonly=True
+    )
+    postage_low_balance = fields.Numeric(
+        'Low Balance Threshold', digits=(16, 2),
+        help='Postage is bought automatically when the balance falls '
+        'below this amount. Leave empty to disable.'
+    )
+    postage_recredit_amount = fields.Numeric(
+        'Recredit Amount', digits=(16, 2),
+        help='Amount of postage in USD bought when the balance is low.'
+    )
+    postage_recredit_pending = fields.Boolean(
+        'Recredit Pending', readonly=True
+    )
+    account_policy = fields.Selection(
+        ACCOUNT_POLICIES, 'Account Policy', required=True,
+        help='How the account of a request is chosen among the Endicia '
+        'accounts of the company. The credentials above are used when the '
+        'company has no account.'
+    )
+
+    # Credentials of each database. The cache is cleared when they are
+    # changed, and its timestamp clears it in the other processes.
+    _credentials_cache = Cache(
+        'endicia_configuration.credentials', context=False
+    )
+
+    @staticmethod
+    def default_refund_sweep_days():
+        return 7
+
+    @staticmethod
+    def default_refund_sweep_batch_size():
+        return 50
+
+    @staticmethod
+    def default_account_policy():
+        return 'round_robin'
 
     @classmethod
     def __setup__(cls):
@@ -27,11 +210,61 @@ class EndiciaConfiguration(ModelSingleton, ModelSQL, ModelView):
         cls._error_messages.update({
             'endicia_credentials_required':
                 'Endicia settings on endicia configuration are incomplete.',
+            'error_buy_postage': 'Error in buying postage "%s"',
+        })
+        cls.__rpc__.update({
+            'get_endicia_metrics': RPC(),
+            'get_endicia_metrics_text': RPC(),
+            'warm_up_endicia_caches': RPC(),
         })
 
-    def get_endicia_credentials(self):
+    @classmethod
+    def get_endicia_metrics(cls):
+        """
+        Returns the latency, response size, status codes and cache hits
+        of each Endicia API, as measured by this server process.
+        """
+        return registry.to_dict()
+
+    @classmethod
+    def get_endicia_metrics_text(cls):
+        """
+        Returns the metrics of the Endicia APIs in the Prometheus text
+        format.
+        """
+        return registry.to_prometheus()
+
+    def get_endicia_credentials(self, warehouse=None, account=None):
         """Validate if endicia credentials are complete.
+
+        When the company has Endicia accounts, the credentials of one of
+        them are chosen with the account policy.
+
+        :param warehouse: Warehouse the request is made for
+        :param account: Account the credentials are required of, like the
+                        one which bought a label
+        :return: EndiciaCredentials snapshot, read once and kept until the
+                 credentials are changed
+        """
+        Account = Pool().get('endicia.account')
+
+        if account:
+            return account.get_credentials()
+
+        accounts = Account.get_endicia_accounts()
+        if accounts:
+            return self.select_endicia_account(accounts, warehouse)
+        return self.get_configuration_credentials()
+
+    def get_configuration_credentials(self):
+        """
+        Returns the EndiciaCredentials snapshot of the credentials of the
+        configuration
         """
+        credentials = self._credentials_cache.get('credentials')
+        if credentials is not None:
+            return credentials
+
         if not all([
             self.account_id,
             self.requester_id,
@@ -39,4 +272,341 @@ class EndiciaConfiguration(ModelSingleton, ModelSQL, ModelView):
         ]):
             self.raise_user_error('endicia_credentials_required')
 
-        return self
+        return self._credentials_cache.set('credentials', EndiciaCredentials(
+            self.account_id, self.requester_id, self.passphrase,
+            bool(self.is_test), None,
+        ))
+
+    def select_endicia_account(self, accounts, warehouse=None):
+        """
+        Returns the credentials of the account chosen for a request
+
+        :param accounts: List of PooledAccount
+        :param warehouse: Warehouse the request is made for
+        """
+        policy = self._credentials_cache.get('policy')
+        if policy is None:
+            policy = self._credentials_cache.set(
+                'policy', self.account_policy
+            )
+
+        candidates = accounts
+        if policy == 'warehouse':
+            candidates = warehouse and [
+                a for a in accounts if a.warehouse == warehouse.id
+            ] or [a for a in accounts if a.warehouse is None] or accounts
+
+        if policy == 'least_loaded':
+            chosen = min(
+                candidates, key=lambda a: slots.load(a.credentials.account_id)
+            )
+        else:
+            chosen = candidates[next(_round_robin) % len(candidates)]
+        return chosen.credentials
+
+    @classmethod
+    def clear_endicia_cache(cls):
+        cls._credentials_cache.clear()
+
+    @classmethod
+    def warm_up_endicia_caches(cls):
+        """
+        Load the credentials, the accounts and the Endicia names of the
+        countries, so the first requests after the server starts do not
+        read them.
+        """
+        Account = Pool().get('endicia.account')
+        Country = Pool().get('country.country')
+
+        config = cls(1)
+        if all([config.account_id, config.requester_id, config.passphrase]):
+            config.get_configuration_credentials()
+        Account.get_endicia_accounts()
+        Country.get_endicia_names()
+
+    @classmethod
+    def create(cls, vlist):
+        configurations = super(EndiciaConfiguration, cls).create(vlist)
+        cls.clear_endicia_cache()
+        return configurations
+
+    @classmethod
+    def write(cls, *args):
+        super(EndiciaConfiguration, cls).write(*args)
+        actions = iter(args)
+        for _, values in zip(actions, actions):
+            if set(values) & CACHED_FIELDS:
+                cls.clear_endicia_cache()
+                break
+
+    @classmethod
+    def delete(cls, configurations):
+        super(EndiciaConfiguration, cls).delete(configurations)
+        cls.clear_endicia_cache()
+
+    @classmethod
+    def update_postage_balance(cls, balance, account=None):
+        """
+        Record the postage balance reported by Endicia.
+
+        The balance is written with a single UPDATE so that concurrent
+        label requests never overwrite it with a value read earlier in
+        their transactions, outside of the transaction of the request on
+        PostgreSQL. When the balance falls below the low balance
+        threshold, a recredit is flagged for the scheduled action.
+
+        :param balance: Postage balance in USD as Decimal
+        :param account: Id of the endicia.account of the balance, None for
+                        the account of the configuration
+        """
+        Account = Pool().get('endicia.account')
+
+        if account:
+            Account.update_postage_balance(account, balance)
+            return
+
+        low_balance = cls(1).postage_low_balance
+        update_postage_balance_row(
+            cls, 1, balance,
+            low_balance is not None and balance < low_balance
+        )
+
+    @classmethod
+    def record_postage_balance(cls, result, account=None):
+        """
+        Record the postage balance if the objectified response has one.
+
+        :param result: Objectified response of an Endicia request
+        :param account: Id of the endicia.account of the request
+        """
+        if hasattr(result, 'PostageBalance'):
+            cls.update_postage_balance(
+                Decimal(str(result.PostageBalance.pyval)), account
+            )
+
+    def buy_postage(self, amount, account=None):
+        """
+        Buy postage for the endicia account
+
+        :param amount: Amount of postage in USD
+        :param account: endicia.account to buy the postage for, the
+                        account of the configuration if None
+        :return: Objectified response from Endicia
+        """
+        if account:
+            endicia_credentials = account.get_credentials()
+        else:
+            endicia_credentials = self.get_configuration_credentials()
+
+        buy_postage_api = BuyingPostageAPI(
+            request_id=Transaction().user,
+            recredit_amount=amount,
+            requesterid=endicia_credentials.requester_id,
+            accountid=endicia_credentials.account_id,
+            passphrase=endicia_credentials.passphrase,
+            test=endicia_credentials.is_test,
+        )
+        try:
+            response = send_request('buy_postage', buy_postage_api)
+        except RequestError, error:
+            self.raise_user_error('error_buy_postage', error_args=(error,))
+
+        result = objectify_response(response)
+        if hasattr(result, 'CertifiedIntermediary'):
+            self.record_postage_balance(
+                result.CertifiedIntermediary, endicia_credentials.account
+            )
+        return result
+
+    @classmethod
+    def recredit_postage(cls):
+        """
+        Buy postage for the configuration and the accounts whose balance
+        fell below their low balance threshold.
+
+        This is called by a scheduled action so that label generation is
+        never held up by the recredit request. A failed purchase is
+        logged and tried again by the next run, without stopping the
+        purchases of the other accounts.
+        """
+        Account = Pool().get('endicia.account')
+
+        config = cls(1)
+        if config.postage_recredit_pending and config.postage_recredit_amount:
+            config._recredit_postage(config)
+        accounts = Account.search([
+            ('postage_recredit_pending', '=', True),
+            ('postage_recredit_amount', '!=', None),
+        ])
+        for account in accounts:
+            config._recredit_postage(account, account)
+
+    def _recredit_postage(self, record, account=None):
+        """
+        Buy the recredit amount of postage of the record and clear its
+        pending recredit
+
+        :param record: endicia.configuration or endicia.account
+        :param account: endicia.account to buy the postage for, the
+                        account of the configuration if None
+        """
+        logger.info(
+            'Postage balance {0} of {1} is below {2}, buying postage of {3}'
+            .format(
+                record.postage_balance, record, record.postage_low_balance,
+                record.postage_recredit_amount
+            )
+        )
+        try:
+            self.buy_postage(record.postage_recredit_amount, account)
+        except UserError, error:
+            logger.warning(
+                'Postage of {0} could not be bought: {1}'.format(
+                    record, error.message
+                )
+            )
+            return
+        record.__class__.write([record], {
+            'postage_recredit_pending': False,
+        })
+
+
+class EndiciaAccount(ModelSQL, ModelView):
+    """
+    Endicia account of a company. The requests of the company are spread
+    over its accounts with the account policy of the configuration.
+    """
+    __name__ = 'endicia.account'
+
+    name = fields.Char('Name', required=True, select=True)
+    company = fields.Many2One(
+        'company.company', 'Company', required=True, select=True
+    )
+    active = fields.Boolean('Active', select=True)
+    account_id = fields.Integer('Account Id', required=True)
+    requester_id = fields.Char('Requester Id', required=True)
+    passphrase = fields.Char('Passphrase', required=True)
+    is_test = fields.Boolean('Is Test')
+    warehouse = fields.Many2One(
+        'stock.location', 'Warehouse', domain=[('type', '=', 'warehouse')],
+        help='Warehouse shipping with this account, with the Per Warehouse '
+        'policy. Accounts without warehouse are used for the others.'
+    )
+    max_concurrency = fields.Integer(
+        'Concurrent Requests',
+        help='Number of requests sent to Endicia at the same time with this '
+        'account, by each server process. Leave empty for no limit.'
+    )
+    rate_limit = fields.Float(
+        'Requests per Second',
+        help='Requests sent to Endicia per second with this account by all '
+        'the server processes. Leave empty to use the rate limit of the '
+        'configuration file.'
+    )
+    postage_balance = fields.Numeric(
+        'Postage Balance', digits=(16, 2), readonly=True,
+        help='Remaining postage balance as last reported by Endicia.'
+    )
+    postage_balance_date = fields.DateTime(
+        'Postage Balance Updated On', readonly=True
+    )
+    postage_low_balance = fields.Numeric(
+        'Low Balance Threshold', digits=(16, 2),
+        help='Postage is bought automatically for this account when its '
+        'balance falls below this amount. Leave empty to disable.'
+    )
+    postage_recredit_amount = fields.Numeric(
+        'Recredit Amount', digits=(16, 2),
+        help='Amount of postage in USD bought when the balance is low.'
+    )
+    postage_recredit_pending = fields.Boolean(
+        'Recredit Pending', readonly=True
+    )
+
+    # Active accounts of each company. The cache is cleared when an
+    # account is changed, and its timestamp clears it in the other
+    # processes.
+    _accounts_cache = Cache('endicia_account.accounts', context=False)
+
+    @staticmethod
+    def default_company():
+        return Transaction().context.get('company')
+
+    @staticmethod
+    def default_active():
+        return True
+
+    @staticmethod
+    def default_max_concurrency():
+        return 4
+
+    def get_credentials(self):
+        """
+        Returns the EndiciaCredentials snapshot of the account
+        """
+        return EndiciaCredentials(
+            self.account_id, self.requester_id, self.passphrase,
+            bool(self.is_test), self.id,
+        )
+
+    @classmethod
+    def get_endicia_accounts(cls):
+        """
+        Returns the PooledAccount of the active accounts of the company of
+        the context, read once and kept until an account is changed. The
+        concurrency limits of the accounts are set on the request slots.
+        """
+        company = Transaction().context.get('company')
+        accounts = cls._accounts_cache.get(company)
+        if accounts is not None:
+            return accounts
+
+        domain = []
+        if company:
+            domain.append(('company', '=', company))
+        accounts = []
+        for account in cls.search(domain, order=[('id', 'ASC')]):
+            slots.set_limit(account.account_id, account.max_concurrency)
+            set_account_rate(account.account_id, account.rate_limit)
+            accounts.append(PooledAccount(
+                account.get_credentials(),
+                account.warehouse and account.warehouse.id,
+                account.max_concurrency,
+            ))
+        return cls._accounts_cache.set(company, accounts)
+
+    @classmethod
+    def clear_endicia_cache(cls):
+        cls._accounts_cache.clear()
+
+    @classmethod
+    def update_postage_balance(cls, account, balance):
+        """
+        Record the postage balance of the account reported by Endicia,
+        and flag a recredit below the low balance threshold of the
+        account, as EndiciaConfiguration does.
+
+        :param account: Id of the account
+        :param balance: Postage balance in USD as Decimal
+        """
+        low_balance = cls(account).postage_low_balance
+        update_postage_balance_row(
+            cls, account, balance,
+            low_balance is not None and balance < low_balance
+        )
+
+    @classmethod
+    def create(cls, vlist):
+        accounts = super(EndiciaAccount, cls).create(vlist)
+        cls.clear_endicia_cache()
+        return accounts
+
+    @classmethod
+    def write(cls, *args):
+        super(EndiciaAccount, cls).write(*args)
+        cls.clear_endicia_cache()
+
+    @classmethod
+    def delete(cls, accounts):
+        super(EndiciaAccount, cls).delete(accounts)
+        cls.clear_endicia_cache()
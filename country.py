@@ -7,6 +7,8 @@
 """
 from trytond.pool import PoolMeta
 from trytond.model import fields
+from trytond.cache import Cache
+from trytond.transaction import Transaction
 
 __metaclass__ = PoolMeta
 __all__ = ['Country']
@@ -18,12 +20,70 @@ class Country:
 
     endicia_country_name = fields.Char('Endicia Country Name')
     endicia_name = fields.Function(
-        fields.Char('Endicia Name'), 'get_endicia_name'
+        fields.Char('Endicia Name'), 'get_endicia_name',
+        searcher='search_endicia_name'
     )
 
-    def get_endicia_name(self, name):
+    # Endicia name of each country code, per language
+    _endicia_names_cache = Cache(
+        'country_country.endicia_names', context=False
+    )
+
+    @classmethod
+    def get_endicia_name(cls, countries, name):
         """
         Checks if there is some name defined in endicia_country_name
         and returns it, else returns the name of country
         """
-        return self.endicia_country_name or self.name
+        return dict(
+            (country.id, country.endicia_country_name or country.name)
+            for country in countries
+        )
+
+    @classmethod
+    def search_endicia_name(cls, name, clause):
+        return ['OR',
+            ('endicia_country_name',) + tuple(clause[1:]),
+            [
+                ['OR',
+                    ('endicia_country_name', '=', None),
+                    ('endicia_country_name', '=', ''),
+                ],
+                ('name',) + tuple(clause[1:]),
+            ],
+        ]
+
+    @classmethod
+    def get_endicia_names(cls):
+        """
+        Returns a dictionary of country code and Endicia name of all the
+        countries, read once and kept until a country is changed.
+        """
+        language = Transaction().language
+        names = cls._endicia_names_cache.get(language)
+        if names is None:
+            names = cls._endicia_names_cache.set(language, dict(
+                (country.code, country.endicia_name)
+                for country in cls.search([])
+            ))
+        return names
+
+    @classmethod
+    def clear_endicia_cache(cls):
+        cls._endicia_names_cache.clear()
+
+    @classmethod
+    def create(cls, vlist):
+        countries = super(Country, cls).create(vlist)
+        cls.clear_endicia_cache()
+        return countries
+
+    @classmethod
+    def write(cls, *args):
+        super(Country, cls).write(*args)
+        cls.clear_endicia_cache()
+
+    @classmethod
+    def delete(cls, countries):
+        super(Country, cls).delete(countries)
+        cls.clear_endicia_cache()
@@ -0,0 +1,453 @@
+# -*- coding: utf-8 -*-
+"""
+    fake_server.py
+
+    Local stand-in for the Endicia Label Server and ELS services, for
+    offline development, tests and load tests.
+
+    Run it with::
+
+        python -m trytond.modules.endicia_integration.fake_server \\
+            --port 8089 --latency 0.2 --error-rate 0.01
+
+    and send the requests to it with the trytond configuration::
+
+        [endicia]
+        url = http://localhost:8089
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import time
+import base64
+import random
+import struct
+import zlib
+import threading
+import itertools
+import urlparse
+from decimal import Decimal
+from datetime import datetime
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+from lxml import etree
+from lxml.builder import ElementMaker
+
+__all__ = ['EndiciaServer']
+
+NAMESPACE = 'www.envmgr.com/LabelService'
+
+E = ElementMaker(namespace=NAMESPACE, nsmap={None: NAMESPACE})
+ELS = ElementMaker()
+
+LABEL_SERVICE = '/LabelService/EwsLabelService.asmx/'
+ELS_SERVICE = '/ELS/ELSServices.cfc'
+
+# Postage of each mail class: (base price, price per ounce)
+DOMESTIC_RATES = {
+    'First': (Decimal('2.32'), Decimal('0.17')),
+    'Priority': (Decimal('5.05'), Decimal('0.31')),
+    'Express': (Decimal('19.99'), Decimal('0.64')),
+    'ParcelSelect': (Decimal('5.37'), Decimal('0.22')),
+    'MediaMail': (Decimal('2.72'), Decimal('0.03')),
+    'LibraryMail': (Decimal('2.58'), Decimal('0.03')),
+    'StandardMail': (Decimal('1.94'), Decimal('0.09')),
+}
+INTERNATIONAL_RATES = {
+    'FirstClassMailInternational': (Decimal('1.15'), Decimal('0.42')),
+    'FirstClassPackageInternationalService': (
+        Decimal('9.15'), Decimal('0.55')
+    ),
+    'PriorityMailInternational': (Decimal('32.95'), Decimal('1.05')),
+    'ExpressMailInternational': (Decimal('44.95'), Decimal('1.30')),
+}
+
+# Status and message of the simulated errors
+ERROR_STATUS = '12503'
+ERROR_MESSAGE = 'Service temporarily unavailable (simulated error).'
+
+
+def make_png(width=1218, height=812):
+    """
+    Returns a blank greyscale PNG image
+    """
+    def chunk(chunk_type, data):
+        return struct.pack('>I', len(data)) + chunk_type + data + \
+            struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff)
+
+    row = '\x00' + '\xff' * width
+    return '\x89PNG\r\n\x1a\n' + \
+        chunk('IHDR', struct.pack(
+            '>IIBBBBB', width, height, 8, 0, 0, 0, 0
+        )) + \
+        chunk('IDAT', zlib.compress(row * height)) + \
+        chunk('IEND', '')
+
+
+class EndiciaServer(ThreadingMixIn, HTTPServer):
+    """
+    HTTP server answering the Endicia requests.
+
+    Labels and postage are computed from the request, postage balances
+    are kept per account and requests can be delayed or fail on purpose.
+
+    :param address: Tuple of host and port, port 0 picks a free port
+    :param latency: Seconds each response is delayed
+    :param jitter: Maximum seconds randomly added to the latency
+    :param error_rate: Probability of a request failing
+    :param seed: Seed of the random latency and errors
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(
+        self, address=('127.0.0.1', 0), latency=0, jitter=0,
+        error_rate=0, seed=None
+    ):
+        HTTPServer.__init__(self, address, RequestHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.balances = {}
+        self.numbers = itertools.count(1)
+        # Operations requested, in order
+        self.operations = []
+        # PIC numbers whose refund is rejected
+        self.rejected_refunds = set()
+        self.label_image = base64.b64encode(make_png())
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address
+        return 'http://%s:%s' % (host, port)
+
+    def start(self):
+        """
+        Serve the requests from a thread
+        """
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def delay(self):
+        delay = self.latency
+        if self.jitter:
+            with self.lock:
+                delay += self.random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+
+    def fails(self):
+        if not self.error_rate:
+            return False
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    def next_number(self):
+        with self.lock:
+            return next(self.numbers)
+
+    def update_balance(self, account_id, amount):
+        """
+        Add the amount to the postage balance of the account
+
+        :return: Tuple of the new balance and the total ever added
+        """
+        with self.lock:
+            balance, ascending = self.balances.get(
+                account_id, (Decimal('1000.00'), Decimal('1000.00'))
+            )
+            balance += amount
+            if amount > 0:
+                ascending += amount
+            self.balances[account_id] = balance, ascending
+        return balance, ascending
+
+    def get_postage(self, mailclass, weight_oz, from_zip, to_zip):
+        """
+        Returns the postage and the zone of a mail piece
+        """
+        if mailclass in INTERNATIONAL_RATES:
+            base, per_oz = INTERNATIONAL_RATES[mailclass]
+            zone = 0
+        else:
+            base, per_oz = DOMESTIC_RATES.get(
+                mailclass, DOMESTIC_RATES['Priority']
+            )
+            try:
+                zone = 1 + abs(int(from_zip[:3]) - int(to_zip[:3])) % 8
+            except (TypeError, ValueError):
+                zone = 8
+        postage = base + per_oz * weight_oz * (1 + Decimal(zone) / 10)
+        return postage.quantize(Decimal('.01')), zone
+
+    def postage_price(self, mailclass, request):
+        weight_oz = Decimal(request.findtext('WeightOz') or '1')
+        postage, zone = self.get_postage(
+            mailclass, weight_oz,
+            request.findtext('FromPostalCode') or '',
+            request.findtext('ToPostalCode') or '',
+        )
+        return postage, E.PostagePrice(
+            E.Postage(
+                E.MailService(mailclass),
+                E.Zone(str(zone)),
+                E.IntraBMC('false'),
+                E.Pricing('CommercialBase'),
+                TotalAmount=str(postage)
+            ),
+            E.Fees(TotalAmount='0'),
+            TotalAmount=str(postage)
+        )
+
+    def error_response(self, tag):
+        return getattr(E, tag)(
+            E.Status(ERROR_STATUS),
+            E.ErrorMessage(ERROR_MESSAGE),
+        )
+
+    def label(self, request):
+        """
+        Answer a LabelRequest
+        """
+        if self.fails():
+            return self.error_response('LabelRequestResponse')
+
+        mailclass = request.findtext('MailClass')
+        postage, postage_price = self.postage_price(mailclass, request)
+        account_id = request.findtext('AccountID')
+        balance, _ = self.update_balance(account_id, -postage)
+        number = self.next_number()
+        tracking_number = '94001118992%011d' % number
+
+        image_format = request.get('ImageFormat', 'PNG')
+        if image_format in ('ZPLII', 'EPL2'):
+            image = base64.b64encode(
+                '^XA^FO50,50^BCN,100^FD%s^FS^XZ\n' % tracking_number
+            )
+        else:
+            image = self.label_image
+
+        if request.get('LabelType') == 'International':
+            # International labels come with their customs forms
+            images = E.Label(
+                E.Image(image, PartNumber='1'),
+                E.Image(image, PartNumber='2'),
+            )
+        else:
+            images = E.Base64LabelImage(image)
+
+        now = datetime.utcnow()
+        return E.LabelRequestResponse(
+            E.Status('0'),
+            images,
+            E.TrackingNumber(tracking_number),
+            E.PIC(tracking_number),
+            E.FinalPostage(str(postage)),
+            E.TransactionID(str(number)),
+            E.TransactionDateTime(now.strftime('%Y%m%d%H%M%S')),
+            E.PostmarkDate(now.strftime('%Y%m%d')),
+            E.PostageBalance(str(balance)),
+            postage_price,
+        )
+
+    def calculate_postage(self, request):
+        """
+        Answer a PostageRateRequest
+        """
+        if self.fails():
+            return self.error_response('PostageRateResponse')
+        postage, postage_price = self.postage_price(
+            request.findtext('MailClass'), request
+        )
+        return E.PostageRateResponse(
+            E.Status('0'),
+            E.Zone(postage_price.findtext('{%s}Postage/{%s}Zone' % (
+                NAMESPACE, NAMESPACE
+            ))),
+            postage_price,
+        )
+
+    def postage_rates(self, request):
+        """
+        Answer a PostageRatesRequest for all the domestic or international
+        mail classes.
+        """
+        if self.fails():
+            return self.error_response('PostageRatesResponse')
+        if request.findtext('MailClass') == 'International':
+            mailclasses = INTERNATIONAL_RATES
+        else:
+            mailclasses = DOMESTIC_RATES
+        response = E.PostageRatesResponse(E.Status('0'))
+        for mailclass in sorted(mailclasses):
+            _, postage_price = self.postage_price(mailclass, request)
+            postage_price.insert(0, E.MailClass(mailclass))
+            response.append(postage_price)
+        return response
+
+    def buy_postage(self, request):
+        """
+        Answer a RecreditRequest
+        """
+        if self.fails():
+            return self.error_response('RecreditRequestResponse')
+        account_id = request.findtext('CertifiedIntermediary/AccountID')
+        balance, ascending = self.update_balance(
+            account_id, Decimal(request.findtext('RecreditAmount'))
+        )
+        return E.RecreditRequestResponse(
+            E.Status('0'),
+            E.RequesterID(request.findtext('RequesterID') or ''),
+            E.RequestID(request.findtext('RequestID') or ''),
+            E.CertifiedIntermediary(
+                E.AccountID(account_id),
+                E.SerialNumber(str(self.next_number())),
+                E.PostageBalance(str(balance)),
+                E.AscendingBalance(str(ascending)),
+                E.AccountStatus('A'),
+                E.DeviceID('0A0A0A0A'),
+            ),
+        )
+
+    def refund(self, request):
+        """
+        Answer a RefundRequest of the ELS service
+        """
+        refund_list = ELS.RefundList()
+        for pic_number in request.findall('RefundList/PICNumber'):
+            pic = ELS.PICNumber(pic_number.text or '')
+            if pic_number.text in self.rejected_refunds or self.fails():
+                pic.append(ELS.IsApproved('NO'))
+                pic.append(ELS.ErrorMsg(ERROR_MESSAGE))
+            else:
+                pic.append(ELS.IsApproved('YES'))
+                pic.append(ELS.ErrorMsg('Approved - less than 10 days'))
+            refund_list.append(pic)
+        return ELS.RefundResponse(
+            ELS.AccountID(request.findtext('AccountID') or ''),
+            refund_list,
+        )
+
+    def scan(self, request):
+        """
+        Answer a SCANRequest of the ELS service
+        """
+        if self.fails():
+            return ELS.SCANResponse(ELS.ErrorMsg(ERROR_MESSAGE))
+        return ELS.SCANResponse(
+            ELS.SubmissionID(str(self.next_number())),
+            ELS.SCANForm(self.label_image),
+        )
+
+    def handle(self, path, values):
+        """
+        Returns the response to the values posted to the path, None if
+        the path is unknown.
+        """
+        path = urlparse.urlsplit(path).path
+        if path.startswith(LABEL_SERVICE):
+            method = path[len(LABEL_SERVICE):]
+            operation, parameter = {
+                'GetPostageLabelXML': ('label', 'labelRequestXML'),
+                'CalculatePostageRateXML': (
+                    'calculate_postage', 'postageRateRequestXML'
+                ),
+                'CalculatePostageRatesXML': (
+                    'postage_rates', 'postageRatesRequestXML'
+                ),
+                'BuyPostageXML': ('buy_postage', 'recreditRequestXML'),
+            }.get(method, (None, None))
+        elif path == ELS_SERVICE:
+            operation = {
+                'RefundRequest': 'refund',
+                'SCANRequest': 'scan',
+            }.get(values.get('method'))
+            parameter = 'XMLInput'
+        else:
+            operation = None
+        if not operation or parameter not in values:
+            return None
+
+        request = etree.fromstring(values[parameter])
+        with self.lock:
+            self.operations.append(operation)
+        self.delay()
+        response = getattr(self, operation)(request)
+        return etree.tostring(
+            response, xml_declaration=True, encoding='utf-8'
+        )
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """
+    Handle the requests posted to the EndiciaServer
+    """
+
+    def do_POST(self):
+        length = int(self.headers.getheader('content-length') or 0)
+        values = dict(
+            (key, value[0]) for key, value in
+            urlparse.parse_qs(self.rfile.read(length)).iteritems()
+        )
+        try:
+            response = self.server.handle(self.path, values)
+        except etree.XMLSyntaxError:
+            self.send_error(400, 'Invalid XML')
+            return
+        if response is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Endicia stand-in server')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument(
+        '--latency', type=float, default=0,
+        help='seconds each response is delayed'
+    )
+    parser.add_argument(
+        '--jitter', type=float, default=0,
+        help='maximum seconds randomly added to the latency'
+    )
+    parser.add_argument(
+        '--error-rate', type=float, default=0,
+        help='probability of a request failing, between 0 and 1'
+    )
+    parser.add_argument('--seed', type=int, help='seed of the random values')
+    options = parser.parse_args()
+
+    server = EndiciaServer(
+        (options.host, options.port), latency=options.latency,
+        jitter=options.jitter, error_rate=options.error_rate,
+        seed=options.seed
+    )
+    print 'Endicia stand-in listening on %s' % server.url
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+    index.py
+
+    Indexes of the Endicia lookups which select=True can not express,
+    like partial indexes on the rows the scheduled jobs scan.
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+from sql import Table
+
+from trytond import backend
+from trytond.transaction import Transaction
+
+__all__ = ['index_exist', 'create_index']
+
+# Backends using partial indexes for the queries of the module. SQLite
+# only uses a partial index when its condition is written as literals in
+# the query, and the queries are sent with parameters.
+PARTIAL_INDEX_BACKENDS = ('postgresql',)
+
+
+def index_exist(name):
+    """
+    Returns True if the database has an index of the name
+    """
+    cursor = Transaction().cursor
+    if backend.name() == 'postgresql':
+        catalog = Table('pg_indexes')
+        query = catalog.select(
+            catalog.indexname, where=catalog.indexname == name
+        )
+    elif backend.name() == 'sqlite':
+        catalog = Table('sqlite_master')
+        query = catalog.select(
+            catalog.name,
+            where=(catalog.type == 'index') & (catalog.name == name)
+        )
+    else:
+        catalog = Table('STATISTICS', 'INFORMATION_SCHEMA')
+        query = catalog.select(
+            catalog.INDEX_NAME, where=catalog.INDEX_NAME == name
+        )
+    cursor.execute(*query)
+    return bool(cursor.fetchone())
+
+
+def create_index(name, table, columns, where=None):
+    """
+    Create an index unless it exists.
+
+    :param name: Name of the index
+    :param table: Name of the table
+    :param columns: List of the indexed columns
+    :param where: SQL condition of the rows indexed, the index being
+                  created on all the rows by the other backends, so the
+                  columns of the condition are indexed too
+    """
+    if index_exist(name):
+        return
+    query = 'CREATE INDEX "%s" ON "%s" (%s)' % (
+        name, table, ', '.join('"%s"' % column for column in columns)
+    )
+    if where and backend.name() in PARTIAL_INDEX_BACKENDS:
+        query += ' WHERE ' + where
+    Transaction().cursor.execute(query)
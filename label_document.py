@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""
+    label_document.py
+
+    Merge label images into a single print document.
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import struct
+
+__all__ = ['RawLabelWriter', 'PDFLabelWriter', 'LabelDocumentError']
+
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+
+# Number of colour components for each supported PNG colour type
+PNG_COLORS = {
+    0: 1,   # Greyscale
+    2: 3,   # RGB
+    3: 1,   # Palette
+}
+
+# Resolution assumed when the PNG does not carry one, that of thermal
+# label printers.
+DEFAULT_DPI = 203
+
+BUFFER_SIZE = 64 * 1024
+
+
+class LabelDocumentError(Exception):
+    """
+    Raised when a label image cannot be merged into the document
+    """
+    pass
+
+
+class RawLabelWriter(object):
+    """
+    Concatenate raw printer labels (ZPL II, EPL2). A printer processes
+    the labels one after the other, so the concatenation prints as a
+    single job.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.count = 0
+
+    def add_label(self, label):
+        """
+        :param label: File like object with the label
+        """
+        data = None
+        while True:
+            chunk = label.read(BUFFER_SIZE)
+            if not chunk:
+                break
+            data = chunk
+            self.fileobj.write(chunk)
+        if data and not data.endswith('\n'):
+            self.fileobj.write('\n')
+        self.count += 1
+
+    def close(self):
+        pass
+
+
+class PDFLabelWriter(object):
+    """
+    Write PNG labels as the pages of a PDF document.
+
+    The compressed image data of the PNG is copied to the PDF stream as
+    is, chunk by chunk, so memory does not grow with the number or the
+    size of labels. Only the offsets of the PDF objects are kept.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.offset = 0
+        self.offsets = {}
+        self.pages = []
+        self.next_id = 3    # 1 is the catalog and 2 the page tree
+        self._write('%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+        self._write_object(1, '<< /Type /Catalog /Pages 2 0 R >>')
+
+    @property
+    def count(self):
+        return len(self.pages)
+
+    def _write(self, data):
+        self.fileobj.write(data)
+        self.offset += len(data)
+
+    def _new_id(self):
+        obj_id = self.next_id
+        self.next_id += 1
+        return obj_id
+
+    def _begin_object(self, obj_id):
+        self.offsets[obj_id] = self.offset
+        self._write('%d 0 obj\n' % obj_id)
+
+    def _end_object(self):
+        self._write('\nendobj\n')
+
+    def _write_object(self, obj_id, data):
+        self._begin_object(obj_id)
+        self._write(data)
+        self._end_object()
+
+    def _read_chunk_header(self, label):
+        header = label.read(8)
+        if len(header) < 8:
+            raise LabelDocumentError('Truncated PNG image')
+        return struct.unpack('>I4s', header)
+
+    def add_label(self, label):
+        """
+        :param label: File like object with the PNG label
+        """
+        width, height, bit_depth, color_type = self._read_header(label)
+        image = {
+            'id': self._new_id(),
+            'length_id': self._new_id(),
+            'width': width,
+            'height': height,
+            'bit_depth': bit_depth,
+            'color_type': color_type,
+            'palette': None,
+            'dpi': (DEFAULT_DPI, DEFAULT_DPI),
+            'length': None,
+        }
+        while True:
+            length, chunk_type = self._read_chunk_header(label)
+            if chunk_type == 'IEND':
+                break
+            self._read_chunk(label, length, chunk_type, image)
+            label.read(4)   # CRC
+
+        if image['length'] is None:
+            raise LabelDocumentError('PNG image has no image data')
+        self._write('\nendstream')
+        self._end_object()
+        self._write_object(image['length_id'], '%d' % image['length'])
+        self._add_page(image['id'], width, height, image['dpi'])
+
+    def _read_header(self, label):
+        """
+        Returns the width, height, bit depth and colour type of the PNG
+        """
+        if label.read(8) != PNG_SIGNATURE:
+            raise LabelDocumentError('Label is not a PNG image')
+
+        length, chunk_type = self._read_chunk_header(label)
+        if chunk_type != 'IHDR':
+            raise LabelDocumentError('Invalid PNG image')
+        width, height, bit_depth, color_type, _, _, interlace = \
+            struct.unpack('>IIBBBBB', label.read(length))
+        label.read(4)   # CRC
+        if color_type not in PNG_COLORS or interlace:
+            raise LabelDocumentError(
+                'Only non interlaced PNG images without transparency '
+                'can be merged'
+            )
+        return width, height, bit_depth, color_type
+
+    def _read_chunk(self, label, length, chunk_type, image):
+        """
+        Read the data of a chunk of the PNG into the image
+        """
+        if chunk_type == 'IDAT':
+            if image['length'] is None:
+                image['length'] = 0
+                self._begin_image(
+                    image['id'], image['length_id'], image['width'],
+                    image['height'], image['bit_depth'],
+                    image['color_type'], image['palette']
+                )
+            self._copy_data(label, length)
+            image['length'] += length
+        elif chunk_type == 'PLTE':
+            image['palette'] = label.read(length)
+        elif chunk_type == 'pHYs':
+            x, y, unit = struct.unpack('>IIB', label.read(length))
+            if unit == 1 and x and y:
+                # Pixels per metre
+                image['dpi'] = (x * 0.0254, y * 0.0254)
+        else:
+            label.read(length)
+
+    def _copy_data(self, label, length):
+        """
+        Copy the compressed image data of a chunk to the image stream
+        """
+        while length:
+            data = label.read(min(length, BUFFER_SIZE))
+            if not data:
+                raise LabelDocumentError('Truncated PNG image')
+            self._write(data)
+            length -= len(data)
+
+    def _begin_image(
+        self, image_id, length_id, width, height, bit_depth, color_type,
+        palette
+    ):
+        if color_type == 3:
+            if palette is None:
+                raise LabelDocumentError('PNG image has no palette')
+            color_space = '[/Indexed /DeviceRGB %d <%s>]' % (
+                len(palette) // 3 - 1, palette.encode('hex')
+            )
+        elif color_type == 2:
+            color_space = '/DeviceRGB'
+        else:
+            color_space = '/DeviceGray'
+
+        self._begin_object(image_id)
+        self._write(
+            '<< /Type /XObject /Subtype /Image /Width %d /Height %d '
+            '/ColorSpace %s /BitsPerComponent %d /Filter /FlateDecode '
+            '/DecodeParms << /Predictor 15 /Colors %d '
+            '/BitsPerComponent %d /Columns %d >> /Length %d 0 R >>\n'
+            'stream\n' % (
+                width, height, color_space, bit_depth,
+                PNG_COLORS[color_type], bit_depth, width, length_id
+            )
+        )
+
+    def _add_page(self, image_id, width, height, dpi):
+        # Page size in points, so the label prints at its real size
+        page_width = width * 72.0 / dpi[0]
+        page_height = height * 72.0 / dpi[1]
+
+        content = 'q %.2f 0 0 %.2f 0 0 cm /Im0 Do Q' % (
+            page_width, page_height
+        )
+        content_id = self._new_id()
+        self._write_object(
+            content_id,
+            '<< /Length %d >>\nstream\n%s\nendstream' % (
+                len(content), content
+            )
+        )
+
+        page_id = self._new_id()
+        self._write_object(
+            page_id,
+            '<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %.2f %.2f] '
+            '/Resources << /XObject << /Im0 %d 0 R >> >> '
+            '/Contents %d 0 R >>' % (
+                page_width, page_height, image_id, content_id
+            )
+        )
+        self.pages.append(page_id)
+
+    def close(self):
+        """
+        Write the page tree and the cross reference table
+        """
+        self._write_object(
+            2, '<< /Type /Pages /Kids [%s] /Count %d >>' % (
+                ' '.join('%d 0 R' % page for page in self.pages),
+                len(self.pages)
+            )
+        )
+
+        xref_offset = self.offset
+        self._write('xref\n0 %d\n' % self.next_id)
+        self._write('0000000000 65535 f \n')
+        for obj_id in xrange(1, self.next_id):
+            self._write('%010d 00000 n \n' % self.offsets[obj_id])
+        self._write(
+            'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n'
+            % (self.next_id, xref_offset)
+        )
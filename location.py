@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+    location.py
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.pool import PoolMeta
+from trytond.pyson import Eval
+
+__all__ = ['EndiciaLabelProfile', 'Location']
+__metaclass__ = PoolMeta
+
+IMAGE_FORMATS = [
+    ('PNG', 'PNG'),
+    ('GIF', 'GIF'),
+    ('JPEG', 'JPEG'),
+    ('PDF', 'PDF'),
+    ('ZPLII', 'ZPL II'),
+    ('EPL2', 'EPL2'),
+]
+
+# File extension of the label image for each image format
+IMAGE_EXTENSIONS = {
+    'PNG': 'png',
+    'GIF': 'gif',
+    'JPEG': 'jpg',
+    'PDF': 'pdf',
+    'ZPLII': 'zpl',
+    'EPL2': 'epl',
+}
+
+
+class EndiciaLabelProfile(ModelSQL, ModelView):
+    "Endicia Label Profile"
+    __name__ = 'endicia.label.profile'
+
+    name = fields.Char('Name', required=True, select=True)
+    image_format = fields.Selection(
+        IMAGE_FORMATS, 'Image Format', required=True,
+        help='ZPL II and EPL2 labels are sent to thermal printers as is. '
+        'Only PNG, ZPL II and EPL2 labels can be merged in one print '
+        'document.'
+    )
+    label_size = fields.Selection([
+        ('4x6', '4x6'),
+        ('6x4', '6x4'),
+        ('4x5', '4x5'),
+        ('4x4.5', '4x4.5'),
+        ('4x8', '4x8'),
+        ('DocTab', 'DocTab'),
+    ], 'Label Size', required=True)
+    image_resolution = fields.Selection([
+        ('150', '150 DPI'),
+        ('203', '203 DPI'),
+        ('300', '300 DPI'),
+    ], 'Image Resolution', required=True)
+    image_rotation = fields.Selection([
+        ('None', 'None'),
+        ('Rotate90', 'Rotate 90'),
+        ('Rotate180', 'Rotate 180'),
+        ('Rotate270', 'Rotate 270'),
+    ], 'Image Rotation', required=True)
+
+    @staticmethod
+    def default_image_format():
+        return 'PNG'
+
+    @staticmethod
+    def default_label_size():
+        return '6x4'
+
+    @staticmethod
+    def default_image_resolution():
+        return '203'
+
+    @staticmethod
+    def default_image_rotation():
+        return 'Rotate270'
+
+    def get_label_request_options(self):
+        """
+        Returns the image options to be sent with the LabelRequest
+        """
+        return {
+            'ImageFormat': self.image_format,
+            'LabelSize': self.label_size,
+            'ImageResolution': self.image_resolution,
+            'ImageRotation': self.image_rotation,
+        }
+
+
+class Location:
+    __name__ = 'stock.location'
+
+    endicia_label_profile = fields.Many2One(
+        'endicia.label.profile', 'Endicia Label Profile', states={
+            'invisible': Eval('type') != 'warehouse',
+        }, depends=['type'],
+        help='Label profile used for the shipments from this warehouse.'
+    )
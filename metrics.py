@@ -0,0 +1,388 @@
+# -*- coding: utf-8 -*-
+"""
+    metrics.py
+
+    Latency and outcome metrics of the requests sent to Endicia.
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import time
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from endicia.exceptions import RequestError
+
+from trytond.transaction import Transaction
+
+from . import transport
+
+__all__ = ['registry', 'measure', 'send_request', 'start_profile']
+
+logger = logging.getLogger(__name__)
+
+# Names of the Endicia APIs measured
+APIS = [
+    'label', 'calculate_postage', 'postage_rates', 'refund', 'scan',
+    'buy_postage',
+]
+
+# Upper bounds of the latency buckets, in seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Upper bounds of the response size buckets, in bytes
+SIZE_BUCKETS = (1024, 10 * 1024, 100 * 1024, 1024 * 1024, 10 * 1024 * 1024)
+
+
+class Histogram(object):
+    """
+    Count of observations in cumulative buckets, as Prometheus does
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            index = len(self.buckets)
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self):
+        """
+        Returns a list of (upper bound, count) including +Inf
+        """
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def quantile(self, q):
+        """
+        Estimate the quantile by linear interpolation inside the bucket
+        where it falls, as histogram_quantile of Prometheus does.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        lower, previous = 0, 0
+        for bound, total in self.cumulative_counts():
+            if total >= rank:
+                if bound == float('inf'):
+                    return lower
+                in_bucket = total - previous
+                return lower + (bound - lower) * (rank - previous) / in_bucket
+            lower, previous = bound, total
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+            'buckets': [
+                (bound, total) for bound, total in self.cumulative_counts()
+                if bound != float('inf')
+            ],
+        }
+
+
+class APIMetrics(object):
+    """
+    Metrics of one Endicia API
+    """
+
+    def __init__(self):
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.size = Histogram(SIZE_BUCKETS)
+        # Number of requests per Endicia status code, or per exception
+        # name when no response could be read.
+        self.requests = {}
+        self.cache = {'hit': 0, 'miss': 0}
+        # Latency of the phases of the calls, when profiled
+        self.phases = {}
+
+
+class MetricsRegistry(object):
+    """
+    Metrics of the Endicia APIs in this process.
+
+    Each process of the server has its own registry, so the exports of
+    all the processes must be collected.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.apis = dict((name, APIMetrics()) for name in APIS)
+
+    def _get(self, name):
+        if name not in self.apis:
+            self.apis[name] = APIMetrics()
+        return self.apis[name]
+
+    def observe(self, name, duration, size, code):
+        """
+        Record a request sent to Endicia
+
+        :param name: Name of the API
+        :param duration: Time taken, in seconds
+        :param size: Size of the response in bytes, None if unknown
+        :param code: Endicia status code of the response as string
+        """
+        with self.lock:
+            metrics = self._get(name)
+            metrics.latency.observe(duration)
+            if size is not None:
+                metrics.size.observe(size)
+            metrics.requests[code] = metrics.requests.get(code, 0) + 1
+
+    def observe_phases(self, name, timings):
+        """
+        Record the time taken by the phases of a profiled call
+
+        :param name: Name of the API
+        :param timings: Dictionary of phase name and time in seconds
+        """
+        with self.lock:
+            phases = self._get(name).phases
+            for phase, duration in timings.iteritems():
+                if phase not in phases:
+                    phases[phase] = Histogram(LATENCY_BUCKETS)
+                phases[phase].observe(duration)
+
+    def record_cache(self, name, hit):
+        """
+        Record whether a result was found in a cache instead of being
+        requested from Endicia.
+        """
+        with self.lock:
+            self._get(name).cache['hit' if hit else 'miss'] += 1
+
+    def to_dict(self):
+        with self.lock:
+            return dict((name, {
+                'latency': metrics.latency.to_dict(),
+                'size': metrics.size.to_dict(),
+                'requests': metrics.requests.copy(),
+                'cache': metrics.cache.copy(),
+                'phases': dict(
+                    (phase, histogram.to_dict())
+                    for phase, histogram in metrics.phases.iteritems()
+                ),
+            }) for name, metrics in self.apis.iteritems())
+
+    def to_prometheus(self):
+        """
+        Returns the metrics in the Prometheus text exposition format
+        """
+        lines = []
+
+        def histogram(metric, help, histograms):
+            lines.append('# HELP %s %s' % (metric, help))
+            lines.append('# TYPE %s histogram' % metric)
+            for labels, values in histograms:
+                for bound, total in values.cumulative_counts():
+                    lines.append('%s_bucket{%s,le="%s"} %d' % (
+                        metric, labels,
+                        '+Inf' if bound == float('inf') else repr(bound),
+                        total
+                    ))
+                lines.append('%s_sum{%s} %r' % (metric, labels, values.sum))
+                lines.append('%s_count{%s} %d' % (
+                    metric, labels, values.count
+                ))
+
+        with self.lock:
+            apis = sorted(self.apis.iteritems())
+            histogram(
+                'endicia_request_duration_seconds',
+                'Time taken by the requests to Endicia.', [
+                    ('api="%s"' % name, metrics.latency)
+                    for name, metrics in apis
+                ]
+            )
+            histogram(
+                'endicia_response_size_bytes',
+                'Size of the responses of Endicia.', [
+                    ('api="%s"' % name, metrics.size)
+                    for name, metrics in apis
+                ]
+            )
+            histogram(
+                'endicia_phase_duration_seconds',
+                'Time taken by the phases of profiled Endicia calls.', [
+                    ('api="%s",phase="%s"' % (name, phase), values)
+                    for name, metrics in apis
+                    for phase, values in sorted(metrics.phases.iteritems())
+                ]
+            )
+
+            lines.append(
+                '# HELP endicia_requests_total Requests sent to Endicia.'
+            )
+            lines.append('# TYPE endicia_requests_total counter')
+            for name, metrics in apis:
+                for code, count in sorted(metrics.requests.iteritems()):
+                    lines.append(
+                        'endicia_requests_total{api="%s",code="%s"} %d'
+                        % (name, code, count)
+                    )
+
+            lines.append(
+                '# HELP endicia_cache_total Lookups in the Endicia caches.'
+            )
+            lines.append('# TYPE endicia_cache_total counter')
+            for name, metrics in apis:
+                for result, count in sorted(metrics.cache.iteritems()):
+                    lines.append(
+                        'endicia_cache_total{api="%s",result="%s"} %d'
+                        % (name, result, count)
+                    )
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+
+class Call(object):
+    """
+    Request being measured
+    """
+
+    def __init__(self):
+        self.size = None
+
+
+@contextmanager
+def measure(name, api):
+    """
+    Record the time taken by the request of the API sent in the block and
+    its outcome. The size of the response is recorded if set on the call
+    given by the context manager.
+    """
+    call = Call()
+    start = time.time()
+    try:
+        yield call
+    except RequestError:
+        registry.observe(
+            name, time.time() - start, call.size,
+            str(api.flags.get('Status'))
+        )
+        raise
+    except Exception, error:
+        registry.observe(
+            name, time.time() - start, call.size, error.__class__.__name__
+        )
+        raise
+    else:
+        registry.observe(name, time.time() - start, call.size, '0')
+
+
+def send_request(name, api):
+    """
+    Send the request of the API and record its metrics
+
+    :param name: Name of the API in the metrics
+    :return: The response of Endicia
+    """
+    with measure(name, api) as call:
+        response = transport.send_request(api)
+        call.size = len(response)
+    return response
+
+
+class Profile(object):
+    """
+    Time taken by the phases of a call, such as building the request,
+    waiting for Endicia or parsing the response.
+    """
+
+    def __init__(self, name, record):
+        self.name = name
+        self.record = record
+        self.timings = OrderedDict()
+        self.last = time.time()
+
+    def mark(self, phase):
+        """
+        End a phase, which took the time since the end of the previous
+        phase.
+        """
+        now = time.time()
+        self.add(phase, now - self.last)
+        self.last = now
+
+    def add(self, phase, duration):
+        """
+        Add time to a phase, for phases timed in several parts
+        """
+        self.timings[phase] = self.timings.get(phase, 0) + duration
+
+    def restart(self):
+        """
+        Start the next phase now, the time since the end of the previous
+        phase having been added to the phases.
+        """
+        self.last = time.time()
+
+    def close(self):
+        """
+        Report the timings of the call and add them to the registry
+        """
+        logger.info(
+            'Endicia %s call for %s: %s', self.name, self.record,
+            ', '.join(
+                '%s %.3fs' % (phase, duration)
+                for phase, duration in self.timings.iteritems()
+            )
+        )
+        registry.observe_phases(self.name, self.timings)
+
+
+class NullProfile(object):
+    """
+    Profile of the calls which are not profiled, doing nothing
+    """
+
+    def mark(self, phase):
+        pass
+
+    def add(self, phase, duration):
+        pass
+
+    def restart(self):
+        pass
+
+    def close(self):
+        pass
+
+NULL_PROFILE = NullProfile()
+
+
+def start_profile(name, record):
+    """
+    Returns the profile of a call, when the `endicia_profile` key of
+    the context is set. Otherwise the profile does nothing.
+
+    :param name: Name of the API
+    :param record: Record for which the call is made
+    """
+    if Transaction().context.get('endicia_profile'):
+        return Profile(name, record)
+    return NULL_PROFILE
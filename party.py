@@ -7,8 +7,17 @@ Customizes party address to have address in correct format for Endicia API .
 
 import string
 
+from sql.aggregate import Count, Max
+from sql.conditionals import Coalesce
+
 from endicia import FromAddress, ToAddress
-from trytond.pool import PoolMeta
+from trytond.pool import Pool, PoolMeta
+from trytond.cache import Cache
+from trytond.transaction import Transaction
+from trytond.tools import reduce_ids, grouped_slice
+
+from .metrics import registry
+from .zip_database import get_zip_database
 
 __all__ = ['Address']
 __metaclass__ = PoolMeta
@@ -20,42 +29,175 @@ class Address:
     '''
     __name__ = "party.address"
 
-    def address_to_endicia_from_address(self):
+    # Values of the addresses normalized for Endicia, keyed by the version
+    # of each address, so a change of an address or of the records its
+    # values come from only misses the cache of that address. The key has
+    # the identity of the ZIP database which corrects the values too.
+    _endicia_values_cache = Cache(
+        'party_address.endicia_values', context=False
+    )
+
+    @classmethod
+    def get_endicia_versions(cls, ids):
         '''
-        Converts party address to Endicia From Address.
+        Returns the versions of the Endicia values of the addresses, read
+        in one query: the timestamps of the address, its party, the
+        contact mechanisms of the party, its subdivision and its country.
+        The number of contact mechanisms changes when one is deleted.
 
-        :param return: Returns instance of FromAddress
+        :param ids: List of address ids
+        :return: Dictionary of address id and version
+        '''
+        pool = Pool()
+        Party = pool.get('party.party')
+        ContactMechanism = pool.get('party.contact_mechanism')
+        Subdivision = pool.get('country.subdivision')
+        Country = pool.get('country.country')
+        address = cls.__table__()
+        party = Party.__table__()
+        mechanism = ContactMechanism.__table__()
+        subdivision = Subdivision.__table__()
+        country = Country.__table__()
+        cursor = Transaction().cursor
+
+        def timestamp(table):
+            return Coalesce(table.write_date, table.create_date)
+
+        columns = [
+            timestamp(address), timestamp(party), timestamp(subdivision),
+            timestamp(country),
+        ]
+        versions = {}
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*address.join(
+                party, condition=address.party == party.id
+            ).join(
+                mechanism, 'LEFT', condition=mechanism.party == party.id
+            ).join(
+                subdivision, 'LEFT',
+                condition=address.subdivision == subdivision.id
+            ).join(
+                country, 'LEFT', condition=address.country == country.id
+            ).select(
+                address.id, Max(timestamp(mechanism)), Count(mechanism.id),
+                *columns,
+                where=reduce_ids(address.id, sub_ids),
+                group_by=[address.id] + columns
+            ))
+            for row in cursor.fetchall():
+                versions[row[0]] = tuple(row[1:])
+        return versions
+
+    def _get_endicia_values(self):
+        '''
+        Returns the values of the address normalized for Endicia, from
+        which both the from and to addresses are built.
+
+        Downstream modules can override this to change the values sent.
         '''
+        Country = Pool().get('country.country')
+
         phone = self.party.phone
         if phone:
             # Remove the special characters in the phone if any
             phone = "".join([char for char in phone if char in string.digits])
+        values = {
+            'name': self.name or self.party.name,
+            'street': self.street,
+            'streetbis': self.streetbis,
+            'city': self.city,
+            'state': self.subdivision and self.subdivision.code[3:],
+            'zip': self.zip,
+            'phone': phone,
+            'email': self.party.email,
+            'country_name': self.country and Country.get_endicia_names().get(
+                self.country.code
+            ),
+            'country_code': self.country and self.country.code,
+        }
+
+        # Correct the city and state of US addresses from the ZIP database
+        database = get_zip_database()
+        if database and values['country_code'] in (None, 'US'):
+            known = database.lookup(self.zip)
+            if known and known[2]:
+                city, state, _ = known
+                if (values['city'] or '').upper() != city:
+                    values['city'] = city
+                values['state'] = state
+        return values
+
+    @classmethod
+    def get_endicia_values(cls, addresses):
+        '''
+        Returns the normalized values of many addresses. The addresses not
+        in the cache are browsed together, so their parties, contact
+        mechanisms, subdivisions and countries are read in one query each.
+
+        :param addresses: List of addresses
+        :return: Dictionary of address id and values
+        '''
+        language = Transaction().language
+        versions = cls.get_endicia_versions([a.id for a in addresses])
+        database = get_zip_database()
+        database = database and database.identity
+        result = {}
+        missing = []
+        for address in addresses:
+            key = (address.id, language, versions.get(address.id), database)
+            values = cls._endicia_values_cache.get(key)
+            registry.record_cache('address', values is not None)
+            if values is None:
+                missing.append(address.id)
+            else:
+                result[address.id] = values
+        for address in cls.browse(missing):
+            key = (address.id, language, versions.get(address.id), database)
+            result[address.id] = cls._endicia_values_cache.set(
+                key, address._get_endicia_values()
+            )
+        return result
+
+    def address_to_endicia_from_address(self, values=None):
+        '''
+        Converts party address to Endicia From Address.
+
+        :param values: Values of the address from get_endicia_values, read
+                       if None
+        :param return: Returns instance of FromAddress
+        '''
+        if values is None:
+            values = self.get_endicia_values([self])[self.id]
+        phone = values['phone']
+        zip = values['zip']
         return FromAddress(
-            FromName=self.name or self.party.name,
+            FromName=values['name'],
             # FromCompany = user_rec.company.name or None,
-            ReturnAddress1=self.street,
-            ReturnAddress2=self.streetbis,
+            ReturnAddress1=values['street'],
+            ReturnAddress2=values['streetbis'],
             ReturnAddress3=None,
             ReturnAddress4=None,
-            FromCity=self.city,
-            FromState=self.subdivision and self.subdivision.code[3:],
-            FromPostalCode=self.zip and self.zip[:5],
+            FromCity=values['city'],
+            FromState=values['state'],
+            FromPostalCode=zip and zip[:5],
             FromPhone=phone and phone[-10:],
-            FromEMail=self.party.email,
+            FromEMail=values['email'],
         )
 
-    def address_to_endicia_to_address(self):
+    def address_to_endicia_to_address(self, values=None):
         '''
         Converts party address to Endicia To Address.
 
+        :param values: Values of the address from get_endicia_values, read
+                       if None
         :param return: Returns instance of ToAddress
         '''
-        phone = self.party.phone
-        zip = self.zip
+        if values is None:
+            values = self.get_endicia_values([self])[self.id]
+        phone = values['phone']
+        zip = values['zip']
         if phone:
-            # Remove the special characters in the phone if any
-            phone = "".join([char for char in phone if char in string.digits])
-            if self.country and self.country.code != 'US':
+            if values['country_code'] and values['country_code'] != 'US':
                 # International
                 phone = phone[-30:]
                 zip = zip and zip[:15]
@@ -65,17 +207,17 @@ class Address:
                 zip = zip and zip[:5]
 
         return ToAddress(
-            ToName=self.name or self.party.name,
-            ToCompany=self.name or self.party.name,
-            ToAddress1=self.street,
-            ToAddress2=self.streetbis,
+            ToName=values['name'],
+            ToCompany=values['name'],
+            ToAddress1=values['street'],
+            ToAddress2=values['streetbis'],
             ToAddress3=None,
             ToAddress4=None,
-            ToCity=self.city,
-            ToState=self.subdivision and self.subdivision.code[3:],
+            ToCity=values['city'],
+            ToState=values['state'],
             ToPostalCode=zip,
-            ToCountry=self.country and self.country.endicia_name,
-            ToCountryCode=self.country and self.country.code,
+            ToCountry=values['country_name'],
+            ToCountryCode=values['country_code'],
             ToPhone=phone,
-            ToEMail=self.party.email,
+            ToEMail=values['email'],
         )
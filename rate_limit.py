@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+    rate_limit.py
+
+    Limit the rate of the requests sent to Endicia by all the processes of
+    a server, so they stay under the limits of Endicia when workers are
+    added.
+
+    The limits are token buckets shared through files. Each bucket is a
+    file holding its tokens and the time they were counted, locked while
+    a request takes a token. A request taking a token the bucket does not
+    have yet waits until the token is due, so the requests of all the
+    processes are spaced evenly instead of being sent in bursts.
+
+    The limits are set, in requests per second, in the `endicia` section
+    of the configuration file, for all the requests of an account and for
+    the requests of an API of an account::
+
+        [endicia]
+        rate_limit = 10
+        rate_limit_label = 5
+        rate_limit_postage_rates = 8
+        # Optional, the bucket files are in the temporary directory
+        rate_limit_directory = /var/run/trytond/endicia
+
+    The APIs are named as in the metrics: label, postage_rates,
+    calculate_postage, refund, scan and buy_postage. The `Requests per
+    Second` of an Endicia account replaces `rate_limit` for it.
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import time
+import fcntl
+import struct
+import logging
+import tempfile
+import threading
+
+from trytond.config import config
+
+__all__ = [
+    'TokenBucket', 'RateLimiter', 'get_rate_limiter', 'set_account_rate',
+    'api_name',
+]
+
+logger = logging.getLogger(__name__)
+
+# Tokens and the time they were counted
+BUCKET = struct.Struct('<dd')
+
+# Name of the APIs, as in the metrics
+API_NAMES = {
+    'ShippingLabelAPI': 'label',
+    'PostageRatesAPI': 'postage_rates',
+    'CalculatingPostageAPI': 'calculate_postage',
+    'RefundRequestAPI': 'refund',
+    'SCANFormAPI': 'scan',
+    'BuyingPostageAPI': 'buy_postage',
+}
+
+
+def api_name(api):
+    """
+    Returns the name of the API of the request
+    """
+    name = api.__class__.__name__
+    return API_NAMES.get(name, name.lower())
+
+
+class TokenBucket(object):
+    """
+    Token bucket shared by the processes through a file
+
+    :param path: Path of the bucket file
+    :param rate: Tokens added per second
+    :param burst: Tokens the bucket holds at most
+    """
+
+    def __init__(self, path, rate, burst=1):
+        self.path = path
+        self.rate = float(rate)
+        self.burst = float(burst)
+        # The file locks do not exclude the threads of a process
+        self.lock = threading.Lock()
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0660)
+
+    def reserve(self, now=None):
+        """
+        Take a token and returns the seconds to wait until it is due
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX)
+            try:
+                os.lseek(self.fd, 0, os.SEEK_SET)
+                data = os.read(self.fd, BUCKET.size)
+                if len(data) == BUCKET.size:
+                    tokens, counted = BUCKET.unpack(data)
+                else:
+                    tokens, counted = self.burst, now
+                tokens = min(
+                    self.burst, tokens + max(now - counted, 0) * self.rate
+                )
+                tokens -= 1
+                os.lseek(self.fd, 0, os.SEEK_SET)
+                os.write(self.fd, BUCKET.pack(tokens, now))
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN)
+        if tokens >= 0:
+            return 0
+        return -tokens / self.rate
+
+    def acquire(self):
+        """
+        Take a token, waiting until it is due
+
+        :return: Seconds waited
+        """
+        wait = self.reserve()
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def close(self):
+        os.close(self.fd)
+
+
+class RateLimiter(object):
+    """
+    Buckets of the accounts and of the APIs of the accounts
+
+    :param directory: Directory of the bucket files
+    :param rate: Requests per second of an account, None for no limit
+    :param api_rates: Dictionary of API name and requests per second of
+                      an account
+    """
+
+    def __init__(self, directory, rate=None, api_rates=None):
+        self.directory = directory
+        self.rate = rate
+        self.api_rates = api_rates or {}
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, name, rate):
+        with self.lock:
+            bucket = self.buckets.get(name)
+            if bucket is None or bucket.rate != rate:
+                if bucket is not None:
+                    bucket.close()
+                elif not os.path.isdir(self.directory):
+                    os.makedirs(self.directory, 0770)
+                bucket = self.buckets[name] = TokenBucket(
+                    os.path.join(self.directory, '%s.bucket' % name), rate
+                )
+            return bucket
+
+    def acquire(self, api):
+        """
+        Wait until the request of the API can be sent
+
+        :return: Seconds waited
+        """
+        account_id = str(api.accountid)
+        name = api_name(api)
+        waited = 0
+        rate = _account_rates.get(account_id) or self.rate
+        if rate:
+            waited += self.bucket(account_id, rate).acquire()
+        rate = self.api_rates.get(name)
+        if rate:
+            waited += self.bucket('%s-%s' % (account_id, name), rate).acquire()
+        if waited:
+            logger.debug(
+                'Request %s of account %s waited %.3fs', name, account_id,
+                waited
+            )
+        return waited
+
+
+_limiters = {}
+_account_rates = {}
+_lock = threading.Lock()
+
+
+def set_account_rate(account_id, rate):
+    """
+    Set the requests per second of the account, the rate of the
+    configuration if None
+    """
+    _account_rates[str(account_id)] = rate
+
+
+def get_rate_limiter():
+    """
+    Returns the rate limiter of the configured limits, created once per
+    process.
+    """
+    rate = config.getfloat('endicia', 'rate_limit')
+    api_rates = dict(
+        (name, config.getfloat('endicia', 'rate_limit_%s' % name))
+        for name in API_NAMES.itervalues()
+        if config.get('endicia', 'rate_limit_%s' % name)
+    )
+    directory = config.get('endicia', 'rate_limit_directory') or \
+        os.path.join(tempfile.gettempdir(), 'trytond-endicia-rate-limit')
+    key = (directory, rate, tuple(sorted(api_rates.iteritems())))
+    with _lock:
+        if key not in _limiters:
+            _limiters[key] = RateLimiter(directory, rate, api_rates)
+        return _limiters[key]
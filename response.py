@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+    response.py
+
+    Parse Endicia responses carrying images as a stream.
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import time
+
+from lxml import etree
+
+from endicia.exceptions import RequestError
+
+from .metrics import NULL_PROFILE
+from .transport import urlopen
+
+__all__ = ['StreamedResponse', 'stream_request']
+
+# Number of bytes of the response read and parsed at a time
+CHUNK_SIZE = 64 * 1024
+
+# Elements holding base64 images. Label responses have a single
+# Base64LabelImage or one Label/Image element for each part of the label.
+IMAGE_TAGS = ('Base64LabelImage', 'Image', 'SCANForm')
+
+
+def local_name(tag):
+    """
+    Returns the tag without its namespace
+    """
+    return tag.rsplit('}', 1)[-1]
+
+
+class StreamedResponse(object):
+    """
+    Parser target collecting the values of a response.
+
+    Image data is written to a store opened for each image as soon as
+    the parser reads it, so neither the response nor the images are held
+    in memory. The text of every other element directly below the root
+    is kept in `values`.
+
+    :param open_image: Callable returning a store for an image, with
+                       `write`, `close` and `abort` methods. The value
+                       returned by `close` is kept in `images`.
+    """
+
+    def __init__(self, open_image):
+        self.open_image = open_image
+        self.values = {}
+        self.images = []
+        self.path = []
+        self.text = []
+        self.image = None
+        self.part_number = None
+        # Number of bytes of the response
+        self.size = 0
+
+    @property
+    def status(self):
+        return self.values.get('Status')
+
+    @property
+    def error_message(self):
+        return self.values.get('ErrorMessage') or self.values.get('ErrorMsg')
+
+    def start(self, tag, attrib):
+        tag = local_name(tag)
+        self.path.append(tag)
+        if tag in IMAGE_TAGS:
+            self.image = self.open_image()
+            self.part_number = attrib.get('PartNumber', 1)
+        elif len(self.path) == 2:
+            self.text = []
+
+    def data(self, data):
+        if self.image is not None:
+            self.image.write(data)
+        elif len(self.path) == 2:
+            self.text.append(data)
+
+    def end(self, tag):
+        tag = self.path.pop()
+        if self.image is not None:
+            image, self.image = self.image, None
+            self.images.append((self.part_number, image.close()))
+        elif len(self.path) == 1:
+            self.values[tag] = ''.join(self.text).strip()
+
+    def close(self):
+        return self
+
+    def abort(self):
+        """
+        Discard the image being written
+        """
+        if self.image is not None:
+            self.image.abort()
+            self.image = None
+
+
+def stream_request(api, values, target, profile=NULL_PROFILE):
+    """
+    Send the request of an Endicia API and parse the response with the
+    target while it is read.
+
+    This replaces `send_request` of the API, which reads the whole
+    response and builds its tree.
+
+    :param api: Instance of an Endicia API
+    :param values: Values posted, as `send_request` of the API posts them
+    :param target: StreamedResponse
+    :param profile: Profile of the call, the time spent waiting for and
+                    reading the response is added to the `network` phase
+                    and the time spent parsing it and storing the images
+                    to the `parse` phase.
+    :return: The target, once the response is parsed
+    """
+    parser = etree.XMLParser(target=target)
+    start = time.time()
+    response = urlopen(api, values)
+    try:
+        while True:
+            chunk = response.read(CHUNK_SIZE)
+            read = time.time()
+            profile.add('network', read - start)
+            if not chunk:
+                break
+            target.size += len(chunk)
+            parser.feed(chunk)
+            start = time.time()
+            profile.add('parse', start - read)
+        parser.close()
+    except Exception:
+        target.abort()
+        raise
+    finally:
+        response.close()
+        profile.restart()
+
+    # Set the flags the API would set on its own response
+    api.flags['Status'] = target.status or 0
+    api.flags['ErrorMessage'] = target.error_message
+    if not api.success:
+        raise RequestError(api.error)
+    return target
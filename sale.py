@@ -7,10 +7,15 @@ from endicia import CalculatingPostageAPI, PostageRatesAPI
 from endicia.tools import objectify_response
 from endicia.exceptions import RequestError
 from trytond.model import ModelView, fields
+from trytond.cache import Cache
 from trytond.pool import PoolMeta, Pool
 from trytond.transaction import Transaction
 from trytond.pyson import Eval
 
+from .client import calculate_postage, postage_rates
+from .template import get_rate_template
+from .carrier import EndiciaShippingMixin
+
 
 __all__ = ['Configuration', 'Sale']
 __metaclass__ = PoolMeta
@@ -75,6 +80,12 @@ class Configuration:
         MAILPIECE_SHAPES, 'Endicia MailPiece Shape'
     )
 
+    # Default Endicia values of shipments, cleared when the configuration
+    # is changed
+    _endicia_defaults_cache = Cache(
+        'sale_configuration.endicia_defaults', context=False
+    )
+
     @staticmethod
     def default_endicia_label_subtype():
         # This is the default value as specified in Endicia doc
@@ -96,9 +107,50 @@ class Configuration:
         """
         return None
 
+    @classmethod
+    def get_endicia_defaults(cls):
+        """
+        Returns the default Endicia values of shipments, read once and kept
+        until the configuration is changed
+        """
+        defaults = cls._endicia_defaults_cache.get('defaults')
+        if defaults is None:
+            config = cls(1)
+            defaults = cls._endicia_defaults_cache.set('defaults', {
+                'endicia_mailclass':
+                    config.endicia_mailclass and config.endicia_mailclass.id,
+                'endicia_label_subtype': config.endicia_label_subtype,
+                'endicia_integrated_form_type':
+                    config.endicia_integrated_form_type,
+                'endicia_include_postage': config.endicia_include_postage,
+                'endicia_package_type': config.endicia_package_type,
+            })
+        return defaults.copy()
+
+    @classmethod
+    def clear_endicia_cache(cls):
+        cls._endicia_defaults_cache.clear()
+
+    @classmethod
+    def create(cls, vlist):
+        configurations = super(Configuration, cls).create(vlist)
+        cls.clear_endicia_cache()
+        return configurations
+
+    @classmethod
+    def write(cls, *args):
+        super(Configuration, cls).write(*args)
+        cls.clear_endicia_cache()
+
+    @classmethod
+    def delete(cls, configurations):
+        super(Configuration, cls).delete(configurations)
+        cls.clear_endicia_cache()
+
 
-class Sale:
+class Sale(EndiciaShippingMixin):
     "Sale"
+    __metaclass__ = PoolMeta
     __name__ = 'sale.sale'
 
     endicia_mailclass = fields.Many2One(
@@ -111,10 +163,6 @@ class Sale:
             'readonly': ~Eval('state').in_(['draft', 'quotation']),
         }, depends=['state']
     )
-    is_endicia_shipping = fields.Function(
-        fields.Boolean('Is Endicia Shipping?', readonly=True),
-        'get_is_endicia_shipping'
-    )
 
     def _get_weight_uom(self):
         """
@@ -211,21 +259,30 @@ class Sale:
             sale.apply_endicia_shipping()
 
     def create_shipment(self, shipment_type):
-        Shipment = Pool().get('stock.shipment.out')
-
         with Transaction().set_context(ignore_carrier_computation=True):
             # disable `carrier cost computation`(default behaviour) as cost
             # should only be computed after updating mailclass else error may
             # occur, with improper mailclass.
-            shipments = super(Sale, self).create_shipment(shipment_type)
-        if shipment_type == 'out' and shipments and self.carrier and \
-                self.carrier.carrier_cost_method == 'endicia':
-            Shipment.write(shipments, {
-                'endicia_mailclass': self.endicia_mailclass.id,
-                'endicia_mailpiece_shape': self.endicia_mailpiece_shape,
-                'is_endicia_shipping': self.is_endicia_shipping,
-            })
-        return shipments
+            return super(Sale, self).create_shipment(shipment_type)
+
+    def _get_shipment_sale(self, Shipment, key):
+        """
+        Set the Endicia values of the outgoing shipments before they are
+        created, so the configuration is read once and the shipments are
+        not written again.
+        """
+        shipment = super(Sale, self)._get_shipment_sale(Shipment, key)
+        if Shipment.__name__ == 'stock.shipment.out' and \
+                self.is_endicia_shipping:
+            defaults = Shipment.get_endicia_defaults()
+            # The mail class is the one of the sale
+            del defaults['endicia_mailclass']
+            for name, value in defaults.iteritems():
+                setattr(shipment, name, value)
+            shipment.is_endicia_shipping = True
+            shipment.endicia_mailclass = self.endicia_mailclass
+            shipment.endicia_mailpiece_shape = self.endicia_mailpiece_shape
+        return shipment
 
     def _get_ship_from_address(self):
         """
@@ -233,22 +290,14 @@ class Sale:
         """
         return self.warehouse.address
 
-    def get_endicia_shipping_cost(self, mailclass=None):
-        """Returns the calculated shipping cost as sent by endicia
-
-        :param mailclass: endicia mailclass for which cost to be fetched
-
-        :returns: The shipping cost in USD
+    def _get_calculate_postage_request(self, mailclass, endicia_credentials):
         """
-        Carrier = Pool().get('carrier')
-        EndiciaConfiguration = Pool().get('endicia.configuration')
-
-        endicia_credentials = EndiciaConfiguration(1).get_endicia_credentials()
-        carrier, = Carrier.search(['carrier_cost_method', '=', 'endicia'])
-
-        if not mailclass and not self.endicia_mailclass:
-            self.raise_user_error('mailclass_missing')
+        Returns the CalculatingPostageAPI request of the shipping cost of
+        the mailclass
 
+        :param mailclass: endicia mailclass value
+        :param endicia_credentials: Credentials the request is sent with
+        """
         from_address = self._get_ship_from_address()
         to_address = self.shipment_address
         to_zip = to_address.zip
@@ -264,18 +313,55 @@ class Sale:
         weight_oz = self.package_weight.quantize(
             Decimal('.1'), rounding=ROUND_UP
         )
-        calculate_postage_request = CalculatingPostageAPI(
-            mailclass=mailclass or self.endicia_mailclass.value,
-            MailpieceShape=self.endicia_mailpiece_shape,
-            weightoz=weight_oz,
-            from_postal_code=from_address.zip and from_address.zip[:5],
-            to_postal_code=to_zip,
-            to_country_code=to_address.country and to_address.country.code,
-            accountid=endicia_credentials.account_id,
-            requesterid=endicia_credentials.requester_id,
-            passphrase=endicia_credentials.passphrase,
-            test=endicia_credentials.is_test,
-        )
+        request = get_rate_template(
+            CalculatingPostageAPI, endicia_credentials,
+            from_address.zip and from_address.zip[:5]
+        ).new_request()
+        request.add_data({
+            'MailClass': mailclass,
+            'WeightOz': weight_oz,
+            'ToPostalCode': to_zip,
+            'ToCountryCode': to_address.country and to_address.country.code,
+        })
+        return request
+
+    def get_endicia_shipping_cost(self, mailclass=None):
+        """Returns the calculated shipping cost as sent by endicia
+
+        :param mailclass: endicia mailclass for which cost to be fetched
+
+        :returns: The shipping cost in USD
+        """
+        if not mailclass and not self.endicia_mailclass:
+            self.raise_user_error('mailclass_missing')
+
+        mailclass = mailclass or self.endicia_mailclass.value
+        return self.get_endicia_shipping_costs([mailclass])[mailclass]
+
+    def get_endicia_shipping_costs(self, mailclasses):
+        """Returns the calculated shipping costs of several mailclasses,
+        requested from endicia at the same time
+
+        :param mailclasses: List of endicia mailclass values
+
+        :returns: Dictionary of mailclass value and shipping cost in USD
+        """
+        Carrier = Pool().get('carrier')
+        EndiciaConfiguration = Pool().get('endicia.configuration')
+
+        configuration = EndiciaConfiguration(1)
+        carrier, = Carrier.search(['carrier_cost_method', '=', 'endicia'])
+
+        # The account is chosen for each request, so they are spread over
+        # the accounts of the policy
+        credentials = [
+            configuration.get_endicia_credentials(self.warehouse)
+            for mailclass in mailclasses
+        ]
+        requests = [
+            self._get_calculate_postage_request(mailclass, endicia_credentials)
+            for mailclass, endicia_credentials in zip(mailclasses, credentials)
+        ]
 
         # Logging.
         logger.debug(
@@ -283,23 +369,35 @@ class Sale:
             'Sale ID: {0} and Carrier ID: {1}'
             .format(self.id, carrier.id)
         )
-        logger.debug('--------POSTAGE REQUEST--------')
-        logger.debug(str(calculate_postage_request.to_xml()))
-        logger.debug('--------END REQUEST--------')
-
-        try:
-            response = calculate_postage_request.send_request()
-        except RequestError, e:
-            self.raise_user_error(unicode(e))
-
-        # Logging.
-        logger.debug('--------POSTAGE RESPONSE--------')
-        logger.debug(str(response))
-        logger.debug('--------END RESPONSE--------')
-
-        return self.fetch_endicia_postage_rate(
-            objectify_response(response).PostagePrice
-        )
+        if logger.isEnabledFor(logging.DEBUG):
+            for calculate_postage_request in requests:
+                logger.debug('--------POSTAGE REQUEST--------')
+                logger.debug(str(calculate_postage_request.to_xml()))
+                logger.debug('--------END REQUEST--------')
+
+        results = calculate_postage(requests)
+
+        costs = {}
+        for mailclass, endicia_credentials, result in zip(
+                mailclasses, credentials, results):
+            try:
+                response = result.get()
+            except RequestError, e:
+                self.raise_user_error(unicode(e))
+
+            # Logging.
+            logger.debug('--------POSTAGE RESPONSE--------')
+            logger.debug(str(response))
+            logger.debug('--------END RESPONSE--------')
+
+            result = objectify_response(response)
+            EndiciaConfiguration.record_postage_balance(
+                result, endicia_credentials.account
+            )
+            costs[mailclass] = self.fetch_endicia_postage_rate(
+                result.PostagePrice
+            )
+        return costs
 
     def _get_endicia_mail_classes(self):
         """
@@ -311,13 +409,17 @@ class Sale:
 
         return Mailclass.search([])
 
-    def _make_endicia_rate_line(self, carrier, mailclass, shipment_rate):
+    def _make_endicia_rate_line(
+            self, carrier, mailclass, shipment_rate, usd=None):
         """
         Build a rate tuple from shipment_rate and mailclass
+
+        :param usd: USD currency, searched for when not given
         """
         Currency = Pool().get('currency.currency')
 
-        usd, = Currency.search([('code', '=', 'USD')])
+        if usd is None:
+            usd, = Currency.search([('code', '=', 'USD')])
         write_vals = {
             'carrier': carrier.id,
             'endicia_mailclass': mailclass.id,
@@ -330,18 +432,13 @@ class Sale:
             write_vals
         )
 
-    def get_endicia_shipping_rates(self, silent=True):
+    def _get_postage_rates_request(self, endicia_credentials):
         """
-        Call the rates service and get possible quotes for shipment for eligible
-        mail classes
+        Returns the PostageRatesAPI request of the rates of the sale
+
+        :param endicia_credentials: Credentials the request is sent with
         """
-        Carrier = Pool().get('carrier')
         UOM = Pool().get('product.uom')
-        EndiciaConfiguration = Pool().get('endicia.configuration')
-
-        endicia_credentials = EndiciaConfiguration(1).get_endicia_credentials()
-
-        carrier, = Carrier.search(['carrier_cost_method', '=', 'endicia'])
 
         from_address = self._get_ship_from_address()
         mailclass_type = "Domestic" if self.shipment_address.country.code == 'US' \
@@ -359,39 +456,93 @@ class Sale:
         else:
             # International
             to_zip = to_zip and to_zip[:15]
-        postage_rates_request = PostageRatesAPI(
-            mailclass=mailclass_type,
-            weightoz=weight_oz,
-            from_postal_code=from_address.zip[:5],
-            to_postal_code=to_zip,
-            to_country_code=self.shipment_address.country.code,
-            accountid=endicia_credentials.account_id,
-            requesterid=endicia_credentials.requester_id,
-            passphrase=endicia_credentials.passphrase,
-            test=endicia_credentials.is_test,
-        )
+        request = get_rate_template(
+            PostageRatesAPI, endicia_credentials, from_address.zip[:5]
+        ).new_request()
+        request.add_data({
+            'MailClass': mailclass_type,
+            'WeightOz': weight_oz,
+            'ToPostalCode': to_zip,
+            'ToCountryCode': self.shipment_address.country.code,
+        })
+        return request
 
-        # Logging.
-        logger.debug(
-            'Making Postage Rates Request for shipping rates of'
-            'Sale ID: {0} and Carrier ID: {1}'
-            .format(self.id, carrier.id)
-        )
-        logger.debug('--------POSTAGE RATES REQUEST--------')
-        logger.debug(str(postage_rates_request.to_xml()))
-        logger.debug('--------END REQUEST--------')
+    def get_endicia_shipping_rates(self, silent=True):
+        """
+        Call the rates service and get possible quotes for shipment for eligible
+        mail classes
+        """
+        return self.get_endicia_sales_shipping_rates([self])[self.id]
+
+    @classmethod
+    def get_endicia_sales_shipping_rates(cls, sales):
+        """
+        Get the quotes of several sales, requested from endicia at the same
+        time
+
+        :param sales: List of sales
+        :returns: Dictionary of sale id and list of rate tuples
+        """
+        Carrier = Pool().get('carrier')
+        Currency = Pool().get('currency.currency')
+        EndiciaConfiguration = Pool().get('endicia.configuration')
+
+        configuration = EndiciaConfiguration(1)
+        carrier, = Carrier.search(['carrier_cost_method', '=', 'endicia'])
 
-        try:
-            response_xml = postage_rates_request.send_request()
-            response = objectify_response(response_xml)
-        except RequestError, e:
-            self.raise_user_error(unicode(e))
+        credentials = [
+            configuration.get_endicia_credentials(sale.warehouse)
+            for sale in sales
+        ]
+        requests = [
+            sale._get_postage_rates_request(endicia_credentials)
+            for sale, endicia_credentials in zip(sales, credentials)
+        ]
 
         # Logging.
-        logger.debug('--------POSTAGE RATES RESPONSE--------')
-        logger.debug(str(response_xml))
-        logger.debug('--------END RESPONSE--------')
+        if logger.isEnabledFor(logging.DEBUG):
+            for sale, postage_rates_request in zip(sales, requests):
+                logger.debug(
+                    'Making Postage Rates Request for shipping rates of'
+                    'Sale ID: {0} and Carrier ID: {1}'
+                    .format(sale.id, carrier.id)
+                )
+                logger.debug('--------POSTAGE RATES REQUEST--------')
+                logger.debug(str(postage_rates_request.to_xml()))
+                logger.debug('--------END REQUEST--------')
+
+        results = postage_rates(requests)
+
+        # Searched once for all the rate lines
+        usd, = Currency.search([('code', '=', 'USD')])
+
+        rates = {}
+        for sale, endicia_credentials, result in zip(
+                sales, credentials, results):
+            try:
+                response_xml = result.get()
+                response = objectify_response(response_xml)
+            except RequestError, e:
+                sale.raise_user_error(unicode(e))
+
+            # Logging.
+            logger.debug('--------POSTAGE RATES RESPONSE--------')
+            logger.debug(str(response_xml))
+            logger.debug('--------END RESPONSE--------')
+
+            EndiciaConfiguration.record_postage_balance(
+                response, endicia_credentials.account
+            )
+            rates[sale.id] = sale._get_endicia_rate_lines(
+                response, carrier, usd
+            )
+        return rates
 
+    def _get_endicia_rate_lines(self, response, carrier, usd):
+        """
+        Returns the rate tuples of the eligible mail classes of the
+        objectified PostageRatesAPI response
+        """
         allowed_mailclasses = {
             mailclass.value: mailclass
             for mailclass in self._get_endicia_mail_classes()
@@ -404,7 +555,9 @@ class Sale:
                 continue
             cost = self.fetch_endicia_postage_rate(postage_price)
             rate_lines.append(
-                self._make_endicia_rate_line(carrier, mailclass, cost)
+                self._make_endicia_rate_line(
+                    carrier, mailclass, cost, usd=usd
+                )
             )
         return filter(None, rate_lines)
 
@@ -413,9 +566,3 @@ class Sale:
         Fetch postage rate from response
         """
         return Decimal(postage_price_node.get('TotalAmount'))
-
-    def get_is_endicia_shipping(self, name):
-        """
-        Check if shipping is from USPS
-        """
-        return self.carrier and self.carrier.carrier_cost_method == 'endicia'
@@ -5,16 +5,18 @@
     :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
     :license: BSD, see LICENSE for more details.
 """
-import base64
 from datetime import datetime
 
 from trytond.model import Workflow, ModelSQL, ModelView, fields
 from trytond.pool import Pool
 from trytond.pyson import Eval
+from trytond.rpc import RPC
 
 from endicia import SCANFormAPI
 
-from endicia.tools import objectify_response
+from .response import StreamedResponse, stream_request
+from .metrics import measure
+from .index import create_index
 
 __all__ = ['EndiciaShipmentBag']
 
@@ -26,7 +28,7 @@ class EndiciaShipmentBag(Workflow, ModelSQL, ModelView):
     state = fields.Selection([
         ('open', 'Open'),
         ('closed', 'Closed'),
-    ], 'State', readonly=True, required=True)
+    ], 'State', readonly=True, required=True, select=True)
 
     shipments = fields.One2Many(
         'stock.shipment.out', 'endicia_shipment_bag', 'Shipments',
@@ -34,20 +36,34 @@ class EndiciaShipmentBag(Workflow, ModelSQL, ModelView):
             'readonly': Eval('state') != 'open',
         },
         domain=[
-            ('carrier.carrier_cost_method', '=', 'endicia'),
+            ('is_endicia_shipping', '=', True),
             ('state', '=', 'done'),
         ],
         add_remove=[
-            ('carrier.carrier_cost_method', '=', 'endicia'),
+            ('is_endicia_shipping', '=', True),
             ('endicia_shipment_bag', '=', None),
             ('state', '=', 'done'),
         ], depends=['state']
     )
     submission_id = fields.Char('Submission Id', readonly=True, select=True)
+    endicia_account = fields.Many2One(
+        'endicia.account', 'Endicia Account', readonly=True,
+        help='Endicia account the labels of the bag were bought with.'
+    )
 
     open_date = fields.Date('Open Date', readonly=True, required=True)
     close_date = fields.Date('Close Date', readonly=True)
 
+    @classmethod
+    def __register__(cls, module_name):
+        super(EndiciaShipmentBag, cls).__register__(module_name)
+
+        # There is at most one open bag per account, looked up by get_bag
+        create_index(
+            'endicia_shipment_bag_open_index', cls._table,
+            ['endicia_account', 'state'], "state = 'open'"
+        )
+
     @classmethod
     def __setup__(cls):
         super(EndiciaShipmentBag, cls).__setup__()
@@ -58,6 +74,8 @@ class EndiciaShipmentBag(Workflow, ModelSQL, ModelView):
 
         cls._error_messages.update({
             'bag_empty': 'Bag should have atleast one shipment.',
+            'bag_mixed_accounts': 'The labels of the shipments of bag '
+            '"%s" were bought with different Endicia accounts.',
             'error_scanform': 'Error in generating scanform "%s"',
         })
 
@@ -66,6 +84,9 @@ class EndiciaShipmentBag(Workflow, ModelSQL, ModelView):
                 'invisible': Eval('state').in_(['closed']),
             },
         })
+        cls.__rpc__.update({
+            'get_endicia_label_document': RPC(readonly=False, instantiate=0),
+        })
 
     def get_rec_name(self, name):
         return self.submission_id or str(self.id)
@@ -79,19 +100,25 @@ class EndiciaShipmentBag(Workflow, ModelSQL, ModelView):
         return datetime.utcnow().date()
 
     @classmethod
-    def get_bag(cls):
+    def get_bag(cls, account=None):
         """
         Returns currently opened bag and make sure only one bag is opened at a
-        time.
+        time for each Endicia account.
         This method can be inherited to change the logic of bag opening.
+
+        :param account: Id of the endicia.account of the labels, None for
+                        the account of the configuration
         """
-        bags = cls.search([('state', '=', 'open')])
+        bags = cls.search([
+            ('state', '=', 'open'),
+            ('endicia_account', '=', account),
+        ])
 
         assert len(bags) < 2  # Assert at max we have 1 open bags.
         if bags:
             # Return if a bag is opened.
             return bags[0]
-        return cls.create([{}])[0]
+        return cls.create([{'endicia_account': account}])[0]
 
     @classmethod
     @ModelView.button
@@ -103,21 +130,56 @@ class EndiciaShipmentBag(Workflow, ModelSQL, ModelView):
             'close_date': datetime.utcnow().date()
         })
 
+    @classmethod
+    def get_endicia_label_document(cls, bags):
+        """
+        Merge the labels of all shipments in the bags in one print
+        document attached to the first bag
+
+        :return: Id of the ir.attachment of the document
+        """
+        Shipment = Pool().get('stock.shipment.out')
+
+        shipments = []
+        for bag in bags:
+            shipments.extend(bag.shipments)
+        return Shipment.get_endicia_label_document(shipments, bags[0])
+
+    def get_endicia_credentials(self):
+        """
+        Returns the credentials of the account the labels of the bag were
+        bought with: the account of the bag, else the account of the
+        labels of its shipments, else the account of the configuration.
+        """
+        EndiciaConfiguration = Pool().get('endicia.configuration')
+
+        account = self.endicia_account
+        if not account:
+            accounts = set(
+                shipment.endicia_account for shipment in self.shipments
+                if shipment.endicia_account
+            )
+            if len(accounts) > 1:
+                self.raise_user_error(
+                    'bag_mixed_accounts', error_args=(self.rec_name,)
+                )
+            if accounts:
+                account, = accounts
+        if account:
+            return account.get_credentials()
+        return EndiciaConfiguration(1).get_configuration_credentials()
+
     def make_scanform(self):
         """
         Generate the SCAN Form for bag
         """
-        EndiciaConfiguration = Pool().get('endicia.configuration')
         Attachment = Pool().get('ir.attachment')
 
-        # Getting the api credentials to be used in refund request generation
-        # endget_weight_for_endiciaicia credentials are in the format :
-        # (account_id, requester_id, passphrase, is_test)
-        endicia_credentials = EndiciaConfiguration(1).get_endicia_credentials()
-
         if not self.shipments:
             self.raise_user_error('bag_empty')
 
+        endicia_credentials = self.get_endicia_credentials()
+
         pic_numbers = [shipment.tracking_number for shipment in self.shipments]
         test = endicia_credentials.is_test and 'Y' or 'N'
         scan_request = SCANFormAPI(
@@ -127,17 +189,23 @@ class EndiciaShipmentBag(Workflow, ModelSQL, ModelView):
             passphrase=endicia_credentials.passphrase,
             test=test,
         )
-        response = scan_request.send_request()
-        result = objectify_response(response)
-        if not hasattr(result, 'SCANForm'):
+        with measure('scan', scan_request) as call:
+            response = stream_request(scan_request, {
+                'method': 'SCANRequest',
+                'XMLInput': scan_request.to_xml(),
+            }, StreamedResponse(Attachment.open_base64_store))
+            call.size = response.size
+        if not response.images:
             self.raise_user_error(
-                'error_scanform', error_args=(result.ErrorMsg,)
+                'error_scanform', error_args=(response.error_message,)
             )
         else:
-            self.submission_id = str(result.SubmissionID)
+            self.submission_id = response.values['SubmissionID']
             self.save()
-            Attachment.create([{
-                'name': 'SCAN%s.png' % str(result.SubmissionID),
-                'data': buffer(base64.decodestring(result.SCANForm.pyval)),
+            (_, stored), = response.images
+            values = {
+                'name': 'SCAN%s.png' % self.submission_id,
                 'resource': '%s,%s' % (self.__name__, self.id)
-            }])
+            }
+            values.update(Attachment.get_stored_values(*stored))
+            Attachment.create([values])
@@ -6,23 +6,39 @@
 Inherit stock for endicia API
 '''
 from decimal import Decimal, ROUND_UP
-import base64
+from datetime import datetime, timedelta
+from collections import OrderedDict
+import re
 import math
 import logging
 
+from sql.functions import Now
 from endicia import ShippingLabelAPI, LabelRequest, RefundRequestAPI, \
-    BuyingPostageAPI, Element, CalculatingPostageAPI
-from endicia.tools import objectify_response, get_images
+    Element, CalculatingPostageAPI
+from endicia.tools import objectify_response
 from endicia.exceptions import RequestError
 
+from trytond import backend
 from trytond.model import Workflow, ModelView, fields
-from trytond.wizard import Wizard, StateView, Button
+from trytond.cache import Cache
+from trytond.wizard import Wizard, StateView, StateAction, Button
 from trytond.transaction import Transaction
 from trytond.pool import Pool, PoolMeta
-from trytond.pyson import Eval
+from trytond.pyson import Eval, PYSONEncoder
 from trytond.rpc import RPC
+from trytond.exceptions import UserError
+from trytond.tools import reduce_ids, grouped_slice
 
 from .sale import ENDICIA_PACKAGE_TYPES, MAILPIECE_SHAPES
+from .carrier import EndiciaShippingMixin
+from .location import IMAGE_EXTENSIONS
+from .response import StreamedResponse, stream_request
+from .metrics import registry, measure, send_request, start_profile
+from .zip_database import get_zip_database
+from .index import create_index
+from .template import RequestTemplate, get_rate_template
+from .label_document import RawLabelWriter, PDFLabelWriter, \
+    LabelDocumentError
 
 
 __metaclass__ = PoolMeta
@@ -30,6 +46,7 @@ __all__ = [
     'ShipmentOut', 'ShippingEndicia', 'GenerateShippingLabel',
     'EndiciaRefundRequestWizardView', 'EndiciaRefundRequestWizard',
     'BuyPostageWizardView', 'BuyPostageWizard',
+    'EndiciaLabelDocument',
 ]
 
 STATES = {
@@ -38,13 +55,20 @@ STATES = {
 
 logger = logging.getLogger(__name__)
 
+# ZIP or ZIP+4 of US addresses
+US_ZIP = re.compile(r'^\d{5}(-?\d{4})?$')
+
+# Maximum length of the postal code of international addresses
+MAX_INTERNATIONAL_ZIP = 15
+
 quantize_2_decimal = lambda v: Decimal(v).quantize(
     Decimal('.01'), rounding=ROUND_UP
 )
 
 
-class ShipmentOut:
+class ShipmentOut(EndiciaShippingMixin):
     "Shipment Out"
+    __metaclass__ = PoolMeta
     __name__ = 'stock.shipment.out'
 
     endicia_mailclass = fields.Many2One(
@@ -55,7 +79,7 @@ class ShipmentOut:
         depends=['state']
     )
     endicia_shipment_bag = fields.Many2One(
-        'endicia.shipment.bag', 'Endicia Shipment Bag')
+        'endicia.shipment.bag', 'Endicia Shipment Bag', select=True)
     endicia_label_subtype = fields.Selection([
         ('None', 'None'),
         ('Integrated', 'Integrated')
@@ -72,11 +96,20 @@ class ShipmentOut:
         ENDICIA_PACKAGE_TYPES, 'Package Content Type',
         states=STATES, depends=['state']
     )
-    is_endicia_shipping = fields.Function(
-        fields.Boolean('Is Endicia Shipping?', readonly=True),
-        'get_is_endicia_shipping'
+    endicia_refunded = fields.Boolean('Refunded ?', readonly=True, select=True)
+    endicia_refund_rejected = fields.Boolean(
+        'Refund Rejected ?', readonly=True,
+        help='Endicia did not approve the refund of the label.'
+    )
+    endicia_account = fields.Many2One(
+        'endicia.account', 'Endicia Account', readonly=True,
+        help='Endicia account the label was bought with.'
+    )
+
+    # Label request templates per account, label options and from address
+    _endicia_label_templates = Cache(
+        'stock_shipment_out.endicia_label_templates', context=False
     )
-    endicia_refunded = fields.Boolean('Refunded ?', readonly=True)
 
     def _get_weight_uom(self):
         """
@@ -91,35 +124,35 @@ class ShipmentOut:
 
         return super(ShipmentOut, self)._get_weight_uom()
 
-    @staticmethod
-    def default_endicia_mailclass():
+    @classmethod
+    def get_endicia_defaults(cls):
+        """
+        Returns the default Endicia values of shipments, from the sale
+        configuration
+        """
         Config = Pool().get('sale.configuration')
-        config = Config(1)
-        return config.endicia_mailclass and config.endicia_mailclass.id or None
 
-    @staticmethod
-    def default_endicia_label_subtype():
-        Config = Pool().get('sale.configuration')
-        config = Config(1)
-        return config.endicia_label_subtype
+        return Config.get_endicia_defaults()
 
-    @staticmethod
-    def default_endicia_integrated_form_type():
-        Config = Pool().get('sale.configuration')
-        config = Config(1)
-        return config.endicia_integrated_form_type
+    @classmethod
+    def default_endicia_mailclass(cls):
+        return cls.get_endicia_defaults()['endicia_mailclass']
 
-    @staticmethod
-    def default_endicia_include_postage():
-        Config = Pool().get('sale.configuration')
-        config = Config(1)
-        return config.endicia_include_postage
+    @classmethod
+    def default_endicia_label_subtype(cls):
+        return cls.get_endicia_defaults()['endicia_label_subtype']
 
-    @staticmethod
-    def default_endicia_package_type():
-        Config = Pool().get('sale.configuration')
-        config = Config(1)
-        return config.endicia_package_type
+    @classmethod
+    def default_endicia_integrated_form_type(cls):
+        return cls.get_endicia_defaults()['endicia_integrated_form_type']
+
+    @classmethod
+    def default_endicia_include_postage(cls):
+        return cls.get_endicia_defaults()['endicia_include_postage']
+
+    @classmethod
+    def default_endicia_package_type(cls):
+        return cls.get_endicia_defaults()['endicia_package_type']
 
     @classmethod
     def __setup__(cls):
@@ -137,12 +170,53 @@ class ShipmentOut:
             'invalid_state': 'Labels can only be generated when the '
                 'shipment is in Packed or Done states only',
             'wrong_carrier': 'Carrier for selected shipment is not Endicia',
+            'tracking_number_missing':
+                'Shipment "%s" has no label to be refunded.',
+            'no_labels': 'There are no labels to print.',
+            'mixed_label_formats':
+                'Labels in different formats can not be printed together.',
+            'label_format_not_mergeable':
+                'Labels in "%s" format can not be merged in one document, '
+                'use a label profile in PNG, ZPL II or EPL2 format.',
+            'error_label_document': 'Error in merging labels "%s"',
+            'delivery_address_required': 'Delivery address is required.',
+            'subdivision_missing': 'Address "%s" has no state.',
+            'invalid_zip': 'ZIP "%s" of address "%s" is not a valid US ZIP.',
+            'unknown_zip': 'ZIP "%s" of address "%s" is not a known '
+                'US ZIP.',
+            'invalid_zip_length': 'Postal code "%s" of address "%s" is '
+                'longer than %s characters.',
+            'customs_value_missing':
+                'Product "%s" has no customs value.',
+            'integrated_form_type_missing':
+                'Select an integrated form type for integrated labels.',
         })
         cls.__rpc__.update({
             'make_endicia_labels': RPC(readonly=False, instantiate=0),
+            'make_endicia_labels_batch': RPC(readonly=False, instantiate=0),
+            'validate_endicia_shipments': RPC(readonly=True, instantiate=0),
             'get_endicia_shipping_cost': RPC(readonly=False, instantiate=0),
+            'get_endicia_label_document': RPC(readonly=False, instantiate=0),
+            'get_endicia_labels': RPC(readonly=True),
         })
 
+    @classmethod
+    def __register__(cls, module_name):
+        super(ShipmentOut, cls).__register__(module_name)
+
+        # Labels are looked up by tracking number
+        create_index(
+            'stock_shipment_out_endicia_tracking_number_index', cls._table,
+            ['tracking_number'], 'tracking_number IS NOT NULL'
+        )
+        # Cancelled shipments with a label, scanned by the refund sweep in
+        # the order of their write date
+        create_index(
+            'stock_shipment_out_endicia_refund_index', cls._table,
+            ['state', 'write_date'],
+            "state = 'cancel' AND tracking_number IS NOT NULL"
+        )
+
     def on_change_carrier(self):
         res = super(ShipmentOut, self).on_change_carrier()
 
@@ -158,22 +232,54 @@ class ShipmentOut:
         """
         Add endicia shipments to a open bag
         """
-        EndiciaShipmentBag = Pool().get('endicia.shipment.bag')
-
         super(ShipmentOut, cls).done(shipments)
-        endicia_shipments = filter(
-            lambda s: s.carrier and s.carrier.carrier_cost_method == 'endicia',
-            shipments
-        )
+        cls.add_to_endicia_bag(shipments)
+
+    @classmethod
+    def add_to_endicia_bag(cls, shipments):
+        """
+        Add the Endicia shipments which are not in a bag to the open bag of
+        the Endicia account of their label.
 
-        if not endicia_shipments:
+        The shipments are selected and updated with one query per slice of
+        ids, so the whole batch of a bulk transition is bagged at once.
+        """
+        EndiciaShipmentBag = Pool().get('endicia.shipment.bag')
+        transaction = Transaction()
+        cursor = transaction.cursor
+        table = cls.__table__()
+
+        accounts = {}
+        for sub_ids in grouped_slice([s.id for s in shipments]):
+            cursor.execute(*table.select(table.id, table.endicia_account,
+                where=(
+                    reduce_ids(table.id, sub_ids)
+                    & (table.is_endicia_shipping == True)  # noqa
+                    & (table.endicia_shipment_bag == None)  # noqa
+                )))
+            for id, account in cursor.fetchall():
+                accounts.setdefault(account, []).append(id)
+        if not accounts:
             return
 
-        with Transaction().set_user(0):
-            bag = EndiciaShipmentBag.get_bag()
-        cls.write(endicia_shipments, {
-            'endicia_shipment_bag': bag
-        })
+        for account, ids in accounts.iteritems():
+            with transaction.set_user(0):
+                bag = EndiciaShipmentBag.get_bag(account)
+            for sub_ids in grouped_slice(ids):
+                cursor.execute(*table.update(
+                    [table.endicia_shipment_bag, table.write_uid,
+                        table.write_date],
+                    [bag.id, transaction.user, Now()],
+                    where=reduce_ids(table.id, sub_ids)
+                ))
+        ids = sum(accounts.values(), [])
+
+        # Clean cursor cache
+        transaction.counter += 1
+        for cache in cursor.cache.itervalues():
+            if cls.__name__ in cache:
+                for id in ids:
+                    cache[cls.__name__].pop(id, None)
 
     def _get_carrier_context(self):
         "Pass shipment in the context"
@@ -199,25 +305,30 @@ class ShipmentOut:
         uom_oz, = UOM.search([('symbol', '=', 'oz')])
         customsitems = []
         value = 0
+        total_value = 0
+        names = []
 
+        # The moves are browsed as one list, so their products, templates
+        # and units are each read in one query for all the moves instead
+        # of one query per move.
         for move in self.outgoing_moves:
+            product = move.product
+            names.append(product.name)
+            total_value += float(product.cost_price) * move.quantity
             if move.quantity <= 0:
                 continue
             weight_oz = quantize_2_decimal(move.get_weight(uom_oz))
+            customs_value = product.customs_value_used
             new_item = [
-                Element('Description', move.product.name[0:50]),
+                Element('Description', product.name[0:50]),
                 Element('Quantity', int(math.ceil(move.quantity))),
                 Element('Weight', weight_oz),
-                Element('Value', quantize_2_decimal(
-                    move.product.customs_value_used
-                )),
+                Element('Value', quantize_2_decimal(customs_value)),
             ]
             customsitems.append(Element('CustomsItem', new_item))
-            value += float(move.product.customs_value_used) * move.quantity
+            value += float(customs_value) * move.quantity
 
-        description = ','.join([
-            move.product.name for move in self.outgoing_moves
-        ])
+        description = ','.join(names)
         request.add_data({
             'customsinfo': [
                 Element('ContentsExplanation', description[:25]),
@@ -225,10 +336,6 @@ class ShipmentOut:
                 Element('ContentsType', self.endicia_package_type)
             ]
         })
-        total_value = sum(map(
-            lambda move: float(move.product.cost_price) * move.quantity,
-            self.outgoing_moves
-        ))
         request.add_data({
             'ContentsType': self.endicia_package_type,
             'Value': quantize_2_decimal(total_value),
@@ -237,13 +344,93 @@ class ShipmentOut:
             'CustomsSigner': user.name,
         })
 
+    def _get_endicia_label_profile(self):
+        """
+        Returns the label profile of the warehouse, or the default label
+        profile from endicia configuration
+        """
+        EndiciaConfiguration = Pool().get('endicia.configuration')
+
+        if self.warehouse and self.warehouse.endicia_label_profile:
+            return self.warehouse.endicia_label_profile
+        return EndiciaConfiguration(1).label_profile
+
+    def _get_endicia_label_options(self):
+        """
+        Returns the image options for the LabelRequest
+
+        Downstream modules can override this to choose the options for
+        a printer.
+        """
+        profile = self._get_endicia_label_profile()
+        if profile:
+            return profile.get_label_request_options()
+        return {
+            'ImageFormat': 'PNG',
+            'LabelSize': '6x4',
+            'ImageResolution': '203',
+            'ImageRotation': 'Rotate270',
+        }
+
+    def _get_endicia_label_template(
+            self, endicia_credentials, label_options, label_type,
+            from_values=None):
+        """
+        Returns the template of the label requests of the account, label
+        options and from address, made once and kept until one of them is
+        changed.
+
+        :param endicia_credentials: Credentials the labels are bought with
+        :param label_options: Image options of the LabelRequest
+        :param label_type: LabelType of the LabelRequest
+        :param from_values: Endicia values of the warehouse address, read
+                            if None
+        """
+        Address = Pool().get('party.address')
+
+        from_address = self.warehouse.address
+        if from_values is None:
+            from_values = Address.get_endicia_values([from_address])[
+                from_address.id
+            ]
+        key = (
+            tuple(endicia_credentials), label_type,
+            tuple(sorted(label_options.iteritems())),
+            from_address.id, tuple(sorted(from_values.iteritems())),
+        )
+        template = self._endicia_label_templates.get(key)
+        registry.record_cache('label_template', template is not None)
+        if template is not None:
+            return template
+
+        label_request = LabelRequest(
+            Test=endicia_credentials.is_test and 'YES' or 'NO',
+            LabelType=label_type,
+            **label_options
+        )
+        api = ShippingLabelAPI(
+            label_request=label_request,
+            weight_oz=None,
+            partner_customer_id=None,
+            partner_transaction_id=None,
+            mail_class=None,
+            accountid=endicia_credentials.account_id,
+            requesterid=endicia_credentials.requester_id,
+            passphrase=endicia_credentials.passphrase,
+            test=endicia_credentials.is_test,
+        )
+        api.add_data(
+            from_address.address_to_endicia_from_address(from_values).data
+        )
+        return self._endicia_label_templates.set(key, RequestTemplate(api))
+
     def make_endicia_labels(self):
         """
         Make labels for the given shipment
 
         :return: Tracking number as string
         """
-        Attachment = Pool().get('ir.attachment')
+        Address = Pool().get('party.address')
         EndiciaConfiguration = Pool().get('endicia.configuration')
 
         if self.state not in ('packed', 'done'):
@@ -258,51 +445,49 @@ class ShipmentOut:
         if self.tracking_number:
             self.raise_user_error('tracking_number_already_present')
 
-        endicia_credentials = EndiciaConfiguration(1).get_endicia_credentials()
+        profile = start_profile('label', self)
+        endicia_credentials = EndiciaConfiguration(1).get_endicia_credentials(
+            self.warehouse
+        )
 
         if not self.endicia_mailclass:
             self.raise_user_error('mailclass_missing')
 
         mailclass = self.endicia_mailclass.value
-        label_request = LabelRequest(
-            Test=endicia_credentials.is_test and 'YES' or 'NO',
-            LabelType=(
-                'International' in mailclass
-            ) and 'International' or 'Default',
-            # TODO: Probably the following have to be configurable
-            ImageFormat="PNG",
-            LabelSize="6x4",
-            ImageResolution="203",
-            ImageRotation="Rotate270",
-        )
-
-        # Endicia only support 1 decimal place in weight
-        weight_oz = self.package_weight.quantize(
-            Decimal('.1'), rounding=ROUND_UP
-        )
-        shipping_label_request = ShippingLabelAPI(
-            label_request=label_request,
-            weight_oz=weight_oz,
-            partner_customer_id=self.delivery_address.id,
-            partner_transaction_id=self.id,
-            mail_class=mailclass,
-            MailpieceShape=self.endicia_mailpiece_shape,
-            accountid=endicia_credentials.account_id,
-            requesterid=endicia_credentials.requester_id,
-            passphrase=endicia_credentials.passphrase,
-            test=endicia_credentials.is_test,
-        )
+        label_options = self._get_endicia_label_options()
 
         # From address is the warehouse location. So it must be filled.
         if not self.warehouse.address:
             self.raise_user_error('warehouse_address_required')
 
-        shipping_label_request.add_data(
-            self.warehouse.address.address_to_endicia_from_address().data
+        # Both addresses are prepared in one read when not cached
+        address_values = Address.get_endicia_values([
+            self.warehouse.address, self.delivery_address
+        ])
+
+        # Endicia only support 1 decimal place in weight
+        weight_oz = self.package_weight.quantize(
+            Decimal('.1'), rounding=ROUND_UP
         )
+        shipping_label_request = self._get_endicia_label_template(
+            endicia_credentials, label_options,
+            'International' in mailclass and 'International' or 'Default',
+            address_values[self.warehouse.address.id]
+        ).new_request()
+        shipping_label_request.add_data({
+            'MailClass': mailclass,
+            'WeightOz': weight_oz,
+            'PartnerCustomerID': self.delivery_address.id,
+            'PartnerTransactionID': self.id,
+        })
+        profile.mark('setup')
+
         shipping_label_request.add_data(
-            self.delivery_address.address_to_endicia_to_address().data
+            self.delivery_address.address_to_endicia_to_address(
+                address_values[self.delivery_address.id]
+            ).data
         )
+        profile.mark('addresses')
         shipping_label_request.add_data({
             'LabelSubtype': self.endicia_label_subtype,
             'IncludePostage':
@@ -316,6 +501,10 @@ class ShipmentOut:
             })
 
         self._update_endicia_item_details(shipping_label_request)
+        profile.mark('item_details')
+
+        request_xml = shipping_label_request.to_xml()
+        profile.mark('to_xml')
 
         # Logging.
         logger.debug(
@@ -324,37 +513,223 @@ class ShipmentOut:
             .format(self.id, self.carrier.id)
         )
         logger.debug('--------SHIPPING LABEL REQUEST--------')
-        logger.debug(str(shipping_label_request.to_xml()))
+        logger.debug(str(request_xml))
         logger.debug('--------END REQUEST--------')
 
+        response = self._send_endicia_label_request(
+            shipping_label_request, request_xml, profile
+        )
+        tracking_number = self._save_endicia_label_response(
+            response, endicia_credentials.account,
+            IMAGE_EXTENSIONS.get(label_options['ImageFormat'], 'png'),
+            profile
+        )
+        profile.close()
+        return tracking_number
+
+    def _update_endicia_bag(self, account):
+        """
+        Move the shipment to the open bag of the account its label was
+        bought with, if it is in the open bag of another account. This
+        happens when the label of a done shipment is bought again.
+
+        :param account: Id of the endicia.account of the label
+        """
+        bag = self.endicia_shipment_bag
+        if not bag or bag.state != 'open':
+            return
+        if (bag.endicia_account and bag.endicia_account.id) == account:
+            return
+        self.__class__.write([self], {'endicia_shipment_bag': None})
+        self.__class__.add_to_endicia_bag([self])
+
+    def _send_endicia_label_request(self, request, request_xml, profile):
+        """
+        Send the label request of the shipment
+
+        :return: StreamedResponse with the images written to the filestore
+        """
+        Attachment = Pool().get('ir.attachment')
+
         try:
-            response = shipping_label_request.send_request()
+            # Images are written to the filestore while the response is
+            # read, so the label response is never held in memory
+            with measure('label', request) as call:
+                response = stream_request(
+                    request,
+                    {'labelRequestXML': request_xml},
+                    StreamedResponse(Attachment.open_base64_store),
+                    profile
+                )
+                call.size = response.size
         except RequestError, error:
             self.raise_user_error('error_label', error_args=(error,))
+
+        # Logging.
+        logger.debug('--------SHIPPING LABEL RESPONSE--------')
+        logger.debug(str(response.values))
+        logger.debug('--------END RESPONSE--------')
+        return response
+
+    def _save_endicia_label_response(
+            self, response, account, extension, profile):
+        """
+        Record the label bought for the shipment and attach its images
+
+        :param account: Id of the endicia.account which bought the label
+        :param extension: File extension of the images
+        :return: Tracking number as string
+        """
+        Attachment = Pool().get('ir.attachment')
+        EndiciaConfiguration = Pool().get('endicia.configuration')
+
+        if response.values.get('PostageBalance'):
+            EndiciaConfiguration.update_postage_balance(
+                Decimal(response.values['PostageBalance']), account
+            )
+        profile.mark('postage_balance')
+
+        tracking_number = response.values['TrackingNumber']
+        self.__class__.write([self], {
+            'tracking_number': unicode(tracking_number),
+            'cost': Decimal(response.values['FinalPostage']),
+            'endicia_account': account,
+        })
+        self._update_endicia_bag(account)
+        profile.mark('write')
+
+        # Save images as attachments. Thermal printer formats are
+        # stored as sent by Endicia, ready to be sent to the printer.
+        attachments = []
+        for id, stored in response.images:
+            values = {
+                'name': "%s_%s_USPS-Endicia.%s" % (
+                    tracking_number, id, extension
+                ),
+                'resource': '%s,%s' % (self.__name__, self.id)
+            }
+            values.update(Attachment.get_stored_values(*stored))
+            attachments.append(values)
+        Attachment.create(attachments)
+        profile.mark('attachments')
+        return str(tracking_number)
+
+    @classmethod
+    def _get_endicia_address_errors(cls, address, domestic):
+        """
+        Returns the errors of an address labels are made for
+
+        :param domestic: True if the address is in the US
+        """
+        errors = []
+        name = address.rec_name
+        if domestic:
+            if not address.subdivision:
+                errors.append(('subdivision_missing', (name,)))
+            if not US_ZIP.match(address.zip or ''):
+                errors.append(('invalid_zip', (address.zip or '', name)))
+            elif get_zip_database():
+                known = get_zip_database().lookup(address.zip)
+                if not (known and known[2]):
+                    errors.append(('unknown_zip', (address.zip, name)))
+        elif len(address.zip or '') > MAX_INTERNATIONAL_ZIP:
+            errors.append((
+                'invalid_zip_length',
+                (address.zip, name, MAX_INTERNATIONAL_ZIP)
+            ))
+        return errors
+
+    def _get_endicia_errors(self):
+        """
+        Returns the errors which would make the label request of the
+        shipment fail, as a list of error names and arguments.
+
+        Downstream modules can override this to add their checks.
+        """
+        if self.state not in ('packed', 'done'):
+            return [('invalid_state', None)]
+        if not (
+            self.carrier and
+            self.carrier.carrier_cost_method == 'endicia'
+        ):
+            return [('wrong_carrier', None)]
+        if self.tracking_number:
+            return [('tracking_number_already_present', None)]
+
+        errors = []
+        if not self.endicia_mailclass:
+            errors.append(('mailclass_missing', None))
+        if self.endicia_label_subtype != 'None' and \
+                not self.endicia_integrated_form_type:
+            errors.append(('integrated_form_type_missing', None))
+
+        if not self.warehouse.address:
+            errors.append(('warehouse_address_required', None))
         else:
-            result = objectify_response(response)
+            errors.extend(self._get_endicia_address_errors(
+                self.warehouse.address, True
+            ))
+        to_address = self.delivery_address
+        if not to_address:
+            errors.append(('delivery_address_required', None))
+        else:
+            errors.extend(self._get_endicia_address_errors(
+                to_address,
+                not to_address.country or to_address.country.code == 'US'
+            ))
 
-            # Logging.
-            logger.debug('--------SHIPPING LABEL RESPONSE--------')
-            logger.debug(str(response))
-            logger.debug('--------END RESPONSE--------')
+        for move in self.outgoing_moves:
+            if move.quantity > 0 and move.product.customs_value_used is None:
+                errors.append(('customs_value_missing', (move.product.name,)))
+        return errors
 
-            tracking_number = result.TrackingNumber.pyval
-            self.__class__.write([self], {
-                'tracking_number': unicode(result.TrackingNumber.pyval),
-                'cost': Decimal(str(result.FinalPostage.pyval)),
-            })
+    @classmethod
+    def validate_endicia_shipments(cls, shipments):
+        """
+        Check locally, in one pass and without any request to Endicia,
+        that labels can be made for the shipments.
 
-            # Save images as attachments
-            images = get_images(result)
-            for (id, label) in images:
-                Attachment.create([{
-                    'name': "%s_%s_USPS-Endicia.png" % (tracking_number, id),
-                    'data': buffer(base64.decodestring(label)),
-                    'resource': '%s,%s' % (self.__name__, self.id)
-                }])
+        :return: Dictionary of the id of each invalid shipment, as a
+                 string so it can be marshalled by XML-RPC, and its list
+                 of (error name, message)
+        """
+        result = {}
+        # The shipments are browsed as one list, so their relations are
+        # read in one query for all of them
+        for shipment in cls.browse(map(int, shipments)):
+            errors = [
+                (error, cls.raise_user_error(
+                    error, error_args, raise_exception=False
+                ))
+                for error, error_args in shipment._get_endicia_errors()
+            ]
+            if errors:
+                result[str(shipment.id)] = errors
+        return result
 
-            return str(tracking_number)
+    @classmethod
+    def make_endicia_labels_batch(cls, shipments):
+        """
+        Make the labels of the valid shipments. The invalid shipments are
+        reported without any request being sent for them, so one invalid
+        shipment does not stop the batch.
+
+        :return: Tuple of the dictionary of shipment id and tracking
+                 number and the dictionary of shipment id and errors, as
+                 returned by `validate_endicia_shipments`. The ids are
+                 strings.
+        """
+        errors = cls.validate_endicia_shipments(shipments)
+        tracking_numbers = {}
+        for shipment in cls.browse(map(int, shipments)):
+            key = str(shipment.id)
+            if key in errors:
+                continue
+            try:
+                tracking_numbers[key] = shipment.make_endicia_labels()
+            except UserError, error:
+                errors[key] = [('error_label', error.message)]
+        return tracking_numbers, errors
 
     def _get_ship_from_address(self):
         """
@@ -370,7 +745,10 @@ class ShipmentOut:
         Carrier = Pool().get('carrier')
         EndiciaConfiguration = Pool().get('endicia.configuration')
 
-        endicia_credentials = EndiciaConfiguration(1).get_endicia_credentials()
+        profile = start_profile('calculate_postage', self)
+        endicia_credentials = EndiciaConfiguration(1).get_endicia_credentials(
+            self.warehouse
+        )
         carrier, = Carrier.search(['carrier_cost_method', '=', 'endicia'])
 
         if not self.endicia_mailclass:
@@ -391,18 +769,17 @@ class ShipmentOut:
         weight_oz = self.package_weight.quantize(
             Decimal('.1'), rounding=ROUND_UP
         )
-        calculate_postage_request = CalculatingPostageAPI(
-            mailclass=self.endicia_mailclass.value,
-            MailpieceShape=self.endicia_mailpiece_shape,
-            weightoz=weight_oz,
-            from_postal_code=from_address.zip and from_address.zip[:5],
-            to_postal_code=to_zip,
-            to_country_code=to_address.country and to_address.country.code,
-            accountid=endicia_credentials.account_id,
-            requesterid=endicia_credentials.requester_id,
-            passphrase=endicia_credentials.passphrase,
-            test=endicia_credentials.is_test,
-        )
+        calculate_postage_request = get_rate_template(
+            CalculatingPostageAPI, endicia_credentials,
+            from_address.zip and from_address.zip[:5]
+        ).new_request()
+        calculate_postage_request.add_data({
+            'MailClass': self.endicia_mailclass.value,
+            'WeightOz': weight_oz,
+            'ToPostalCode': to_zip,
+            'ToCountryCode': to_address.country and to_address.country.code,
+        })
+        profile.mark('build_request')
 
         # Logging.
         logger.debug(
@@ -410,29 +787,371 @@ class ShipmentOut:
             'Shipment ID: {0} and Carrier ID: {1}'
             .format(self.id, carrier.id)
         )
-        logger.debug('--------POSTAGE REQUEST--------')
-        logger.debug(str(calculate_postage_request.to_xml()))
-        logger.debug('--------END REQUEST--------')
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('--------POSTAGE REQUEST--------')
+            logger.debug(str(calculate_postage_request.to_xml()))
+            logger.debug('--------END REQUEST--------')
 
+        profile.restart()
         try:
-            response = calculate_postage_request.send_request()
+            response = send_request(
+                'calculate_postage', calculate_postage_request
+            )
         except RequestError, error:
             self.raise_user_error('error_label', error_args=(error,))
+        profile.mark('request')
 
         # Logging.
         logger.debug('--------POSTAGE RESPONSE--------')
         logger.debug(str(response))
         logger.debug('--------END RESPONSE--------')
 
-        return Decimal(
-            objectify_response(response).PostagePrice.get('TotalAmount')
+        result = objectify_response(response)
+        profile.mark('parse')
+        EndiciaConfiguration.record_postage_balance(
+            result, endicia_credentials.account
+        )
+        profile.mark('postage_balance')
+        profile.close()
+
+        return Decimal(result.PostagePrice.get('TotalAmount'))
+
+    @classmethod
+    def _get_endicia_label_attachments(cls, shipments):
+        """
+        Returns the label attachments of the shipments, searched by their
+        indexed resource
+        """
+        Attachment = Pool().get('ir.attachment')
+
+        # The underscore of the label names is a wildcard of LIKE, so the
+        # names are matched in full here
+        return [
+            attachment for attachment in Attachment.search([
+                ('resource', 'in', [
+                    '%s,%s' % (cls.__name__, shipment.id)
+                    for shipment in shipments
+                ]),
+                ('name', 'like', '%USPS-Endicia.%'),
+            ], order=[('name', 'ASC')])
+            if attachment.name.rsplit('.', 1)[0].endswith('_USPS-Endicia')
+        ]
+
+    @classmethod
+    def get_endicia_labels(cls, tracking_numbers):
+        """
+        Returns the label attachments of the shipments of the tracking
+        numbers, to reprint them or check their status. Both the tracking
+        numbers and the attachment resources are indexed.
+
+        :param tracking_numbers: List of tracking numbers
+        :return: Dictionary of tracking number and list of attachment ids
+        """
+        shipments = cls.search([
+            ('tracking_number', 'in', tracking_numbers),
+        ])
+        labels = dict((number, []) for number in tracking_numbers)
+        tracking_number = dict(
+            (shipment.id, shipment.tracking_number) for shipment in shipments
         )
+        for attachment in cls._get_endicia_label_attachments(shipments):
+            labels[tracking_number[attachment.resource.id]].append(
+                attachment.id
+            )
+        return labels
+
+    @classmethod
+    def write_endicia_label_document(cls, shipments, fileobj):
+        """
+        Write the labels of the shipments into one print document.
+
+        ZPL II and EPL2 labels are concatenated, PNG labels become the
+        pages of a PDF document. The labels of the other formats can not
+        be merged. Labels are read from the filestore and written one
+        chunk at a time.
+
+        :param shipments: List of shipment active records
+        :param fileobj: File object to write the document to
+        :return: File extension of the document
+        """
+        resources = [
+            '%s,%s' % (cls.__name__, shipment.id) for shipment in shipments
+        ]
+        attachments = cls._get_endicia_label_attachments(shipments)
+        if not attachments:
+            cls.raise_user_error('no_labels')
+
+        # Keep the order of the shipments
+        sequence = dict((resource, i) for i, resource in enumerate(resources))
+        attachments.sort(key=lambda a: sequence['%s,%s' % (
+            a.resource.__name__, a.resource.id
+        )])
+
+        extensions = set(a.name.rsplit('.', 1)[1] for a in attachments)
+        if len(extensions) > 1:
+            cls.raise_user_error('mixed_label_formats')
+        extension = extensions.pop()
+
+        if extension == 'png':
+            writer = PDFLabelWriter(fileobj)
+            extension = 'pdf'
+        elif extension in ('zpl', 'epl'):
+            writer = RawLabelWriter(fileobj)
+        else:
+            # PDF, GIF and JPEG labels are printed one by one
+            cls.raise_user_error(
+                'label_format_not_mergeable', error_args=(extension.upper(),)
+            )
+
+        try:
+            for attachment in attachments:
+                label = attachment.open_data()
+                try:
+                    writer.add_label(label)
+                finally:
+                    label.close()
+            writer.close()
+        except LabelDocumentError, error:
+            cls.raise_user_error('error_label_document', error_args=(error,))
+        return extension
+
+    @classmethod
+    def get_endicia_label_document(cls, shipments, resource=None):
+        """
+        Merge the labels of the shipments in one print document, written
+        to the filestore and attached to the resource. The attachment of
+        a previous document of the resource is replaced.
+
+        :param resource: Record the document is attached to, the first
+                         shipment if None
+        :return: Id of the ir.attachment of the document
+        """
+        Attachment = Pool().get('ir.attachment')
+
+        if not shipments:
+            cls.raise_user_error('no_labels')
+        if resource is None:
+            resource = shipments[0]
+
+        store = Attachment.open_file_store()
+        try:
+            extension = cls.write_endicia_label_document(shipments, store)
+        except Exception:
+            store.abort()
+            raise
+        values = Attachment.get_stored_values(*store.close())
+
+        values['resource'] = '%s,%s' % (resource.__name__, resource.id)
+        values['name'] = 'USPS-Endicia-Labels.%s' % extension
+        attachments = Attachment.search([
+            ('resource', '=', values['resource']),
+            ('name', '=', values['name']),
+        ], limit=1)
+        if attachments:
+            Attachment.write(attachments, values)
+        else:
+            attachments = Attachment.create([values])
+        return attachments[0].id
+
+    @classmethod
+    def refund_endicia_labels(cls, shipments):
+        """
+        Request refund for the labels of the given shipments in a single
+        refund request per Endicia account which bought them.
+
+        :param shipments: List of shipment active records
+        :return: List of tuples of (shipment, approved, message)
+        """
+        accounts = OrderedDict()
+        for shipment in shipments:
+            accounts.setdefault(shipment.endicia_account, []).append(shipment)
+
+        results = {}
+        for account, account_shipments in accounts.iteritems():
+            for result in cls._refund_endicia_labels(
+                    account_shipments, account):
+                results[result[0]] = result
+        return [results[shipment] for shipment in shipments]
 
-    def get_is_endicia_shipping(self, name):
+    @classmethod
+    def _refund_endicia_labels(cls, shipments, account=None):
         """
-        Check if shipping is from USPS
+        Request refund for the labels bought with the same account in a
+        single refund request.
+
+        :param account: endicia.account which bought the labels, the
+                        account of the configuration if None
         """
-        return self.carrier and self.carrier.carrier_cost_method == 'endicia'
+        EndiciaConfiguration = Pool().get('endicia.configuration')
+
+        if not shipments:
+            return []
+
+        # Getting the api credentials to be used in refund request generation
+        # endicia credentials are in the format :
+        # (account_id, requester_id, passphrase, is_test)
+        if account:
+            endicia_credentials = account.get_credentials()
+        else:
+            endicia_credentials = \
+                EndiciaConfiguration(1).get_configuration_credentials()
+
+        # PICNumber is the argument name expected by endicia in API,
+        # so its better to use the same name here for better understanding
+        pic_numbers = []
+        for shipment in shipments:
+            if not (
+                shipment.carrier and
+                shipment.carrier.carrier_cost_method == 'endicia'
+            ):
+                cls.raise_user_error('wrong_carrier')
+            if not shipment.tracking_number:
+                cls.raise_user_error(
+                    'tracking_number_missing', error_args=(shipment.rec_name,)
+                )
+            pic_numbers.append(shipment.tracking_number)
+
+        refund_request = RefundRequestAPI(
+            pic_numbers=pic_numbers,
+            accountid=endicia_credentials.account_id,
+            requesterid=endicia_credentials.requester_id,
+            passphrase=endicia_credentials.passphrase,
+            test=endicia_credentials.is_test and 'Y' or 'N',
+        )
+        try:
+            response = send_request('refund', refund_request)
+        except RequestError, error:
+            cls.raise_user_error('error_label', error_args=(error,))
+
+        result = objectify_response(response)
+
+        # Refund list is in the same order as the PIC numbers were sent
+        results = []
+        refund_list = result.RefundList.PICNumber
+        for shipment, pic_number in zip(shipments, refund_list):
+            results.append((
+                shipment,
+                str(pic_number.IsApproved) == 'YES',
+                unicode(pic_number.ErrorMsg),
+            ))
+
+        cls._save_endicia_refunds(results)
+        return results
+
+    @classmethod
+    def _save_endicia_refunds(cls, results):
+        """
+        Record on the shipments whether Endicia approved the refund of
+        their label, a rejected refund is not requested by the sweep again.
+
+        :param results: List of tuples of (shipment, approved, message)
+        """
+        approved = [shipment for shipment, ok, _ in results if ok]
+        rejected = [shipment for shipment, ok, _ in results if not ok]
+        if approved:
+            # If refund is approved, then set the state of record
+            # as cancel/refund
+            cls.write(approved, {
+                'endicia_refunded': True,
+                'endicia_refund_rejected': False,
+            })
+        if rejected:
+            cls.write(rejected, {'endicia_refund_rejected': True})
+
+    @classmethod
+    def _refund_endicia_batch(cls, shipments):
+        """
+        Refund the labels of a batch of the refund sweep.
+
+        On PostgreSQL each batch is refunded and committed with its own
+        cursor, so the refunds Endicia approved stay recorded when a later
+        batch fails or the sweep is interrupted.
+
+        :return: List of tuples of (approved, message) in the order of the
+                 shipments
+        """
+        if backend.name() != 'postgresql':
+            # The other backends lock the database for the transaction, so
+            # the batch is refunded in it
+            return [
+                result[1:] for result in cls.refund_endicia_labels(shipments)
+            ]
+        with Transaction().new_cursor() as transaction:
+            try:
+                results = [
+                    result[1:] for result in cls.refund_endicia_labels(
+                        cls.browse(map(int, shipments)))
+                ]
+                transaction.cursor.commit()
+            except Exception:
+                transaction.cursor.rollback()
+                raise
+        return results
+
+    @classmethod
+    def sweep_endicia_refunds(cls):
+        """
+        Refund unused labels of cancelled shipments.
+
+        This is called by a scheduled action. Only the shipments cancelled
+        since the watermark of the previous run are scanned, and their
+        labels are refunded in batches. The watermark stops before the
+        oldest shipment whose refund request failed, so it is requested
+        again by the next run. A refund Endicia rejected is recorded on the
+        shipment and not requested again.
+        """
+        EndiciaConfiguration = Pool().get('endicia.configuration')
+
+        config = EndiciaConfiguration(1)
+        until = datetime.utcnow() - timedelta(
+            days=config.refund_sweep_days or 0
+        )
+
+        domain = [
+            ('state', '=', 'cancel'),
+            ('tracking_number', '!=', None),
+            ('endicia_refunded', '=', False),
+            ('endicia_refund_rejected', '=', False),
+            ('is_endicia_shipping', '=', True),
+            ('write_date', '<=', until),
+        ]
+        if config.refund_sweep_watermark:
+            domain.append(('write_date', '>', config.refund_sweep_watermark))
+        shipments = cls.search(domain, order=[('write_date', 'ASC')])
+
+        unresolved = []
+        batch_size = config.refund_sweep_batch_size or 50
+        for index in xrange(0, len(shipments), batch_size):
+            batch = shipments[index:index + batch_size]
+            try:
+                results = cls._refund_endicia_batch(batch)
+            except (UserError, IOError), error:
+                # The request failed, Endicia did not answer for the labels
+                if isinstance(error, UserError):
+                    error = error.message
+                logger.warning(
+                    'Refund for shipments {0} failed: {1}'.format(
+                        [s.id for s in batch], error
+                    )
+                )
+                unresolved.extend(batch)
+                continue
+            for shipment, (approved, message) in zip(batch, results):
+                if not approved:
+                    logger.warning(
+                        'Refund for shipment {0} was not approved: {1}'
+                        .format(shipment.id, message)
+                    )
+
+        watermark = until
+        if unresolved:
+            # Just before the oldest unresolved shipment, which stays in
+            # the window of the next run
+            watermark = min(s.write_date for s in unresolved) - \
+                timedelta(microseconds=1)
+        EndiciaConfiguration.write([config], {
+            'refund_sweep_watermark': watermark,
+        })
 
 
 class EndiciaRefundRequestWizardView(ModelView):
@@ -475,18 +1194,8 @@ class EndiciaRefundRequestWizard(Wizard):
         and returns the response.
         """
         Shipment = Pool().get('stock.shipment.out')
-        EndiciaConfiguration = Pool().get('endicia.configuration')
-
-        # Getting the api credentials to be used in refund request generation
-        # endicia credentials are in the format :
-        # (account_id, requester_id, passphrase, is_test)
-        endicia_credentials = EndiciaConfiguration(1).get_endicia_credentials()
 
         shipments = Shipment.browse(Transaction().context['active_ids'])
-
-        # PICNumber is the argument name expected by endicia in API,
-        # so its better to use the same name here for better understanding
-        pic_numbers = []
         for shipment in shipments:
             if not (
                 shipment.carrier and
@@ -494,35 +1203,12 @@ class EndiciaRefundRequestWizard(Wizard):
             ):
                 self.raise_user_error('wrong_carrier')
 
-            pic_numbers.append(shipment.tracking_number)
-
-        test = endicia_credentials.is_test and 'Y' or 'N'
-
-        refund_request = RefundRequestAPI(
-            pic_numbers=pic_numbers,
-            accountid=endicia_credentials.account_id,
-            requesterid=endicia_credentials.requester_id,
-            passphrase=endicia_credentials.passphrase,
-            test=test,
-        )
-        try:
-            response = refund_request.send_request()
-        except RequestError, error:
-            self.raise_user_error('error_label', error_args=(error,))
-
-        result = objectify_response(response)
-        if str(result.RefundList.PICNumber.IsApproved) == 'YES':
-            refund_approved = True
-            # If refund is approved, then set the state of record
-            # as cancel/refund
-            shipment.__class__.write(
-                [shipment], {'endicia_refunded': True}
-            )
-        else:
-            refund_approved = False
+        results = Shipment.refund_endicia_labels(shipments)
         default = {
-            'refund_status': unicode(result.RefundList.PICNumber.ErrorMsg),
-            'refund_approved': refund_approved
+            'refund_status': u'\n'.join(
+                message for _, _, message in results
+            ),
+            'refund_approved': all(approved for _, approved, _ in results),
         }
         return default
 
@@ -562,27 +1248,13 @@ class BuyPostageWizard(Wizard):
 
     def default_buy_postage(self, data):
         """
-        Generate the SCAN Form for the current shipment record
+        Buy postage for the endicia account
         """
         EndiciaConfiguration = Pool().get('endicia.configuration')
 
         default = {}
-        endicia_credentials = EndiciaConfiguration(1).get_endicia_credentials()
+        result = EndiciaConfiguration(1).buy_postage(self.start.amount)
 
-        buy_postage_api = BuyingPostageAPI(
-            request_id=Transaction().user,
-            recredit_amount=self.start.amount,
-            requesterid=endicia_credentials.requester_id,
-            accountid=endicia_credentials.account_id,
-            passphrase=endicia_credentials.passphrase,
-            test=endicia_credentials.is_test,
-        )
-        try:
-            response = buy_postage_api.send_request()
-        except RequestError, error:
-            self.raise_user_error('error_label', error_args=(error,))
-
-        result = objectify_response(response)
         default['company'] = self.start.company
         default['amount'] = self.start.amount
         default['response'] = str(result.ErrorMessage) \
@@ -590,6 +1262,37 @@ class BuyPostageWizard(Wizard):
         return default
 
 
+class EndiciaLabelDocument(Wizard):
+    '''
+    Merge the labels of the selected shipments or shipment bags in one
+    print document and open its attachment
+    '''
+    __name__ = 'endicia.label.document'
+
+    start = StateAction('ir.act_attachment_form')
+
+    def do_start(self, action):
+        Shipment = Pool().get('stock.shipment.out')
+        ShipmentBag = Pool().get('endicia.shipment.bag')
+
+        context = Transaction().context
+        if context.get('active_model') == ShipmentBag.__name__:
+            attachment_id = ShipmentBag.get_endicia_label_document(
+                ShipmentBag.browse(context['active_ids'])
+            )
+        else:
+            attachment_id = Shipment.get_endicia_label_document(
+                Shipment.browse(context['active_ids'])
+            )
+
+        # The client downloads the document from the filestore through the
+        # attachment, so it is not read by the wizard
+        action['pyson_domain'] = PYSONEncoder().encode([
+            ('id', '=', attachment_id),
+        ])
+        return action, {}
+
+
 class ShippingEndicia(ModelView):
     'Endicia Configuration'
     __name__ = 'shipping.label.endicia'
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+    template.py
+
+    Precompiled Endicia requests. Most of a request is the same on every
+    call of a warehouse, label profile and account: the credentials, the
+    label options and the from address. A template serializes that part
+    once, and each request is a copy of it in which only the variable
+    elements are written.
+
+    The XML of a request made from a template is the same as the one the
+    API writes itself.
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import copy
+from bisect import bisect_left, bisect_right
+from functools import partial
+
+from lxml import etree
+from endicia.tools import transform_to_xml
+
+from trytond.cache import Cache
+
+from .metrics import registry
+
+__all__ = ['RequestTemplate', 'get_rate_template']
+
+# Elements the APIs write before and after their valid elements
+HEAD_ELEMENTS = {
+    'CalculatingPostageAPI': ['RequesterID', 'CertifiedIntermediary'],
+    'PostageRatesAPI': ['RequesterID', 'CertifiedIntermediary'],
+}
+TAIL_ELEMENTS = {
+    'CalculatingPostageAPI': ['ResponseOptions'],
+}
+
+# Elements the APIs do not write when they are empty
+SKIP_EMPTY_APIS = ('ShippingLabelAPI',)
+
+MISSING = object()
+
+
+class RequestTemplate(object):
+    """
+    Request of an Endicia API with its fixed data serialized
+
+    :param api: Instance of the API with the data shared by the requests
+    """
+
+    def __init__(self, api):
+        api_name = api.__class__.__name__
+        self.api = api
+        self.skip_empty = api_name in SKIP_EMPTY_APIS
+        self.root = api.to_xml(as_string=False)
+        self.tags = dict(
+            (element.lower(), element) for element in api.valid_elements
+        )
+        self.order = {}
+        for index, element in enumerate(api.valid_elements):
+            self.order.setdefault(element, index)
+
+        # Rank of the elements of the tree in the order the API writes them
+        head = len(HEAD_ELEMENTS.get(api_name, []))
+        tail = len(TAIL_ELEMENTS.get(api_name, []))
+        children = list(self.root)
+        self.ranks = [-1] * head + [
+            self.order[child.tag]
+            for child in children[head:len(children) - tail]
+        ] + [len(api.valid_elements)] * tail
+
+        fixed = api.__dict__
+        # Data of the requests changed in place, copied for each request
+        self.mutable = [
+            name for name in self.tags
+            if isinstance(fixed.get(name), (dict, list))
+        ]
+        # Elements of the fixed data in the tree
+        self.written = set(
+            name for name in self.tags
+            if name in fixed and self._is_written(fixed[name])
+        )
+
+    def new_request(self):
+        """
+        Returns a request of the API with the fixed data, to which the
+        variable data is added with `add_data`
+        """
+        request = copy.copy(self.api)
+        for name in self.mutable:
+            setattr(request, name, copy.copy(getattr(request, name)))
+        request.flags = dict(self.api.flags)
+        request.to_xml = partial(self.to_xml, request)
+        return request
+
+    def _is_written(self, value):
+        if not self.skip_empty:
+            return True
+        if not value:
+            return False
+        return not (type(value) == dict and not any(value.values()))
+
+    def to_xml(self, request, as_string=True):
+        """
+        Returns the XML of a request of the template, as the API writes it
+        """
+        fixed = self.api.__dict__
+        root = copy.deepcopy(self.root)
+        ranks = list(self.ranks)
+        label_request = getattr(request, 'labelrequest', None)
+        if label_request is not fixed.get('labelrequest'):
+            root.attrib.clear()
+            for name, value in label_request.data.iteritems():
+                root.set(name, value)
+        for name, value in request.__dict__.iteritems():
+            element = self.tags.get(name)
+            if element is None or fixed.get(name, MISSING) == value:
+                continue
+            rank = self.order[element]
+            if name in self.written:
+                # Remove the element of the fixed value
+                index = bisect_left(ranks, rank)
+                root.remove(root[index])
+                del ranks[index]
+            if not self._is_written(value):
+                continue
+            child = transform_to_xml(root, value, element)
+            index = bisect_right(ranks, rank)
+            root.insert(index, child)
+            ranks.insert(index, rank)
+        if as_string:
+            return etree.tostring(root, pretty_print=True)
+        return root
+
+
+# Rate request templates per API, account and from postal code
+_rate_templates = Cache('endicia.rate_templates', context=False)
+
+
+def get_rate_template(API, endicia_credentials, from_postal_code):
+    """
+    Returns the template of the rate requests of the API sent with the
+    credentials from the postal code, made once.
+
+    :param API: CalculatingPostageAPI or PostageRatesAPI
+    """
+    key = (API.__name__, tuple(endicia_credentials), from_postal_code)
+    template = _rate_templates.get(key)
+    registry.record_cache('rate_template', template is not None)
+    if template is None:
+        template = _rate_templates.set(key, RequestTemplate(API(
+            mailclass=None,
+            weightoz=None,
+            from_postal_code=from_postal_code,
+            to_postal_code=None,
+            to_country_code=None,
+            accountid=endicia_credentials.account_id,
+            requesterid=endicia_credentials.requester_id,
+            passphrase=endicia_credentials.passphrase,
+            test=endicia_credentials.is_test,
+        )))
+    return template
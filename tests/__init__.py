@@ -11,6 +11,9 @@ import trytond.tests.test_tryton
 from test_endicia import TestUSPSEndicia
 from test_carrier import CarrierTestCase
 from test_stock import ShipmentTestCase
+from test_label_document import LabelDocumentTestCase
+from test_response import ResponseTestCase
+from test_zip_database import ZipDatabaseTestCase
 
 
 def suite():
@@ -21,7 +24,10 @@ def suite():
     test_suite.addTests([
         unittest.TestLoader().loadTestsFromTestCase(TestUSPSEndicia),
         unittest.TestLoader().loadTestsFromTestCase(ShipmentTestCase),
-        unittest.TestLoader().loadTestsFromTestCase(CarrierTestCase)
+        unittest.TestLoader().loadTestsFromTestCase(CarrierTestCase),
+        unittest.TestLoader().loadTestsFromTestCase(LabelDocumentTestCase),
+        unittest.TestLoader().loadTestsFromTestCase(ResponseTestCase),
+        unittest.TestLoader().loadTestsFromTestCase(ZipDatabaseTestCase),
     ])
     return test_suite
 
@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmark
+
+    Benchmarks of the main Endicia flows, run end to end against the local
+    Endicia stand-in.
+
+    Each flow reports its wall time, the number of SQL queries and the
+    peak memory growth. Results are saved as a JSON baseline and later
+    runs are compared with it::
+
+        DB_NAME=:memory: python -m tests.benchmark --save baseline.json
+        DB_NAME=:memory: python -m tests.benchmark --compare baseline.json
+
+    Labels are made concurrently only on PostgreSQL, as each thread needs
+    its own connection. That flow commits its records, so run it on a
+    database created for the benchmark.
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+"""
+import sys
+import json
+import time
+import platform
+import resource
+import argparse
+import threading
+from decimal import Decimal
+from datetime import datetime
+from contextlib import contextmanager
+
+from trytond.tests.test_tryton import POOL, DB_NAME, USER, CONTEXT
+from trytond.transaction import Transaction
+from trytond import backend
+
+from trytond.modules.endicia_integration.tests.test_endicia import \
+    BaseTestCase
+from trytond.modules.endicia_integration.tests.query_count import \
+    QueryCounter
+
+# Metrics compared with the baseline, a higher value is a regression
+COMPARED = ('wall_time', 'queries', 'peak_memory')
+
+
+def read_memory(field):
+    """
+    Returns a memory size of /proc/self/status in bytes
+    """
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def reset_peak_memory():
+    """
+    Reset the peak resident set size of the process, where supported
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except IOError:
+        pass
+
+
+class Benchmark(BaseTestCase):
+    """
+    Run the flows and collect their results
+    """
+
+    def __init__(self, options):
+        super(Benchmark, self).__init__()
+        self.options = options
+        self.results = {}
+
+    def runTest(self):
+        pass
+
+    @contextmanager
+    def measure(self, flow, items, counters=None):
+        """
+        Measure the block running the flow on a number of items.
+
+        :param counters: List to which the query counters of other
+                         threads are added, the query counter of the
+                         current transaction is used otherwise.
+        """
+        reset_peak_memory()
+        memory = read_memory('VmRSS')
+        start = time.time()
+        if counters is None:
+            counters = [QueryCounter()]
+            with counters[0]:
+                yield
+        else:
+            yield
+        wall_time = time.time() - start
+
+        self.results[flow] = {
+            'items': items,
+            'wall_time': wall_time,
+            'throughput': items / wall_time if wall_time else None,
+            'queries': sum(counter.count for counter in counters),
+            'peak_memory': max(read_memory('VmHWM') - memory, 0),
+        }
+        print >> sys.stderr, '%-24s %6d items %9.3fs %8d queries' % (
+            flow, items, wall_time, self.results[flow]['queries']
+        )
+
+    def create_sales(self, count):
+        """
+        Create draft sales with one line
+        """
+        Sale = POOL.get('sale.sale')
+        Location = POOL.get('stock.location')
+
+        address = self.sale_party.addresses[0]
+        sales = Sale.create([{
+            'reference': 'S-%s' % index,
+            'payment_term': self.payment_term,
+            'party': self.sale_party.id,
+            'invoice_address': address.id,
+            'shipment_address': address.id,
+            'carrier': self.carrier.id,
+            'lines': [('create', [{
+                'type': 'line',
+                'quantity': 3,
+                'product': self.product,
+                'unit_price': Decimal('10.00'),
+                'description': 'Test Description1',
+                'unit': self.product.template.default_uom,
+            }])],
+        } for index in xrange(count)])
+        Location.write([sales[0].warehouse], {
+            'address': self.company.party.addresses[0].id,
+        })
+        return sales
+
+    def create_packed_shipments(self, count):
+        """
+        Create packed shipments from processed sales
+        """
+        Sale = POOL.get('sale.sale')
+        ShipmentOut = POOL.get('stock.shipment.out')
+
+        sales = self.create_sales(count)
+        Sale.quote(sales)
+        Sale.confirm(sales)
+        Sale.process(sales)
+        shipments = ShipmentOut.search([('state', '=', 'waiting')])
+        ShipmentOut.assign(shipments)
+        ShipmentOut.pack(shipments)
+        return shipments
+
+    @contextmanager
+    def flow(self):
+        """
+        Run a flow in a transaction which is rolled back
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            with Transaction().set_context(company=self.company.id):
+                yield
+
+    def bench_quote(self):
+        Sale = POOL.get('sale.sale')
+
+        with self.flow():
+            sales = self.create_sales(self.options.sales)
+            with self.measure('quote', len(sales)):
+                Sale.quote(sales)
+
+    def bench_rates(self):
+        with self.flow():
+            sale, = self.create_sales(1)
+            with self.measure('shipping_rates', self.options.rates):
+                for _ in xrange(self.options.rates):
+                    sale.get_endicia_shipping_rates()
+
+    def bench_done(self):
+        ShipmentOut = POOL.get('stock.shipment.out')
+
+        with self.flow():
+            shipments = self.create_packed_shipments(self.options.sales)
+            with self.measure('done', len(shipments)):
+                ShipmentOut.done(shipments)
+
+    def bench_labels(self):
+        with self.flow():
+            shipments = self.create_packed_shipments(self.options.labels)
+            with self.measure('labels_c1', len(shipments)):
+                for shipment in shipments:
+                    shipment.make_endicia_labels()
+
+    def bench_close_bag(self):
+        ShipmentOut = POOL.get('stock.shipment.out')
+        Bag = POOL.get('endicia.shipment.bag')
+
+        with self.flow():
+            bag = Bag.get_bag()
+            address = self.sale_party.addresses[0]
+            ShipmentOut.create([{
+                'customer': self.sale_party.id,
+                'delivery_address': address.id,
+                'carrier': self.carrier.id,
+                'cost_currency': self.currency.id,
+                'state': 'done',
+                'tracking_number': '94001118992%011d' % index,
+                'endicia_shipment_bag': bag.id,
+            } for index in xrange(self.options.bag_size)])
+            with self.measure('close_bag', self.options.bag_size):
+                Bag.close([bag])
+
+    def bench_concurrent_labels(self, concurrency):
+        """
+        Make labels from several threads, each with its transaction
+        """
+        ShipmentOut = POOL.get('stock.shipment.out')
+
+        flow = 'labels_c%s' % concurrency
+        if backend.name() == 'sqlite':
+            self.results[flow] = {
+                'skipped': 'needs a database with several connections',
+            }
+            return
+
+        count = self.options.labels * concurrency
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            with Transaction().set_context(company=self.company.id):
+                shipment_ids = map(int, self.create_packed_shipments(count))
+            company_id = self.company.id
+            Transaction().cursor.commit()
+
+        counters = []
+        errors = []
+
+        def make_labels(ids):
+            counter = QueryCounter()
+            counters.append(counter)
+            context = dict(CONTEXT, company=company_id)
+            try:
+                for shipment_id in ids:
+                    with Transaction().start(DB_NAME, USER, context=context):
+                        with counter:
+                            ShipmentOut(shipment_id).make_endicia_labels()
+                        Transaction().cursor.commit()
+            except Exception, error:
+                errors.append(error)
+
+        threads = [
+            threading.Thread(
+                target=make_labels, args=(shipment_ids[index::concurrency],)
+            ) for index in xrange(concurrency)
+        ]
+        with self.measure(flow, count, counters):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        if errors:
+            raise errors[0]
+
+    def run_all(self):
+        self.setUp()
+        self.endicia_server.latency = self.options.latency
+        self.bench_quote()
+        self.bench_rates()
+        self.bench_done()
+        self.bench_labels()
+        self.bench_close_bag()
+        for concurrency in self.options.concurrency:
+            if concurrency > 1:
+                self.bench_concurrent_labels(concurrency)
+        return {
+            'date': datetime.utcnow().isoformat(),
+            'backend': backend.name(),
+            'python': platform.python_version(),
+            'latency': self.options.latency,
+            'flows': self.results,
+        }
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print the flows slower or bigger than the baseline
+
+    :return: True if there is no regression
+    """
+    success = True
+    for flow, values in sorted(results['flows'].iteritems()):
+        reference = baseline['flows'].get(flow)
+        if not reference or 'skipped' in values or 'skipped' in reference:
+            continue
+        for metric in COMPARED:
+            # Compare per item as the number of items may differ
+            value = float(values[metric]) / values['items']
+            limit = float(reference[metric]) / reference['items']
+            if value > limit * (1 + tolerance) and values[metric]:
+                success = False
+                print >> sys.stderr, 'REGRESSION %s %s: %.6g > %.6g' % (
+                    flow, metric, value, limit
+                )
+    return success
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark Endicia flows')
+    parser.add_argument('--save', help='file to save the results to')
+    parser.add_argument('--compare', help='baseline file to compare with')
+    parser.add_argument(
+        '--tolerance', type=float, default=0.25,
+        help='allowed increase over the baseline, per item')
+    parser.add_argument('--sales', type=int, default=20)
+    parser.add_argument('--rates', type=int, default=10)
+    parser.add_argument('--labels', type=int, default=20)
+    parser.add_argument('--bag-size', type=int, default=10000)
+    parser.add_argument(
+        '--concurrency', default='1,10,100',
+        type=lambda value: map(int, value.split(',')))
+    parser.add_argument(
+        '--latency', type=float, default=0,
+        help='seconds the Endicia stand-in delays each response')
+    options = parser.parse_args()
+
+    results = Benchmark(options).run_all()
+    if options.save:
+        with open(options.save, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+    if options.compare:
+        with open(options.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        if not compare(results, baseline, options.tolerance):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+    query_count
+
+    Count the SQL queries of a transaction and show their plans.
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+"""
+from trytond import backend
+from trytond.transaction import Transaction
+
+
+class QueryCounter(object):
+    """
+    Context manager counting the SQL queries executed by the cursor of
+    the current transaction::
+
+        with QueryCounter() as counter:
+            shipment.make_endicia_labels()
+        print counter.count
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.queries = []
+        self.cursor = None
+
+    def __enter__(self):
+        self.cursor = Transaction().cursor
+        execute = self.cursor.execute
+
+        def counting_execute(sql, *args, **kwargs):
+            self.count += 1
+            self.queries.append((sql, args[0] if args else None))
+            return execute(sql, *args, **kwargs)
+
+        self.cursor.execute = counting_execute
+        return self
+
+    def __exit__(self, type, value, traceback):
+        del self.cursor.execute
+
+
+def query_plan(query):
+    """
+    Returns the plan of a python-sql query, or of a tuple of SQL and
+    parameters, as one string. On PostgreSQL sequential scans are
+    disabled, as the tables of the tests are too small for an index to be
+    cheaper. On SQLite the EXPLAIN commits the transaction, so the plans
+    must be read before the test writes.
+    """
+    cursor = Transaction().cursor
+    sql, params = tuple(query)
+    params = params or ()
+    if backend.name() == 'sqlite':
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        return '\n'.join(str(row[-1]) for row in cursor.fetchall())
+    cursor.execute('SET LOCAL enable_seqscan = off')
+    cursor.execute('EXPLAIN ' + sql, params)
+    return '\n'.join(row[0] for row in cursor.fetchall())
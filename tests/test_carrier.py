@@ -12,7 +12,8 @@ from decimal import Decimal
 
 from trytond.tests.test_tryton import DB_NAME, USER, CONTEXT
 from trytond.transaction import Transaction
-from tests.test_endicia import BaseTestCase
+from trytond.modules.endicia_integration.tests.test_endicia import \
+    BaseTestCase
 
 
 class CarrierTestCase(BaseTestCase):
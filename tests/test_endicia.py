@@ -8,19 +8,56 @@
     :license: GPLv3, see LICENSE for more details.
 """
 from decimal import Decimal
+import os
+import base64
+import shutil
+import tempfile
+import threading
 from time import time
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
 import unittest
+import xmlrpclib
+
+from endicia import ShippingLabelAPI, LabelRequest, FromAddress, ToAddress, \
+    Element, CalculatingPostageAPI, PostageRatesAPI
 
 import trytond.tests.test_tryton
+from trytond import backend
 from trytond.tests.test_tryton import POOL, DB_NAME, USER, CONTEXT, \
     test_view, test_depends
 from trytond.transaction import Transaction
+from trytond.pyson import PYSONDecoder
 from trytond.config import config
 from trytond.error import UserError
+from trytond.modules.endicia_integration.fake_server import EndiciaServer
+from trytond.modules.endicia_integration.transport import AccountSlots, \
+    slots
+from trytond.modules.endicia_integration.rate_limit import TokenBucket, \
+    RateLimiter, set_account_rate
+from trytond.modules.endicia_integration.template import RequestTemplate
+from trytond.modules.endicia_integration.tests.query_count import \
+    QueryCounter, query_plan
 config.set('database', 'path', '/tmp')
 
+ENDICIA_SERVER = None
+
+
+def start_endicia_server():
+    """
+    Send the requests to a local Endicia stand-in, unless the tests are
+    asked to use the Endicia test server with ENDICIA_LIVE_TESTS.
+    """
+    global ENDICIA_SERVER
+
+    if os.environ.get('ENDICIA_LIVE_TESTS') or ENDICIA_SERVER:
+        return ENDICIA_SERVER
+    ENDICIA_SERVER = EndiciaServer().start()
+    if not config.has_section('endicia'):
+        config.add_section('endicia')
+    config.set('endicia', 'url', ENDICIA_SERVER.url)
+    return ENDICIA_SERVER
+
 
 class BaseTestCase(unittest.TestCase):
     """
@@ -28,6 +65,7 @@ class BaseTestCase(unittest.TestCase):
     """
     def setUp(self):
         trytond.tests.test_tryton.install_module('endicia_integration')
+        self.endicia_server = start_endicia_server()
         self.Sale = POOL.get('sale.sale')
         self.SaleConfig = POOL.get('sale.configuration')
         self.EndiciaMailclass = POOL.get('endicia.mailclass')
@@ -157,6 +195,12 @@ class BaseTestCase(unittest.TestCase):
     def setup_defaults(self):
         """Method to setup defaults
         """
+        # The records of the tests are rolled back, but the Endicia values
+        # cached for them would be used by the next tests
+        self.Country.clear_endicia_cache()
+        POOL.get('endicia.account').clear_endicia_cache()
+        self.SaleConfig.clear_endicia_cache()
+
         # Create currency
         self.currency, = self.Currency.create([{
             'name': 'United Stated Dollar',
@@ -389,6 +433,27 @@ class BaseTestCase(unittest.TestCase):
 
             return sale
 
+    def create_products(self, count):
+        """
+        Create products like the default product
+        """
+        template = self.product.template
+        templates = self.Template.create([{
+            'name': 'Test Product %s' % index,
+            'category': template.category.id,
+            'type': 'goods',
+            'salable': True,
+            'sale_uom': template.sale_uom.id,
+            'list_price': Decimal('10.896'),
+            'cost_price': Decimal('5.896'),
+            'default_uom': template.default_uom.id,
+            'account_revenue': template.account_revenue.id,
+            'weight': .1,
+            'weight_uom': template.weight_uom.id,
+            'products': [('create', self.Template.default_products())]
+        } for index in xrange(count)])
+        return [t.products[0] for t in templates]
+
 
 class TestUSPSEndicia(BaseTestCase):
     """
@@ -606,6 +671,12 @@ class TestUSPSEndicia(BaseTestCase):
             bag = bags[0]
             self.assertFalse(bag.submission_id)
             self.assertEqual(len(bag.shipments), 2)
+
+            # The shipments already in a bag are found with one query
+            with QueryCounter() as counter:
+                ShipmentOut.add_to_endicia_bag(shipments)
+            self.assertEqual(counter.count, 1)
+
             EndiciaShipmentBag.close([bag])
             self.assertTrue(bag.submission_id)
 
@@ -795,6 +866,1302 @@ class TestUSPSEndicia(BaseTestCase):
                 ], count=True) > 0
             )
 
+    def test_0045_postage_balance(self):
+        """
+        Test that postage balance is recorded and recredit is flagged
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.EndiciaConfiguration.create([{
+                'account_id': '123456',
+                'requester_id': '123456',
+                'passphrase': 'PassPhrase',
+                'is_test': True,
+                'postage_low_balance': Decimal('100'),
+                'postage_recredit_amount': Decimal('500'),
+            }])
+
+            self.EndiciaConfiguration.update_postage_balance(Decimal('250'))
+
+            config = self.EndiciaConfiguration(1)
+            self.assertEqual(config.postage_balance, Decimal('250'))
+            self.assertTrue(config.postage_balance_date)
+            self.assertFalse(config.postage_recredit_pending)
+
+            # Balance falls below the threshold
+            self.EndiciaConfiguration.update_postage_balance(Decimal('75.5'))
+
+            config = self.EndiciaConfiguration(1)
+            self.assertEqual(config.postage_balance, Decimal('75.5'))
+            self.assertTrue(config.postage_recredit_pending)
+
+    def test_0050_attachment_from_base64(self):
+        """
+        Test that base64 images are stored once in the filestore
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            image = 'PNG image data ' * 1000
+            encoded = base64.encodestring(image)
+            mailclass, = self.EndiciaMailclass.search([
+                ('value', '=', 'First')
+            ])
+            resource = '%s,%s' % (mailclass.__name__, mailclass.id)
+
+            vlist = []
+            # Data is written to the store in chunks of any length
+            for name, chunks in [
+                    ('label1.png', [encoded]),
+                    ('label2.png', [encoded[:1001], encoded[1001:]])]:
+                store = self.IrAttachment.open_base64_store()
+                for chunk in chunks:
+                    store.write(chunk)
+                values = {
+                    'name': name,
+                    'resource': resource,
+                }
+                values.update(
+                    self.IrAttachment.get_stored_values(*store.close())
+                )
+                vlist.append(values)
+            attachment1, attachment2 = self.IrAttachment.create(vlist)
+
+            self.assertEqual(str(attachment1.data), image)
+            self.assertEqual(str(attachment2.data), image)
+            self.assertTrue(attachment1.digest)
+            self.assertEqual(attachment1.digest, attachment2.digest)
+
+    def test_0055_label_profile(self):
+        """
+        Test the label request options of a label profile
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            LabelProfile = POOL.get('endicia.label.profile')
+
+            profile, = LabelProfile.create([{
+                'name': 'Zebra',
+                'image_format': 'ZPLII',
+                'label_size': '4x6',
+                'image_rotation': 'None',
+            }])
+
+            self.assertEqual(profile.get_label_request_options(), {
+                'ImageFormat': 'ZPLII',
+                'LabelSize': '4x6',
+                'ImageResolution': '203',
+                'ImageRotation': 'None',
+            })
+
+    def test_0060_metrics(self):
+        """
+        Test the export of the metrics of the Endicia APIs
+        """
+        from trytond.modules.endicia_integration.metrics import registry
+
+        registry.reset()
+        registry.observe('label', 0.3, 2048, '0')
+        registry.observe('label', 0.7, 512, '0')
+        registry.observe('label', 12, None, '12345')
+        registry.record_cache('calculate_postage', True)
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            metrics = self.EndiciaConfiguration.get_endicia_metrics()
+            self.assertEqual(metrics['label']['latency']['count'], 3)
+            self.assertEqual(metrics['label']['size']['count'], 2)
+            self.assertEqual(
+                metrics['label']['requests'], {'0': 2, '12345': 1}
+            )
+            self.assertTrue(0.5 < metrics['label']['latency']['p50'] <= 1)
+            self.assertEqual(
+                metrics['calculate_postage']['cache'], {'hit': 1, 'miss': 0}
+            )
+
+            text = self.EndiciaConfiguration.get_endicia_metrics_text()
+            self.assertIn(
+                'endicia_request_duration_seconds_bucket'
+                '{api="label",le="0.5"} 1', text
+            )
+            self.assertIn(
+                'endicia_request_duration_seconds_bucket'
+                '{api="label",le="+Inf"} 3', text
+            )
+            self.assertIn(
+                'endicia_requests_total{api="label",code="12345"} 1', text
+            )
+        registry.reset()
+
+    def test_0065_profile(self):
+        """
+        Test that the phases of calls are timed only when asked for
+        """
+        from trytond.modules.endicia_integration.metrics import registry, \
+            start_profile, NULL_PROFILE
+
+        registry.reset()
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.assertIs(start_profile('label', None), NULL_PROFILE)
+
+            with Transaction().set_context(endicia_profile=True):
+                profile = start_profile('label', None)
+            profile.mark('to_xml')
+            profile.add('network', 0.2)
+            profile.add('network', 0.2)
+            profile.restart()
+            profile.mark('write')
+            profile.close()
+
+            self.assertEqual(
+                profile.timings.keys(), ['to_xml', 'network', 'write']
+            )
+            phases = registry.to_dict()['label']['phases']
+            self.assertEqual(phases['network']['count'], 1)
+            self.assertAlmostEqual(phases['network']['sum'], 0.4)
+        registry.reset()
+
+    def test_0070_endicia_errors(self):
+        """
+        Test that errors of Endicia are reported to the user
+        """
+        if self.endicia_server is None:
+            # Errors cannot be injected in the Endicia test server
+            return
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            shipment, = self.StockShipmentOut.search([])
+            self.StockShipmentOut.write([shipment], {
+                'code': str(int(time())),
+            })
+            shipment.assign([shipment])
+            shipment.pack([shipment])
+
+            self.endicia_server.error_rate = 1
+            try:
+                with Transaction().set_context(company=self.company.id):
+                    self.assertRaises(
+                        UserError, shipment.make_endicia_labels
+                    )
+            finally:
+                self.endicia_server.error_rate = 0
+
+            self.assertFalse(shipment.tracking_number)
+            self.assertEqual(self.endicia_server.operations[-1], 'label')
+
+    def test_0075_query_count(self):
+        """
+        Test that the queries of the rate and label flows do not grow with
+        the number of lines.
+        """
+        # Upper bounds of the queries of each flow
+        bounds = {
+            'rates': 8,
+            'item_details': 5,
+            'label': 40,
+        }
+
+        def count_queries(lines):
+            """
+            Returns the queries of each flow for a sale of the given number
+            of lines
+            """
+            counts = {}
+            sale, = self.Sale.create([{
+                'reference': 'S-%s' % lines,
+                'payment_term': self.payment_term,
+                'party': self.sale_party.id,
+                'invoice_address': self.sale_party.addresses[0].id,
+                'shipment_address': self.sale_party.addresses[0].id,
+                'carrier': self.carrier.id,
+                'lines': [('create', [{
+                    'type': 'line',
+                    'quantity': 2,
+                    'product': product.id,
+                    'unit_price': Decimal('10.00'),
+                    'description': product.name,
+                    'unit': product.default_uom.id,
+                } for product in self.create_products(lines)])]
+            }])
+
+            sale = self.Sale(sale.id)
+            with QueryCounter() as counter:
+                rates = sale.get_endicia_shipping_rates()
+            self.assertTrue(len(rates) > 1)
+            counts['rates'] = counter.count
+
+            self.Sale.quote([sale])
+            self.Sale.confirm([sale])
+            self.Sale.process([sale])
+            shipment, = self.Sale(sale.id).shipments
+            self.StockShipmentOut.assign([shipment])
+            self.StockShipmentOut.pack([shipment])
+
+            shipment = self.StockShipmentOut(shipment.id)
+            self.assertEqual(len(shipment.outgoing_moves), lines)
+            request = ShippingLabelAPI(
+                label_request=LabelRequest(), weight_oz=1,
+                partner_customer_id=1, partner_transaction_id=1,
+                mail_class='First', accountid='123456',
+                requesterid='123456', passphrase='PassPhrase', test=True,
+            )
+            with QueryCounter() as counter:
+                shipment._update_endicia_item_details(request)
+            counts['item_details'] = counter.count
+
+            shipment = self.StockShipmentOut(shipment.id)
+            with QueryCounter() as counter:
+                shipment.make_endicia_labels()
+            counts['label'] = counter.count
+            return counts
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context(company=self.company.id):
+                # The first sale warms the caches of the server
+                count_queries(1)
+                one_line = count_queries(1)
+                many_lines = count_queries(20)
+
+            for flow, bound in bounds.iteritems():
+                self.assertLessEqual(many_lines[flow], bound, flow)
+                self.assertLessEqual(
+                    many_lines[flow], one_line[flow], flow
+                )
+
+    def test_0080_cassette(self):
+        """
+        Test that the calls recorded in a cassette are replayed
+        """
+        from trytond.modules.endicia_integration.cassette import \
+            read_entries, cassette_paths
+
+        def make_label():
+            self.setup_defaults()
+
+            shipment, = self.StockShipmentOut.search([])
+            self.StockShipmentOut.write([shipment], {
+                'code': '1001',
+            })
+            shipment.assign([shipment])
+            shipment.pack([shipment])
+
+            with Transaction().set_context(company=self.company.id):
+                rates = self.sale.get_endicia_shipping_rates()
+                tracking_number = shipment.make_endicia_labels()
+            return rates, tracking_number
+
+        directory = tempfile.mkdtemp()
+        try:
+            config.set('endicia', 'record', directory)
+            try:
+                with Transaction().start(DB_NAME, USER, context=CONTEXT):
+                    rates, tracking_number = make_label()
+            finally:
+                config.remove_option('endicia', 'record')
+
+            path, = cassette_paths([directory])
+            entries = list(read_entries(path))
+            # Postage of the sale, rates and label
+            self.assertEqual(len(entries), 3)
+            for entry in entries:
+                self.assertNotIn('PassPhrase</', entry['response'])
+                for value in entry['request'].values():
+                    self.assertNotIn('PassPhrase', value.replace(
+                        '<PassPhrase>REDACTED</PassPhrase>', ''
+                    ))
+
+            operations = len(self.endicia_server.operations) \
+                if self.endicia_server else 0
+            config.set('endicia', 'replay', directory)
+            try:
+                with Transaction().start(DB_NAME, USER, context=CONTEXT):
+                    self.assertEqual(make_label(), (rates, tracking_number))
+            finally:
+                config.remove_option('endicia', 'replay')
+            if self.endicia_server:
+                self.assertEqual(
+                    len(self.endicia_server.operations), operations
+                )
+        finally:
+            shutil.rmtree(directory)
+
+    def test_0085_address_cache(self):
+        """
+        Test that the Endicia values of an address are cached until the
+        address or its party, subdivision or country is changed
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            address = self.sale_party.addresses[1]
+            values = self.PartyAddress.get_endicia_values(
+                self.sale_party.addresses
+            )
+            self.assertEqual(
+                sorted(values), sorted(map(int, self.sale_party.addresses))
+            )
+            self.assertEqual(values[address.id]['phone'], '8005763279')
+            self.assertEqual(values[address.id]['country_name'], 'Austria')
+
+            # Only the versions of the addresses are read
+            with QueryCounter() as counter:
+                to_address = self.PartyAddress(
+                    address.id
+                ).address_to_endicia_to_address()
+            self.assertEqual(counter.count, 1)
+            self.assertEqual(to_address.data['ToCountry'], 'Austria')
+            self.assertEqual(to_address.data['ToPostalCode'], '8010')
+
+            # A change of an address keeps the values of the others
+            other = self.sale_party.addresses[0]
+            self.PartyAddress.write([address], {'zip': '8011'})
+            with QueryCounter() as counter:
+                self.PartyAddress.get_endicia_values([other])
+            self.assertEqual(counter.count, 1)
+
+            self.PartyContact.write(
+                list(self.sale_party.contact_mechanisms), {
+                    'value': '+1 (800) 555-1234',
+                }
+            )
+            self.Country.write([address.country], {
+                'endicia_country_name': 'Republic of Austria',
+            })
+            self.PartyAddress.write([address], {'zip': '8020'})
+
+            to_address = self.PartyAddress(
+                address.id
+            ).address_to_endicia_to_address()
+            self.assertEqual(to_address.data['ToPhone'], '18005551234')
+            self.assertEqual(
+                to_address.data['ToCountry'], 'Republic of Austria'
+            )
+            self.assertEqual(to_address.data['ToPostalCode'], '8020')
+
+    def test_0090_validate_shipments(self):
+        """
+        Test that invalid shipments are reported without any request and
+        that the labels of the valid shipments of the batch are made
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            self.create_sale(self.sale_party)
+
+            valid, invalid = self.StockShipmentOut.search(
+                [], order=[('id', 'ASC')]
+            )
+            address, = self.PartyAddress.create([{
+                'party': self.sale_party.id,
+                'name': 'John Doe',
+                'street': '123 Main Street',
+                'zip': '8370',
+                'city': 'Boise',
+                'country': self.sale_party.addresses[0].country.id,
+            }])
+            self.StockShipmentOut.write([invalid], {
+                'delivery_address': address.id,
+                'endicia_integrated_form_type': None,
+            })
+            self.StockShipmentOut.assign([valid, invalid])
+            self.StockShipmentOut.pack([valid, invalid])
+
+            with Transaction().set_context(company=self.company.id):
+                errors = self.StockShipmentOut.validate_endicia_shipments(
+                    [valid, invalid]
+                )
+                self.assertEqual(errors.keys(), [str(invalid.id)])
+                self.assertEqual(
+                    sorted(error for error, _ in errors[str(invalid.id)]), [
+                        'integrated_form_type_missing',
+                        'invalid_zip',
+                        'subdivision_missing',
+                    ]
+                )
+                self.assertIn(
+                    '"8370"', dict(errors[str(invalid.id)])['invalid_zip']
+                )
+
+                operations = self.endicia_server and \
+                    len(self.endicia_server.operations)
+                tracking_numbers, errors = \
+                    self.StockShipmentOut.make_endicia_labels_batch(
+                        [valid, invalid]
+                    )
+            # The results can be sent over XML-RPC
+            xmlrpclib.dumps((tracking_numbers, errors))
+            self.assertEqual(tracking_numbers.keys(), [str(valid.id)])
+            self.assertEqual(errors.keys(), [str(invalid.id)])
+            self.assertEqual(
+                self.StockShipmentOut(valid.id).tracking_number,
+                tracking_numbers[str(valid.id)]
+            )
+            self.assertFalse(self.StockShipmentOut(invalid.id).tracking_number)
+            if self.endicia_server:
+                self.assertEqual(
+                    self.endicia_server.operations[operations:], ['label']
+                )
+
+    def test_0095_zip_database(self):
+        """
+        Test that US addresses are checked and corrected with the ZIP
+        database
+        """
+        from trytond.modules.endicia_integration.zip_database import build
+
+        handle, path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        build([
+            ('84301', 'Bear River City', 'UT'),
+            ('83702', 'Boise', 'ID'),
+        ], path)
+        try:
+            with Transaction().start(DB_NAME, USER, context=CONTEXT):
+                self.setup_defaults()
+
+                # The company address is in California with a ZIP of Utah
+                from_address = self.company.party.addresses[0] \
+                    .address_to_endicia_from_address()
+                self.assertEqual(from_address.data['FromState'], 'CA')
+
+                # The cached values are corrected once there is a database
+                config.set('endicia', 'zip_database', path)
+                from_address = self.company.party.addresses[0] \
+                    .address_to_endicia_from_address()
+                self.assertEqual(from_address.data['FromState'], 'UT')
+                self.assertEqual(
+                    from_address.data['FromCity'], 'BEAR RIVER CITY'
+                )
+                to_address = self.sale_party.addresses[0] \
+                    .address_to_endicia_to_address()
+                self.assertEqual(to_address.data['ToCity'], 'Boise')
+
+                shipment, = self.StockShipmentOut.search([])
+                self.StockShipmentOut.write([shipment], {
+                    'delivery_address': self.sale_party.addresses[2].id,
+                })
+                shipment.assign([shipment])
+                shipment.pack([shipment])
+                errors = self.StockShipmentOut.validate_endicia_shipments(
+                    [shipment]
+                )
+                self.assertEqual(
+                    [error for error, _ in errors[str(shipment.id)]],
+                    ['unknown_zip']
+                )
+        finally:
+            config.remove_option('endicia', 'zip_database')
+            os.remove(path)
+
+    def test_0100_country_endicia_name(self):
+        """
+        Test the Endicia name of countries and its search
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            country_us, country_at = self.Country.search(
+                [('code', 'in', ['US', 'AT'])], order=[('code', 'DESC')]
+            )
+            self.Country.write([country_us], {
+                'endicia_country_name': 'United States of America',
+            })
+            self.assertEqual(
+                self.Country.search([('endicia_name', '=', 'Austria')]),
+                [country_at]
+            )
+            self.assertEqual(
+                self.Country.search([
+                    ('endicia_name', 'ilike', 'United States%'),
+                ]),
+                [country_us]
+            )
+
+            names = self.Country.get_endicia_names()
+            self.assertEqual(names['US'], 'United States of America')
+            self.assertEqual(names['AT'], 'Austria')
+            with QueryCounter() as counter:
+                self.Country.get_endicia_names()
+            self.assertEqual(counter.count, 0)
+
+            self.Country.write([country_at], {
+                'endicia_country_name': 'Republic of Austria',
+            })
+            self.assertEqual(
+                self.Country.get_endicia_names()['AT'], 'Republic of Austria'
+            )
+
+    def test_0105_is_endicia_shipping(self):
+        """
+        Test that sales and shipments store whether their carrier is Endicia
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            shipment, = self.StockShipmentOut.search([])
+            self.assertTrue(self.sale.is_endicia_shipping)
+            self.assertTrue(shipment.is_endicia_shipping)
+            self.assertEqual(
+                self.Sale.search([('is_endicia_shipping', '=', True)]),
+                [self.sale]
+            )
+            self.assertEqual(
+                self.StockShipmentOut.search([
+                    ('is_endicia_shipping', '=', True),
+                ]),
+                [shipment]
+            )
+
+            # The shipments of the carrier follow its cost method
+            self.Carrier.write([self.carrier], {
+                'carrier_cost_method': 'product',
+            })
+            self.assertFalse(self.Sale(self.sale.id).is_endicia_shipping)
+            self.assertEqual(
+                self.StockShipmentOut.search([
+                    ('is_endicia_shipping', '=', True),
+                ]),
+                []
+            )
+            self.Carrier.write([self.carrier], {
+                'carrier_cost_method': 'endicia',
+            })
+            self.assertTrue(
+                self.StockShipmentOut(shipment.id).is_endicia_shipping
+            )
+
+            self.StockShipmentOut.write([shipment], {'carrier': None})
+            self.assertFalse(
+                self.StockShipmentOut(shipment.id).is_endicia_shipping
+            )
+
+    def test_0110_endicia_indexes(self):
+        """
+        Test that the Endicia lookups use their indexes and the label lookup
+        by tracking number
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            ShipmentBag = POOL.get('endicia.shipment.bag')
+
+            # The plans are read before any write, as SQLite commits the
+            # transaction before an EXPLAIN
+            # Labels looked up by tracking number
+            self.assertIn(
+                'stock_shipment_out_endicia_tracking_number_index',
+                query_plan(self.StockShipmentOut.search([
+                    ('tracking_number', 'in', ['9400110200881']),
+                ], query=True))
+            )
+            # Open bag of an account
+            for account in [None, 1]:
+                self.assertIn(
+                    'endicia_shipment_bag_open_index',
+                    query_plan(ShipmentBag.search([
+                        ('state', '=', 'open'),
+                        ('endicia_account', '=', account),
+                    ], query=True))
+                )
+            # Cancelled shipments of the refund sweep
+            self.assertIn(
+                'stock_shipment_out_endicia_refund_index',
+                query_plan(self.StockShipmentOut.search([
+                    ('state', '=', 'cancel'),
+                    ('tracking_number', '!=', None),
+                    ('endicia_refunded', '=', False),
+                    ('endicia_refund_rejected', '=', False),
+                    ('is_endicia_shipping', '=', True),
+                    ('write_date', '<=', datetime.utcnow()),
+                    ('write_date', '>', datetime(2015, 1, 1)),
+                ], order=[('write_date', 'ASC')], query=True))
+            )
+            # Shipments are bagged by their primary key
+            with QueryCounter() as counter:
+                self.StockShipmentOut.add_to_endicia_bag(
+                    [self.StockShipmentOut(-1)]
+                )
+            select, = counter.queries
+            self.assertRegexpMatches(
+                query_plan(select), 'PRIMARY KEY|_pkey'
+            )
+
+            self.setup_defaults()
+
+            shipment, = self.StockShipmentOut.search([])
+            self.StockShipmentOut.write([shipment], {
+                'code': str(int(time())),
+            })
+            shipment.assign([shipment])
+            shipment.pack([shipment])
+            with Transaction().set_context(company=self.company.id):
+                tracking_number = shipment.make_endicia_labels()
+
+            attachments = self.IrAttachment.search([
+                ('resource', '=', 'stock.shipment.out,%s' % shipment.id)
+            ])
+            self.assertTrue(attachments)
+            self.assertEqual(
+                self.StockShipmentOut.get_endicia_labels(
+                    [tracking_number, 'UNKNOWN']
+                ), {
+                    tracking_number: [a.id for a in sorted(
+                        attachments, key=lambda a: a.name
+                    )],
+                    'UNKNOWN': [],
+                }
+            )
+
+    def test_0115_shipment_endicia_defaults(self):
+        """
+        Test that the shipments of sales are created with their Endicia
+        values
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            mailclass, = self.EndiciaMailclass.search([
+                ('value', '=', 'Express')
+            ])
+            self.SaleConfig.write(self.SaleConfig(1), {
+                'endicia_package_type': 'Merchandise',
+            })
+            with Transaction().set_context(company=self.company.id):
+                sale, = self.Sale.create([{
+                    'reference': 'S-1002',
+                    'payment_term': self.payment_term,
+                    'party': self.sale_party.id,
+                    'invoice_address': self.sale_party.addresses[0].id,
+                    'shipment_address': self.sale_party.addresses[0].id,
+                    'carrier': self.carrier.id,
+                    'endicia_mailclass': mailclass.id,
+                    'endicia_mailpiece_shape': 'Parcel',
+                    'lines': [('create', [{
+                        'type': 'line',
+                        'quantity': 1,
+                        'product': self.product,
+                        'unit_price': Decimal('10.00'),
+                        'description': 'Test Description1',
+                        'unit': self.product.template.default_uom,
+                    }])],
+                }])
+                self.Sale.quote([sale])
+                self.Sale.confirm([sale])
+                self.Sale.process([sale])
+
+            shipment, = sale.shipments
+            self.assertEqual(shipment.endicia_mailclass, mailclass)
+            self.assertEqual(shipment.endicia_mailpiece_shape, 'Parcel')
+            self.assertEqual(shipment.endicia_label_subtype, 'Integrated')
+            self.assertEqual(
+                shipment.endicia_integrated_form_type, 'Form2976'
+            )
+            self.assertTrue(shipment.endicia_include_postage)
+            self.assertEqual(shipment.endicia_package_type, 'Merchandise')
+            self.assertTrue(shipment.is_endicia_shipping)
+
+    def test_0120_credentials_cache(self):
+        """
+        Test that the credentials are read once and kept until changed
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            self.EndiciaConfiguration.warm_up_endicia_caches()
+            with QueryCounter() as counter:
+                credentials = \
+                    self.EndiciaConfiguration(1).get_endicia_credentials()
+            self.assertEqual(counter.count, 0)
+            self.assertEqual(credentials.passphrase, 'PassPhrase')
+
+            # Writing other fields keeps the snapshot
+            self.EndiciaConfiguration.write([self.EndiciaConfiguration(1)], {
+                'refund_sweep_days': 3,
+            })
+            self.assertIs(
+                self.EndiciaConfiguration(1).get_endicia_credentials(),
+                credentials
+            )
+
+            self.EndiciaConfiguration.write([self.EndiciaConfiguration(1)], {
+                'passphrase': 'NewPassPhrase',
+            })
+            self.assertEqual(
+                self.EndiciaConfiguration(1)
+                .get_endicia_credentials().passphrase,
+                'NewPassPhrase'
+            )
+
+            self.EndiciaConfiguration.write([self.EndiciaConfiguration(1)], {
+                'passphrase': None,
+            })
+            self.assertRaises(
+                UserError,
+                self.EndiciaConfiguration(1).get_endicia_credentials
+            )
+
+    def test_0125_account_pool(self):
+        """
+        Test that the requests are spread over the Endicia accounts
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            EndiciaAccount = POOL.get('endicia.account')
+            EndiciaShipmentBag = POOL.get('endicia.shipment.bag')
+
+            self.setup_defaults()
+            self.create_sale(self.sale_party)
+            shipments = self.StockShipmentOut.search([])
+            warehouse = shipments[0].warehouse
+
+            account1, account2 = EndiciaAccount.create([{
+                'name': 'Account 1',
+                'company': self.company.id,
+                'account_id': 100001,
+                'requester_id': '123456',
+                'passphrase': 'PassPhrase',
+                'is_test': True,
+            }, {
+                'name': 'Account 2',
+                'company': self.company.id,
+                'account_id': 100002,
+                'requester_id': '123456',
+                'passphrase': 'PassPhrase',
+                'is_test': True,
+            }])
+
+            self.StockShipmentOut.assign(shipments)
+            self.StockShipmentOut.pack(shipments)
+            with Transaction().set_context(company=self.company.id):
+                for shipment in shipments:
+                    shipment.make_endicia_labels()
+
+                # Round robin
+                self.assertEqual(
+                    set(s.endicia_account for s in shipments),
+                    set([account1, account2])
+                )
+                for account in (account1, account2):
+                    self.assertTrue(
+                        EndiciaAccount(account.id).postage_balance
+                    )
+
+                # The shipments are bagged by account
+                self.StockShipmentOut.done(shipments)
+                bags = EndiciaShipmentBag.search([('state', '=', 'open')])
+                self.assertEqual(len(bags), 2)
+                for bag in bags:
+                    shipment, = bag.shipments
+                    self.assertEqual(
+                        bag.endicia_account, shipment.endicia_account
+                    )
+                EndiciaShipmentBag.close(bags)
+                self.assertTrue(all(bag.submission_id for bag in bags))
+
+                # Least loaded
+                self.EndiciaConfiguration.write(
+                    [self.EndiciaConfiguration(1)], {
+                        'account_policy': 'least_loaded',
+                    }
+                )
+                config = self.EndiciaConfiguration(1)
+                slots.acquire(account1.account_id)
+                try:
+                    self.assertEqual(
+                        config.get_endicia_credentials().account, account2.id
+                    )
+                finally:
+                    slots.release(account1.account_id)
+
+                # Per warehouse
+                EndiciaAccount.write([account2], {'warehouse': warehouse.id})
+                self.EndiciaConfiguration.write(
+                    [self.EndiciaConfiguration(1)], {
+                        'account_policy': 'warehouse',
+                    }
+                )
+                config = self.EndiciaConfiguration(1)
+                for _ in xrange(2):
+                    self.assertEqual(
+                        config.get_endicia_credentials(warehouse).account,
+                        account2.id
+                    )
+                    self.assertEqual(
+                        config.get_endicia_credentials().account, account1.id
+                    )
+
+                # The labels are refunded with their account
+                results = self.StockShipmentOut.refund_endicia_labels(
+                    shipments
+                )
+                self.assertEqual([r[0] for r in results], shipments)
+
+    def test_0130_account_slots(self):
+        """
+        Test that the requests of an account wait for a free slot
+        """
+        account_slots = AccountSlots()
+        account_slots.set_limit(100001, 1)
+        account_slots.acquire(100001)
+        self.assertEqual(account_slots.load(100001), 1)
+
+        acquired = threading.Event()
+
+        def request():
+            account_slots.acquire(100001)
+            acquired.set()
+            account_slots.release(100001)
+
+        thread = threading.Thread(target=request)
+        thread.start()
+        self.assertFalse(acquired.wait(0.2))
+        account_slots.release(100001)
+        self.assertTrue(acquired.wait(5))
+        thread.join()
+        self.assertEqual(account_slots.load(100001), 0)
+
+    def test_0135_rate_limit(self):
+        """
+        Test that the rate limits are shared by the buckets of a file
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'test.bucket')
+            bucket = TokenBucket(path, 10)
+            now = time()
+            self.assertEqual(bucket.reserve(now), 0)
+            self.assertAlmostEqual(bucket.reserve(now), 0.1)
+
+            # Another process reads the tokens taken from the file
+            other = TokenBucket(path, 10)
+            self.assertAlmostEqual(other.reserve(now), 0.2)
+
+            # The tokens are added back, but not above the burst
+            self.assertEqual(bucket.reserve(now + 10), 0)
+            self.assertAlmostEqual(other.reserve(now + 10), 0.1)
+            bucket.close()
+            other.close()
+
+            api = ShippingLabelAPI(
+                label_request=None, weight_oz=1, partner_customer_id=1,
+                partner_transaction_id=1, accountid=100002,
+                requesterid='test', passphrase='test', test=True
+            )
+            limiter = RateLimiter(directory, api_rates={'label': 1000})
+            self.assertEqual(limiter.acquire(api), 0)
+            self.assertTrue(os.path.exists(
+                os.path.join(directory, '100002-label.bucket')
+            ))
+            self.assertFalse(os.path.exists(
+                os.path.join(directory, '100002.bucket')
+            ))
+
+            # The rate of the account replaces the rate of the configuration
+            set_account_rate(100002, 1000)
+            try:
+                # At most a token of the API bucket is waited for
+                self.assertTrue(limiter.acquire(api) <= 0.001)
+                self.assertTrue(os.path.exists(
+                    os.path.join(directory, '100002.bucket')
+                ))
+            finally:
+                set_account_rate(100002, None)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_0140_parallel_rating(self):
+        """
+        Test that the costs of several mailclasses and the rates of several
+        sales are requested at the same time
+        """
+        mailclasses = ['First', 'Priority', 'Express', 'MediaMail']
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context(company=self.company.id):
+                other_sale = self.create_sale(self.sale_party)
+                costs = self.sale.get_endicia_shipping_costs(mailclasses)
+                self.assertEqual(sorted(costs), sorted(mailclasses))
+                for mailclass in mailclasses:
+                    self.assertEqual(
+                        costs[mailclass],
+                        self.sale.get_endicia_shipping_cost(mailclass)
+                    )
+
+                rates = self.Sale.get_endicia_sales_shipping_rates(
+                    [self.sale, other_sale]
+                )
+                self.assertEqual(
+                    sorted(rates), sorted([self.sale.id, other_sale.id])
+                )
+                self.assertEqual(
+                    rates[self.sale.id],
+                    self.sale.get_endicia_shipping_rates()
+                )
+
+                if self.endicia_server is None:
+                    # The latency of the Endicia test server is not known
+                    return
+                self.endicia_server.latency = 0.5
+                try:
+                    start = time()
+                    self.sale.get_endicia_shipping_costs(mailclasses)
+                    self.assertLess(time() - start, 1.5)
+                finally:
+                    self.endicia_server.latency = 0
+
+    def test_0145_request_templates(self):
+        """
+        Test that the requests made from a template are the ones the APIs
+        write
+        """
+        credentials = {
+            'accountid': 100003, 'requesterid': 'test',
+            'passphrase': 'test', 'test': True,
+        }
+        from_address = FromAddress(
+            FromName='Warehouse', ReturnAddress1='1 Main St',
+            FromCity='Springfield', FromState='IL',
+            FromPostalCode='62701', FromPhone='5555555555',
+        )
+        to_address = ToAddress(
+            ToName='Customer', ToCompany='Customer',
+            ToAddress1='2 Oak St', ToCity='Chicago', ToState='IL',
+            ToPostalCode='60601', ToCountryCode='US', ToPhone='5555555556',
+        )
+
+        def label_request():
+            return LabelRequest(
+                Test='YES', LabelType='International', ImageFormat='PNG',
+                LabelSize='6x4'
+            )
+
+        api = ShippingLabelAPI(
+            label_request=label_request(), weight_oz=None,
+            partner_customer_id=None, partner_transaction_id=None,
+            mail_class=None, **credentials
+        )
+        api.add_data(from_address.data)
+        template = RequestTemplate(api)
+
+        variable = {
+            'LabelSubtype': 'Integrated',
+            'IncludePostage': 'FALSE',
+            'IntegratedFormType': 'Form2976',
+            'customsinfo': [
+                Element('ContentsExplanation', 'Books'),
+                Element('CustomsItems', [
+                    Element('CustomsItem', [
+                        Element('Description', 'Book'),
+                        Element('Quantity', 2),
+                    ]),
+                ]),
+            ],
+            'Value': '10.00',
+        }
+        request = template.new_request()
+        request.add_data({
+            'MailClass': 'PriorityMailInternational',
+            'WeightOz': Decimal('12.5'),
+            'PartnerCustomerID': 7,
+            'PartnerTransactionID': 8,
+        })
+        request.add_data(to_address.data)
+        request.add_data(variable)
+
+        expected = ShippingLabelAPI(
+            label_request=label_request(), weight_oz=Decimal('12.5'),
+            partner_customer_id=7, partner_transaction_id=8,
+            mail_class='PriorityMailInternational', **credentials
+        )
+        expected.add_data(from_address.data)
+        expected.add_data(to_address.data)
+        expected.add_data(variable)
+        self.assertEqual(request.to_xml(), expected.to_xml())
+
+        # The template is not changed by its requests
+        self.assertEqual(template.new_request().to_xml(), api.to_xml())
+
+        for API in (CalculatingPostageAPI, PostageRatesAPI):
+            template = RequestTemplate(API(
+                mailclass=None, weightoz=None, from_postal_code='62701',
+                to_postal_code=None, to_country_code=None, **credentials
+            ))
+            request = template.new_request()
+            request.add_data({
+                'MailClass': 'Priority',
+                'WeightOz': Decimal('3.2'),
+                'ToPostalCode': '60601',
+                'ToCountryCode': 'US',
+            })
+            expected = API(
+                mailclass='Priority', weightoz=Decimal('3.2'),
+                from_postal_code='62701', to_postal_code='60601',
+                to_country_code='US', **credentials
+            )
+            self.assertEqual(request.to_xml(), expected.to_xml())
+
+    def test_0150_concurrent_postage_balance(self):
+        """
+        Test that concurrent label runs record the postage balance without
+        failing to serialize their transactions
+        """
+        if backend.name() == 'sqlite':
+            self.skipTest('needs a database with several connections')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.EndiciaConfiguration.create([{
+                'account_id': '123456',
+                'requester_id': '123456',
+                'passphrase': 'PassPhrase',
+                'is_test': True,
+            }])
+            Transaction().cursor.commit()
+
+        started = threading.Semaphore(0)
+        go = threading.Event()
+        errors = []
+
+        def label_run(balance):
+            try:
+                with Transaction().start(DB_NAME, USER, context=CONTEXT):
+                    # The snapshot of the transaction is taken before the
+                    # other run records its balance
+                    self.EndiciaConfiguration(1).postage_balance
+                    started.release()
+                    go.wait(5)
+                    self.EndiciaConfiguration.update_postage_balance(
+                        balance
+                    )
+                    Transaction().cursor.commit()
+            except Exception, error:
+                errors.append(error)
+                started.release()
+
+        threads = [
+            threading.Thread(target=label_run, args=(Decimal(balance),))
+            for balance in ('900', '800')
+        ]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                started.acquire()
+            go.set()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(errors, [])
+
+            with Transaction().start(DB_NAME, USER, context=CONTEXT):
+                self.assertIn(
+                    self.EndiciaConfiguration(1).postage_balance,
+                    [Decimal('900'), Decimal('800')]
+                )
+        finally:
+            with Transaction().start(DB_NAME, USER, context=CONTEXT):
+                self.EndiciaConfiguration.delete(
+                    self.EndiciaConfiguration.search([])
+                )
+                Transaction().cursor.commit()
+
+    def test_0155_recredit_postage(self):
+        """
+        Test that the scheduled action buys postage when the balance is low
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.EndiciaConfiguration.create([{
+                'account_id': '123456',
+                'requester_id': '123456',
+                'passphrase': 'PassPhrase',
+                'is_test': True,
+                'postage_low_balance': Decimal('100'),
+                'postage_recredit_amount': Decimal('500'),
+            }])
+            operations = self.endicia_server and \
+                len(self.endicia_server.operations)
+
+            # Nothing is bought while the balance is not low
+            self.EndiciaConfiguration.update_postage_balance(Decimal('250'))
+            self.EndiciaConfiguration.recredit_postage()
+            if self.endicia_server:
+                self.assertEqual(
+                    len(self.endicia_server.operations), operations
+                )
+
+            self.EndiciaConfiguration.update_postage_balance(Decimal('75.5'))
+            self.assertTrue(
+                self.EndiciaConfiguration(1).postage_recredit_pending
+            )
+            self.EndiciaConfiguration.recredit_postage()
+
+            config = self.EndiciaConfiguration(1)
+            self.assertFalse(config.postage_recredit_pending)
+            self.assertNotEqual(config.postage_balance, Decimal('75.5'))
+            if self.endicia_server:
+                self.assertEqual(
+                    self.endicia_server.operations[operations:],
+                    ['buy_postage']
+                )
+
+    def test_0160_label_document(self):
+        """
+        Test that the label document is stored as an attachment
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            shipment, = self.StockShipmentOut.search([])
+            self.StockShipmentOut.write([shipment], {
+                'code': str(int(time())),
+            })
+            shipment.assign([shipment])
+            shipment.pack([shipment])
+            with Transaction().set_context(company=self.company.id):
+                tracking_number = shipment.make_endicia_labels()
+
+            resource = 'stock.shipment.out,%s' % shipment.id
+            labels = self.IrAttachment.search([('resource', '=', resource)])
+            # The underscore of the label names is not a wildcard
+            self.IrAttachment.create([{
+                'name': 'PackingXUSPS-Endicia.png',
+                'resource': resource,
+                'data': buffer('Not a label'),
+            }])
+            self.assertEqual(
+                self.StockShipmentOut.get_endicia_labels([tracking_number]),
+                {tracking_number: [a.id for a in labels]}
+            )
+
+            attachment_id = self.StockShipmentOut.get_endicia_label_document(
+                [shipment]
+            )
+            document = self.IrAttachment(attachment_id)
+            self.assertEqual(document.name, 'USPS-Endicia-Labels.pdf')
+            self.assertEqual(document.resource, shipment)
+            self.assertTrue(document.digest)
+            self.assertTrue(str(document.data).startswith('%PDF'))
+
+            # The document of the shipment is replaced
+            self.assertEqual(
+                self.StockShipmentOut.get_endicia_label_document([shipment]),
+                attachment_id
+            )
+
+            # The wizard opens the attachment of the document
+            LabelDocument = POOL.get('endicia.label.document', type='wizard')
+            session_id, _, _ = LabelDocument.create()
+            wizard = LabelDocument(session_id)
+            with Transaction().set_context(
+                    active_model='stock.shipment.out',
+                    active_ids=[shipment.id]):
+                action, _ = wizard.do_start(wizard.start.get_action())
+            self.assertEqual(action['res_model'], 'ir.attachment')
+            self.assertEqual(
+                PYSONDecoder().decode(action['pyson_domain']),
+                [['id', '=', attachment_id]]
+            )
+
+            # Labels of a profile in PDF format are not merged
+            self.create_sale(self.sale_party)
+            other, = self.StockShipmentOut.search([
+                ('id', '!=', shipment.id),
+            ])
+            self.IrAttachment.create([{
+                'name': '%s_USPS-Endicia.pdf' % tracking_number,
+                'resource': 'stock.shipment.out,%s' % other.id,
+                'data': buffer('%PDF-1.4'),
+            }])
+            with self.assertRaises(UserError) as error:
+                self.StockShipmentOut.get_endicia_label_document([other])
+            self.assertIn('"PDF" format', error.exception.message)
+
+    def test_0165_account_recredit(self):
+        """
+        Test that postage is bought for the accounts whose balance is low
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            EndiciaAccount = POOL.get('endicia.account')
+
+            self.setup_defaults()
+            account, = EndiciaAccount.create([{
+                'name': 'Account 1',
+                'company': self.company.id,
+                'account_id': 100001,
+                'requester_id': '123456',
+                'passphrase': 'PassPhrase',
+                'is_test': True,
+                'postage_low_balance': Decimal('100'),
+                'postage_recredit_amount': Decimal('500'),
+            }])
+            operations = self.endicia_server and \
+                len(self.endicia_server.operations)
+
+            self.EndiciaConfiguration.update_postage_balance(
+                Decimal('250'), account.id
+            )
+            self.assertFalse(
+                EndiciaAccount(account.id).postage_recredit_pending
+            )
+
+            self.EndiciaConfiguration.update_postage_balance(
+                Decimal('75.5'), account.id
+            )
+            account = EndiciaAccount(account.id)
+            self.assertEqual(account.postage_balance, Decimal('75.5'))
+            self.assertTrue(account.postage_recredit_pending)
+            self.assertFalse(
+                self.EndiciaConfiguration(1).postage_recredit_pending
+            )
+
+            self.EndiciaConfiguration.recredit_postage()
+
+            account = EndiciaAccount(account.id)
+            self.assertFalse(account.postage_recredit_pending)
+            self.assertNotEqual(account.postage_balance, Decimal('75.5'))
+            if self.endicia_server:
+                self.assertEqual(
+                    self.endicia_server.operations[operations:],
+                    ['buy_postage']
+                )
+
+    def test_0170_bag_account(self):
+        """
+        Test that the SCAN form of a bag is made with the account of its
+        labels when the configuration has no credentials
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            EndiciaAccount = POOL.get('endicia.account')
+            EndiciaShipmentBag = POOL.get('endicia.shipment.bag')
+
+            self.setup_defaults()
+            account, = EndiciaAccount.create([{
+                'name': 'Account 1',
+                'company': self.company.id,
+                'account_id': 100001,
+                'requester_id': '123456',
+                'passphrase': 'PassPhrase',
+                'is_test': True,
+            }])
+
+            shipment, = self.StockShipmentOut.search([])
+            self.StockShipmentOut.write([shipment], {
+                'code': str(int(time())),
+            })
+            shipment.assign([shipment])
+            shipment.pack([shipment])
+            with Transaction().set_context(company=self.company.id):
+                shipment.make_endicia_labels()
+                shipment.done([shipment])
+
+            # A bag opened without account
+            bag = self.StockShipmentOut(shipment.id).endicia_shipment_bag
+            EndiciaShipmentBag.write([bag], {'endicia_account': None})
+            self.EndiciaConfiguration.write([self.EndiciaConfiguration(1)], {
+                'account_id': None,
+                'requester_id': None,
+                'passphrase': None,
+            })
+
+            credentials = EndiciaShipmentBag(bag.id).get_endicia_credentials()
+            self.assertEqual(credentials.account, account.id)
+            EndiciaShipmentBag.close([bag])
+            self.assertTrue(EndiciaShipmentBag(bag.id).submission_id)
+
 
 def suite():
     suite = trytond.tests.test_tryton.suite()
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+    test_label_document
+
+    Test merging of labels in a print document.
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+"""
+import struct
+import zlib
+import unittest
+from StringIO import StringIO
+
+from trytond.modules.endicia_integration.label_document import \
+    RawLabelWriter, PDFLabelWriter, LabelDocumentError
+
+
+def make_png(width, height, color_type=0):
+    """
+    Build a blank PNG image
+    """
+    def chunk(chunk_type, data):
+        return struct.pack('>I', len(data)) + chunk_type + data + \
+            struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff)
+
+    row = '\x00' + '\xff' * width
+    return '\x89PNG\r\n\x1a\n' + \
+        chunk('IHDR', struct.pack(
+            '>IIBBBBB', width, height, 8, color_type, 0, 0, 0
+        )) + \
+        chunk('IDAT', zlib.compress(row * height)) + \
+        chunk('IEND', '')
+
+
+class LabelDocumentTestCase(unittest.TestCase):
+    """
+    Test the label document writers.
+    """
+
+    def test_pdf_document(self):
+        """
+        Test that PNG labels are written as the pages of a PDF
+        """
+        output = StringIO()
+        writer = PDFLabelWriter(output)
+        writer.add_label(StringIO(make_png(812, 1218)))
+        writer.add_label(StringIO(make_png(812, 1218)))
+        writer.close()
+
+        document = output.getvalue()
+        self.assertEqual(writer.count, 2)
+        self.assertTrue(document.startswith('%PDF-1.4'))
+        self.assertTrue(document.endswith('%%EOF\n'))
+        self.assertIn('/Type /Pages /Kids [6 0 R 10 0 R] /Count 2', document)
+        # 812 x 1218 pixels at 203 DPI is 4 x 6 inches
+        self.assertIn('/MediaBox [0 0 288.00 432.00]', document)
+
+        # Cross reference table points to the objects
+        xref = int(document.rsplit('startxref\n', 1)[1].split('\n')[0])
+        self.assertTrue(document[xref:].startswith('xref\n0 11\n'))
+        for line in document[xref:].splitlines()[3:13]:
+            offset = int(line.split()[0])
+            self.assertRegexpMatches(
+                document[offset:offset + 10], r'^\d+ 0 obj'
+            )
+
+    def test_pdf_document_alpha(self):
+        """
+        Test that PNG images with transparency are refused
+        """
+        writer = PDFLabelWriter(StringIO())
+        self.assertRaises(
+            LabelDocumentError, writer.add_label,
+            StringIO(make_png(10, 10, color_type=6))
+        )
+
+    def test_raw_document(self):
+        """
+        Test that raw printer labels are concatenated
+        """
+        output = StringIO()
+        writer = RawLabelWriter(output)
+        writer.add_label(StringIO('^XA^FDLabel 1^FS^XZ'))
+        writer.add_label(StringIO('^XA^FDLabel 2^FS^XZ\n'))
+        writer.close()
+
+        self.assertEqual(writer.count, 2)
+        self.assertEqual(
+            output.getvalue(),
+            '^XA^FDLabel 1^FS^XZ\n^XA^FDLabel 2^FS^XZ\n'
+        )
+
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(LabelDocumentTestCase)
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+    test_response
+
+    Test parsing of Endicia responses as a stream.
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+"""
+import base64
+import unittest
+
+from lxml import etree
+
+from trytond.modules.endicia_integration.response import StreamedResponse
+
+LABEL_RESPONSE = '''<?xml version="1.0" encoding="utf-8"?>
+<LabelRequestResponse xmlns="www.envmgr.com/LabelService">
+  <Status>0</Status>
+  <Label>
+    <Image PartNumber="1">%s</Image>
+    <Image PartNumber="2">%s</Image>
+  </Label>
+  <TrackingNumber>9400110200881234567890</TrackingNumber>
+  <FinalPostage>23.45</FinalPostage>
+  <PostageBalance>976.55</PostageBalance>
+  <PostagePrice TotalAmount="23.45">
+    <Postage TotalAmount="23.45"><MailService>Priority</MailService></Postage>
+  </PostagePrice>
+</LabelRequestResponse>'''
+
+
+class ImageStore(object):
+    """
+    Store keeping the chunks written to it
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.aborted = False
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    def close(self):
+        return base64.b64decode(''.join(self.chunks))
+
+    def abort(self):
+        self.aborted = True
+
+
+class ResponseTestCase(unittest.TestCase):
+    """
+    Test the streamed response parser.
+    """
+
+    def parse(self, response, chunk_size):
+        stores = []
+
+        def open_image():
+            stores.append(ImageStore())
+            return stores[-1]
+
+        target = StreamedResponse(open_image)
+        parser = etree.XMLParser(target=target)
+        for index in xrange(0, len(response), chunk_size):
+            parser.feed(response[index:index + chunk_size])
+        return parser.close(), stores
+
+    def test_label_response(self):
+        """
+        Test that values and images are read from a label response
+        """
+        image1, image2 = 'label ' * 5000, 'customs form ' * 5000
+        response, stores = self.parse(LABEL_RESPONSE % (
+            base64.encodestring(image1), base64.encodestring(image2)
+        ), 1000)
+
+        self.assertEqual(response.status, '0')
+        self.assertEqual(
+            response.values['TrackingNumber'], '9400110200881234567890'
+        )
+        self.assertEqual(response.values['FinalPostage'], '23.45')
+        self.assertEqual(response.values['PostageBalance'], '976.55')
+        self.assertEqual(response.images, [('1', image1), ('2', image2)])
+        # Images are given to the store as the response is read
+        self.assertTrue(len(stores[0].chunks) > 1)
+
+    def test_scan_response(self):
+        """
+        Test a SCAN form response and its error message
+        """
+        response, _ = self.parse(
+            '<SCANResponse><SubmissionID>42</SubmissionID>'
+            '<SCANForm>%s</SCANForm></SCANResponse>'
+            % base64.b64encode('scan form'), 10
+        )
+        self.assertEqual(response.status, None)
+        self.assertEqual(response.values['SubmissionID'], '42')
+        self.assertEqual(response.images, [(1, 'scan form')])
+
+        response, _ = self.parse(
+            '<SCANResponse><ErrorMsg>Invalid PIC</ErrorMsg></SCANResponse>',
+            10
+        )
+        self.assertEqual(response.error_message, 'Invalid PIC')
+        self.assertEqual(response.images, [])
+
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(ResponseTestCase)
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -7,9 +7,15 @@
     :copyright: (c) 2013-2014 by Openlabs Technologies & Consulting (P) Limited
     :license: GPLv3, see LICENSE for more details.
 """
+from time import time
+
 from trytond.tests.test_tryton import DB_NAME, USER, CONTEXT
+from trytond.config import config as tryton_config
 from trytond.transaction import Transaction
-from tests.test_endicia import BaseTestCase
+from trytond.modules.endicia_integration.tests.test_endicia import \
+    BaseTestCase
+from trytond.modules.endicia_integration.tests.query_count import \
+    QueryCounter
 
 
 class ShipmentTestCase(BaseTestCase):
@@ -39,3 +45,174 @@ class ShipmentTestCase(BaseTestCase):
             self.assertEquals(shipment.on_change_carrier(), {
                 'is_endicia_shipping': None
             })
+
+    def test_endicia_defaults(self):
+        """
+        Test that the Endicia defaults of shipments are read once from the
+        sale configuration and follow its changes.
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            fields = [
+                'endicia_mailclass', 'endicia_label_subtype',
+                'endicia_integrated_form_type', 'endicia_include_postage',
+                'endicia_package_type',
+            ]
+            self.StockShipmentOut.default_get(fields)
+            with QueryCounter() as counter:
+                defaults = self.StockShipmentOut.default_get(fields)
+            self.assertEqual(counter.count, 0)
+            self.assertEqual(defaults['endicia_package_type'], 'Other')
+
+            self.SaleConfig.write([self.SaleConfig(1)], {
+                'endicia_package_type': 'Gift',
+            })
+            defaults = self.StockShipmentOut.default_get(fields)
+            self.assertEqual(defaults['endicia_package_type'], 'Gift')
+
+    def test_sweep_endicia_refunds(self):
+        """
+        Test that the refund sweep advances its watermark.
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            config = self.EndiciaConfiguration(1)
+            self.assertIsNone(config.refund_sweep_watermark)
+
+            # No cancelled shipments, so there is nothing to refund
+            self.StockShipmentOut.sweep_endicia_refunds()
+
+            config = self.EndiciaConfiguration(1)
+            self.assertTrue(config.refund_sweep_watermark)
+            shipment, = self.StockShipmentOut.search([])
+            self.assertFalse(shipment.endicia_refunded)
+
+    def test_sweep_endicia_refunds_cancelled_label(self):
+        """
+        Test that the refund sweep refunds the label of a cancelled
+        shipment, and keeps it in its window while the refund request
+        fails.
+        """
+        if self.endicia_server is None:
+            # The requests cannot be made to fail on the Endicia test server
+            return
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            shipment, = self.StockShipmentOut.search([])
+            self.StockShipmentOut.write([shipment], {
+                'code': str(int(time())),
+            })
+            shipment.assign([shipment])
+            shipment.pack([shipment])
+            with Transaction().set_context(company=self.company.id):
+                shipment.make_endicia_labels()
+            self.StockShipmentOut.cancel([shipment])
+
+            config = self.EndiciaConfiguration(1)
+            self.EndiciaConfiguration.write([config], {
+                'refund_sweep_days': 0,
+            })
+
+            # Endicia can not be reached, so the shipment stays in the
+            # window of the next run
+            url = tryton_config.get('endicia', 'url')
+            tryton_config.set('endicia', 'url', 'http://127.0.0.1:1')
+            try:
+                self.StockShipmentOut.sweep_endicia_refunds()
+            finally:
+                tryton_config.set('endicia', 'url', url)
+
+            shipment = self.StockShipmentOut(shipment.id)
+            config = self.EndiciaConfiguration(1)
+            self.assertEqual(shipment.state, 'cancel')
+            self.assertFalse(shipment.endicia_refunded)
+            self.assertFalse(shipment.endicia_refund_rejected)
+            cancelled = shipment.write_date
+            self.assertTrue(config.refund_sweep_watermark < cancelled)
+
+            # The next run refunds the label and closes the window
+            self.StockShipmentOut.sweep_endicia_refunds()
+            self.assertEqual(self.endicia_server.operations[-1], 'refund')
+
+            shipment = self.StockShipmentOut(shipment.id)
+            config = self.EndiciaConfiguration(1)
+            self.assertTrue(shipment.endicia_refunded)
+            # The watermark is stored to the second
+            self.assertTrue(
+                config.refund_sweep_watermark >=
+                cancelled.replace(microsecond=0)
+            )
+
+            # Nothing is left to refund
+            operations = len(self.endicia_server.operations)
+            self.StockShipmentOut.sweep_endicia_refunds()
+            self.assertEqual(len(self.endicia_server.operations), operations)
+
+    def test_sweep_endicia_refunds_rejected_label(self):
+        """
+        Test that the refund sweep records a rejected refund and does not
+        request it again.
+        """
+        if self.endicia_server is None:
+            # Refunds cannot be rejected by the Endicia test server
+            return
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            self.create_sale(self.sale_party)
+
+            shipments = self.StockShipmentOut.search(
+                [], order=[('id', 'ASC')]
+            )
+            self.assertEqual(len(shipments), 2)
+            for shipment in shipments:
+                self.StockShipmentOut.write([shipment], {
+                    'code': '%s-%s' % (int(time()), shipment.id),
+                })
+            self.StockShipmentOut.assign(shipments)
+            self.StockShipmentOut.pack(shipments)
+            with Transaction().set_context(company=self.company.id):
+                for shipment in shipments:
+                    shipment.make_endicia_labels()
+            self.StockShipmentOut.cancel(shipments)
+
+            config = self.EndiciaConfiguration(1)
+            self.EndiciaConfiguration.write([config], {
+                'refund_sweep_days': 0,
+            })
+
+            # Both labels are in one refund request, and Endicia rejects
+            # the refund of the first one
+            rejected, refunded = self.StockShipmentOut.browse(
+                map(int, shipments)
+            )
+            self.endicia_server.rejected_refunds.add(rejected.tracking_number)
+            operations = len(self.endicia_server.operations)
+            try:
+                self.StockShipmentOut.sweep_endicia_refunds()
+            finally:
+                self.endicia_server.rejected_refunds.clear()
+            self.assertEqual(
+                self.endicia_server.operations[operations:], ['refund']
+            )
+
+            rejected, refunded = self.StockShipmentOut.browse(
+                map(int, shipments)
+            )
+            self.assertFalse(rejected.endicia_refunded)
+            self.assertTrue(rejected.endicia_refund_rejected)
+            self.assertTrue(refunded.endicia_refunded)
+            self.assertFalse(refunded.endicia_refund_rejected)
+
+            # The rejected label is not scanned again, even from the start
+            # of the window
+            self.EndiciaConfiguration.write([config], {
+                'refund_sweep_watermark': None,
+            })
+            operations = len(self.endicia_server.operations)
+            self.StockShipmentOut.sweep_endicia_refunds()
+            self.assertEqual(len(self.endicia_server.operations), operations)
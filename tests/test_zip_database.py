@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+    test_zip_database
+
+    Test the memory mapped ZIP database.
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+"""
+import os
+import tempfile
+import unittest
+
+from trytond.config import config
+from trytond.modules.endicia_integration.zip_database import ZipDatabase, \
+    ZipDatabaseError, build, get_zip_database
+
+
+class ZipDatabaseTestCase(unittest.TestCase):
+    """
+    Test the ZIP database
+    """
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_lookup(self):
+        """
+        Test the lookup of ZIP and ZIP+4 codes
+        """
+        count = build([
+            ('94703', 'Berkeley', 'CA'),
+            ('83702', 'boise', 'id', '1'),
+            ('00501', 'Holtsville', 'NY', '0'),
+            ('ABCDE', 'Nowhere', 'XX'),
+        ], self.path)
+        self.assertEqual(count, 3)
+
+        database = ZipDatabase(self.path)
+        try:
+            self.assertEqual(len(database), 3)
+            self.assertEqual(
+                database.lookup('83702'), (u'BOISE', 'ID', True)
+            )
+            self.assertEqual(
+                database.lookup(u'94703-1234'), (u'BERKELEY', 'CA', True)
+            )
+            self.assertEqual(
+                database.lookup('00501'), (u'HOLTSVILLE', 'NY', False)
+            )
+            self.assertIsNone(database.lookup('83703'))
+            self.assertIsNone(database.lookup(''))
+            self.assertIsNone(database.lookup(None))
+        finally:
+            database.close()
+
+    def test_binary_search(self):
+        """
+        Test that every ZIP of a large database is found
+        """
+        zip_codes = ['%05d' % number for number in xrange(1, 100000, 7)]
+        build(
+            [(zip_code, 'City %s' % zip_code, 'CA') for zip_code in zip_codes],
+            self.path
+        )
+        database = ZipDatabase(self.path)
+        try:
+            for zip_code in zip_codes:
+                self.assertEqual(
+                    database.lookup(zip_code)[0], 'CITY %s' % zip_code
+                )
+            self.assertIsNone(database.lookup('00000'))
+            self.assertIsNone(database.lookup('99999'))
+            self.assertIsNone(database.lookup('00002'))
+        finally:
+            database.close()
+
+    def test_invalid_file(self):
+        """
+        Test that a file which is not a ZIP database is refused
+        """
+        with open(self.path, 'wb') as database:
+            database.write('zip,city,state\n83702,Boise,ID\n')
+        self.assertRaises(ZipDatabaseError, ZipDatabase, self.path)
+
+    def test_replaced_database(self):
+        """
+        Test that a replaced database is opened again with a new identity
+        """
+        build([('83702', 'Boise', 'ID')], self.path)
+        if not config.has_section('endicia'):
+            config.add_section('endicia')
+        config.set('endicia', 'zip_database', self.path)
+        try:
+            database = get_zip_database()
+            self.assertIs(get_zip_database(), database)
+
+            build([('84301', 'Bear River City', 'UT')], self.path)
+            mtime = database.mtime + 10
+            os.utime(self.path, (mtime, mtime))
+            replaced = get_zip_database()
+            self.assertIsNot(replaced, database)
+            self.assertNotEqual(replaced.identity, database.identity)
+            self.assertEqual(replaced.lookup('84301')[1], 'UT')
+        finally:
+            config.remove_option('endicia', 'zip_database')
+
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(ZipDatabaseTestCase)
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
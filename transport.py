@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+    transport.py
+
+    Send the requests of the Endicia APIs.
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import time
+import urllib
+import urllib2
+import urlparse
+import threading
+from collections import defaultdict
+from StringIO import StringIO
+
+from trytond.config import config
+
+from .cassette import get_recorder, get_cassette
+from .rate_limit import get_rate_limiter
+
+__all__ = ['get_url', 'urlopen', 'send_request', 'AccountSlots', 'slots']
+
+
+class AccountSlots(object):
+    """
+    Requests in flight for each Endicia account in this process, limited
+    to the concurrency of the account. A request waits for a slot of its
+    account once the limit is reached.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.in_flight = defaultdict(int)
+        self.limits = {}
+
+    def set_limit(self, account_id, limit):
+        """
+        Set the number of requests of the account sent at the same time,
+        no limit if None
+        """
+        with self.condition:
+            self.limits[str(account_id)] = limit
+            self.condition.notify_all()
+
+    def load(self, account_id):
+        """
+        Returns the share of the slots of the account in use
+        """
+        account_id = str(account_id)
+        with self.condition:
+            limit = self.limits.get(account_id)
+            return float(self.in_flight[account_id]) / (limit or 1)
+
+    def acquire(self, account_id):
+        account_id = str(account_id)
+        with self.condition:
+            while self.limits.get(account_id) and \
+                    self.in_flight[account_id] >= self.limits[account_id]:
+                self.condition.wait()
+            self.in_flight[account_id] += 1
+
+    def release(self, account_id):
+        account_id = str(account_id)
+        with self.condition:
+            self.in_flight[account_id] -= 1
+            self.condition.notify_all()
+
+slots = AccountSlots()
+
+
+class SlotResponse(object):
+    """
+    Response holding a slot of its account until it is closed
+    """
+
+    def __init__(self, response, account_id):
+        self.response = response
+        self.account_id = account_id
+
+    def read(self, *args):
+        return self.response.read(*args)
+
+    def close(self):
+        if self.account_id is not None:
+            account_id, self.account_id = self.account_id, None
+            try:
+                self.response.close()
+            finally:
+                slots.release(account_id)
+
+
+def get_url(api):
+    """
+    Returns the URL the request of the API is sent to.
+
+    The `url` option of the `endicia` section of the configuration file
+    replaces the scheme and host of the Endicia URLs, so the requests can
+    be sent to a stand-in server::
+
+        [endicia]
+        url = http://localhost:8089
+    """
+    base_url = config.get('endicia', 'url')
+    if not base_url:
+        return api.url
+    _, _, path, query, _ = urlparse.urlsplit(api.url)
+    return base_url.rstrip('/') + path + (query and '?' + query)
+
+
+def urlopen(api, values):
+    """
+    Post the values to the URL of the API
+
+    The response is read from the cassette when the calls are replayed,
+    and recorded once read when they are recorded. Otherwise the request
+    waits for the rate limits of its account and API, and a slot of the
+    account is held until the response is closed.
+
+    :return: File like object of the response
+    """
+    cassette = get_cassette()
+    if cassette is not None:
+        return StringIO(cassette.play(api.url, values))
+
+    get_rate_limiter().acquire(api)
+    slots.acquire(api.accountid)
+    try:
+        start = time.time()
+        response = urllib2.urlopen(
+            urllib2.Request(get_url(api), urllib.urlencode(values))
+        )
+    except Exception:
+        slots.release(api.accountid)
+        raise
+    response = SlotResponse(response, api.accountid)
+    recorder = get_recorder()
+    if recorder is None:
+        return response
+    try:
+        data = response.read()
+    finally:
+        response.close()
+    recorder.record(api.url, values, data, time.time() - start)
+    return StringIO(data)
+
+
+def send_request(api):
+    """
+    Send the request of the API with its own `send_request`, the response
+    being read through `urlopen`.
+    """
+    def request(values):
+        response = urlopen(api, values)
+        try:
+            return api._set_flags(response.read())
+        finally:
+            response.close()
+
+    api.request = request
+    return api.send_request()
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+    zip_database.py
+
+    Local database of the USPS ZIP codes, with their city and state, used
+    to check and correct US addresses before labels are bought.
+
+    The database is a file of fixed size records sorted by ZIP code. It is
+    memory mapped, so it is not loaded in the workers and the processes of
+    a server share it through the page cache. A lookup is a binary search
+    on the mapped file.
+
+    The file is built from a CSV file of `zip,city,state[,valid]` rows::
+
+        python -m trytond.modules.endicia_integration.zip_database \\
+            zips.csv /var/lib/trytond/zip.db
+
+    and used by setting its path in the trytond configuration::
+
+        [endicia]
+        zip_database = /var/lib/trytond/zip.db
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import csv
+import mmap
+import struct
+import threading
+
+from trytond.config import config
+
+__all__ = ['ZipDatabase', 'ZipDatabaseError', 'build', 'get_zip_database']
+
+MAGIC = 'EZIP'
+VERSION = 1
+# Magic, version and number of records
+HEADER = struct.Struct('<4sHI')
+# ZIP, valid flag, state and city
+RECORD = struct.Struct('<5s?2s28s')
+
+
+class ZipDatabaseError(Exception):
+    """
+    The file is not a ZIP database
+    """
+
+
+def build(rows, path):
+    """
+    Write the ZIP database of the rows
+
+    :param rows: Iterable of (zip, city, state) or (zip, city, state,
+                 valid) tuples, valid being True when missing
+    :param path: Path of the file written
+    """
+    records = {}
+    for row in rows:
+        zip_code, city, state = row[:3]
+        valid = row[3] not in ('0', 'false', 'False', False) \
+            if len(row) > 3 else True
+        zip_code = zip_code.strip()[:5]
+        if len(zip_code) != 5 or not zip_code.isdigit():
+            continue
+        city = city.strip().upper()
+        if isinstance(city, unicode):
+            city = city.encode('utf-8')
+        records[zip_code] = RECORD.pack(
+            zip_code, valid, state.strip().upper(), city
+        )
+    with open(path, 'wb') as database:
+        database.write(HEADER.pack(MAGIC, VERSION, len(records)))
+        for zip_code in sorted(records):
+            database.write(records[zip_code])
+    return len(records)
+
+
+class ZipDatabase(object):
+    """
+    Memory mapped ZIP database
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as database:
+            self.map = mmap.mmap(
+                database.fileno(), 0, access=mmap.ACCESS_READ
+            )
+            self.mtime = os.fstat(database.fileno()).st_mtime
+        if len(self.map) < HEADER.size:
+            raise ZipDatabaseError('%s is not a ZIP database' % path)
+        magic, version, self.count = HEADER.unpack_from(self.map)
+        if magic != MAGIC or version != VERSION or \
+                len(self.map) != HEADER.size + self.count * RECORD.size:
+            raise ZipDatabaseError('%s is not a ZIP database' % path)
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def identity(self):
+        """
+        Path and modification time of the file, which change when the
+        database is replaced
+        """
+        return self.path, self.mtime
+
+    def close(self):
+        self.map.close()
+
+    def _find(self, zip_code):
+        """
+        Returns the offset of the record of the ZIP, None if not found
+        """
+        data = self.map
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            offset = HEADER.size + middle * RECORD.size
+            key = data[offset:offset + 5]
+            if key < zip_code:
+                low = middle + 1
+            elif key > zip_code:
+                high = middle
+            else:
+                return offset
+        return None
+
+    def lookup(self, zip_code):
+        """
+        Returns the city, state and valid flag of the ZIP, None if unknown
+
+        :param zip_code: ZIP or ZIP+4 code
+        """
+        if not zip_code:
+            return None
+        offset = self._find(zip_code.strip()[:5].encode('ascii', 'ignore'))
+        if offset is None:
+            return None
+        _, valid, state, city = RECORD.unpack_from(self.map, offset)
+        return city.rstrip('\0 ').decode('utf-8', 'ignore'), state, valid
+
+
+_databases = {}
+_lock = threading.Lock()
+
+
+def get_zip_database():
+    """
+    Returns the configured ZIP database, None if there is none. It is
+    opened once per process, and opened again when the file is replaced.
+    """
+    path = config.get('endicia', 'zip_database')
+    if not path:
+        return None
+    mtime = os.stat(path).st_mtime
+    with _lock:
+        database = _databases.get(path)
+        if database is None or database.mtime != mtime:
+            # The previous map is unmapped once no lookup uses it
+            database = _databases[path] = ZipDatabase(path)
+        return database
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Build the ZIP database from a CSV file of '
+        'zip,city,state[,valid] rows'
+    )
+    parser.add_argument('source', help='CSV file')
+    parser.add_argument('path', help='ZIP database written')
+    parser.add_argument(
+        '--skip-header', action='store_true',
+        help='skip the first row of the CSV file'
+    )
+    options = parser.parse_args()
+
+    with open(options.source, 'rb') as source:
+        rows = csv.reader(source)
+        if options.skip_header:
+            next(rows, None)
+        count = build(rows, options.path)
+    print '%s ZIP codes written to %s' % (count, options.path)
+
+if __name__ == '__main__':
+    main()